@@ -0,0 +1,75 @@
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import gbx_xml
+from gbx import xml_to_gbx
+from gbxerrors import ValidationError, GBXWriteError
+
+
+SAMPLES_DIR = 'Samples'
+REPEAT = 3  # Compiles of each file, the fastest one is kept
+
+
+def sample_paths(directory: str) -> list[str]:
+    """ Returns the xml files of directory that have a md5, the linked files don't """
+    paths = []
+    for dir_path, dir_names, file_names in os.walk(directory):
+        for file_name in file_names:
+            if not file_name.endswith('.xml'):
+                continue
+            path = os.path.join(dir_path, file_name)
+            with open(path, 'rb') as xml_file:
+                if b'md5=' in xml_file.read(512):
+                    paths.append(path)
+    return sorted(paths)
+
+
+def compile_time(xml_path: str, gbx_path: str, compress: bool) -> float:
+    gbx_tree = gbx_xml.ParseXml(xml_path)[0]
+    gbx_xml.validate_gbx_xml(gbx_tree, xml_path)
+    og_path = os.getcwd()
+    start_time = time.perf_counter()
+    try:
+        xml_to_gbx(xml_path, gbx_path, gbx_tree.getroot(), compress=compress)
+    finally:
+        os.chdir(og_path)
+    return time.perf_counter() - start_time
+
+
+def bench_compress(directory: str = SAMPLES_DIR):
+    """ Compiles every sample with and without a compressed body, prints the sizes and times """
+    print(f'{"File":<48} {"Size":>9} {"BUC size":>9} {"Ratio":>6} {"BUU ms":>8} {"BUC ms":>8}')
+    totals = [0, 0, 0.0, 0.0]
+    with tempfile.TemporaryDirectory() as out_dir:
+        for xml_path in sample_paths(directory):
+            xml_path = os.path.abspath(xml_path)
+            sizes = []
+            times = []
+            try:
+                for compress in (False, True):
+                    gbx_path = os.path.join(out_dir, 'BUC' if compress else 'BUU', 'out.Gbx')
+                    times.append(min(compile_time(xml_path, gbx_path, compress) for _ in range(REPEAT)))
+                    sizes.append(os.path.getsize(gbx_path))
+            except (ValidationError, GBXWriteError):
+                print(f'{os.path.basename(xml_path)[:48]:<48} failed to compile')
+                continue
+            print(f'{os.path.basename(xml_path)[:48]:<48} {sizes[0]:>9} {sizes[1]:>9} '
+                  f'{sizes[1] / sizes[0]:>6.2f} {times[0] * 1000:>8.1f} {times[1] * 1000:>8.1f}')
+            for i, value in enumerate(sizes + times):
+                totals[i] += value
+    if totals[0]:
+        print(f'{"Total":<48} {totals[0]:>9} {totals[1]:>9} {totals[1] / totals[0]:>6.2f} '
+              f'{totals[2] * 1000:>8.1f} {totals[3] * 1000:>8.1f}')
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    directory = sys.argv[1] if len(sys.argv) > 1 else SAMPLES_DIR
+    bench_compress(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import csv
+import logging
+from typing import BinaryIO
+
+import xml.etree.ElementTree as ET
+
+import utils
+from datatypes import data_types
+from gbxerrors import GBXWriteError
+
+
+# Data types that need child tags or files and can't be read from a single cell
+NON_SCALAR_TYPES = ('flags', 'icon', 'mesh')
+# Number of columns a data type takes when the vector components are split over columns
+TYPE_COLUMNS = {'vec2': 2, 'vec3': 3, 'color': 3, 'vec4': 4}
+
+
+def parse_schema(schema: str) -> list[tuple[str, dict]]:
+    """
+    Parses the "schema" attribute of a <list source="...">, a comma separated list of data types.
+    Parameters can be passed after a colon, like "lookbackstr:40" (the "type" attribute).
+    Raises ValueError on unknown or unsupported data types.
+    """
+    fields = []
+    for entry in schema.split(','):
+        tag, _, param = entry.strip().partition(':')
+        if tag not in data_types or tag in NON_SCALAR_TYPES:
+            raise ValueError(tag)
+        params = {}
+        if param:
+            params['type'] = param
+        fields.append((tag, params))
+    if not fields:
+        raise ValueError(schema)
+    return fields
+
+
+def get_delimiter(lst: ET.Element) -> str:
+    delimiter = lst.get('delimiter')
+    if delimiter:
+        return '\t' if delimiter == 'tab' else delimiter
+    return '\t' if lst.get('source').lower().endswith('.tsv') else ','
+
+
+def write_csv_list(file_w: BinaryIO, lst: ET.Element):
+    """
+    Writes the rows of a CSV/TSV file as <list> elements, one row at a time.
+    The element count is written first as a placeholder and patched once all rows are written.
+    """
+    source = lst.get('source')
+    count_type = lst.get('count_type')
+    try:
+        fields = parse_schema(lst.get('schema', ''))
+    except ValueError as e:
+        logging.error(f'Error: unsupported data type "{e}" in <list> schema!')
+        raise GBXWriteError
+    writers = [(data_types[tag], tag, params) for tag, params in fields]
+    split_columns = sum(TYPE_COLUMNS.get(tag, 1) for tag, _ in fields)
+
+    count_pos = file_w.tell()
+    utils.write_count(file_w, 0, count_type)
+    count = 0
+    try:
+        with utils.open_file(source, 'r', newline='', encoding='utf-8') as csv_file:
+            reader = csv.reader(csv_file, delimiter=get_delimiter(lst))
+            if lst.get('header') == '1':
+                next(reader, None)
+            for row in reader:
+                if not row:
+                    continue
+                if len(row) == len(writers):  # one cell per field
+                    values = row
+                elif len(row) == split_columns:  # vector components in separate cells
+                    values = []
+                    column = 0
+                    for _, tag, _ in writers:
+                        width = TYPE_COLUMNS.get(tag, 1)
+                        values.append(' '.join(cell.strip() for cell in row[column:column + width]))
+                        column += width
+                else:
+                    logging.error(f'Error: row has {len(row)} columns, schema needs {len(writers)} '
+                                  f'or {split_columns}! In "{source}" @ line {reader.line_num}')
+                    raise GBXWriteError
+                for (writer, _, params), value in zip(writers, values):
+                    try:
+                        writer(file_w, value.strip(), params, None)
+                    except GBXWriteError:
+                        logging.error(f'In "{source}" @ line {reader.line_num}')
+                        raise
+                count += 1
+    except (OSError, UnicodeDecodeError, csv.Error) as e:
+        logging.error(f'Error: failed to read list source "{source}"! {e}')
+        raise GBXWriteError
+
+    end_pos = file_w.tell()
+    file_w.seek(count_pos)
+    utils.write_count(file_w, count, count_type)
+    file_w.seek(end_pos)
@@ -8,18 +8,33 @@ from gbxclasses import GBXClasses
 import xml.etree.ElementTree as ET
 from gbxerrors import GBXWriteError
 from PIL import Image, ImageOps
+import meshdata
 import utils
 
 
 class LookBackStrHolder:
     has_been_used = False
     lookback_strings = []
+    string_indices = {}  # string -> index of its first occurrence in lookback_strings (counting from 1)
     version = 3
+    hits = 0
+    misses = 0
+
+    def add(self, value: str):
+        self.lookback_strings.append(value)
+        self.string_indices.setdefault(value, len(self.lookback_strings))
 
 
 lookback = LookBackStrHolder()
+_lookback_scopes: list[tuple] = []
 gbx_classes = GBXClasses()
 
+ENCODED_STR_CACHE_SIZE = 4096  # Number of encoded strings kept per encoding by _encode_str
+ENCODED_STR_MAX_LEN = 256  # Longer strings (like scripts) are rarely repeated and aren't cached
+_encoded_strs: dict = {}  # encoding -> {string: encoded string preceded by its length}
+prefetched_icons: dict = None  # absolute path -> encode_icon result, loaded ahead by linkgraph.LinkGraph
+lookback_log: list = None  # (start, 'lookbackstr', end, text, params) of the lookback strings written, see gbx
+
 
 def write_uint16(wf, value: int) -> None:
     wf.write(struct.pack('<H', value))
@@ -37,9 +52,44 @@ def read_int32(rf) -> int:
     return struct.unpack('<i', rf.read(4))[0]
 
 
+def _encode_str(value: str) -> bytes:
+    """
+    Returns the string encoded with the current encoding and preceded by its length, as written by <str>.
+    Short strings are cached for all the following compiles. Raises ValueError if it can't be encoded.
+    """
+    cache = _encoded_strs.get(utils.encoding)
+    if cache is None:
+        cache = _encoded_strs[utils.encoding] = {}
+    data = cache.get(value)
+    if data is None:
+        data = pack('<I', len(value)) + bytes(value, utils.encoding)
+        if len(value) <= ENCODED_STR_MAX_LEN:
+            if len(cache) >= ENCODED_STR_CACHE_SIZE:
+                del cache[next(iter(cache))]  # Drop the oldest string
+            cache[value] = data
+    return data
+
+
 def reset_lookback():
+    """ Starts a new lookback string scope (a head chunk or the body) """
     lookback.has_been_used = False
     lookback.lookback_strings = []
+    lookback.string_indices = {}
+
+
+def push_lookback_scope():
+    """ Saves the current lookback string scope and starts a new one, see pop_lookback_scope """
+    _lookback_scopes.append((lookback.has_been_used, lookback.lookback_strings, lookback.string_indices))
+    reset_lookback()
+
+
+def pop_lookback_scope():
+    lookback.has_been_used, lookback.lookback_strings, lookback.string_indices = _lookback_scopes.pop()
+
+
+def reset_lookback_stats():
+    lookback.hits = 0
+    lookback.misses = 0
 
 
 def __write_raw(file_w: BinaryIO, value: str, _params=None, _element: ET.Element = None):
@@ -192,15 +242,22 @@ def __write_str(file_w: BinaryIO, value: str, _params: dict, _element: ET.Elemen
         file_w.write(pack('<I', 0))
         return
     try:
-        file_w.write(pack('<I', len(value)))
-        value = bytes(value, utils.encoding)
-        file_w.write(value)
+        file_w.write(_encode_str(value))
     except ValueError or packerr:
         logging.error(f'Data type tag error: incorrect text value "{value}" in <str> tag!')
         raise GBXWriteError
 
 
 def __write_lookbackstr(file_w: BinaryIO, value: str, params: dict, _element: ET.Element = None):
+    if lookback_log is None:
+        _write_lookbackstr(file_w, value, params)
+        return
+    start_pos = file_w.tell()
+    _write_lookbackstr(file_w, value, params)
+    lookback_log.append((start_pos, 'lookbackstr', file_w.tell(), value, dict(params or {})))
+
+
+def _write_lookbackstr(file_w: BinaryIO, value: str, params: dict):
     index = 0
     if params is None:
         params = {}
@@ -216,12 +273,9 @@ def __write_lookbackstr(file_w: BinaryIO, value: str, params: dict, _element: ET
     if 'index' in params and lookback.version == 2:
         index = int(params.get('index'))
 
-    count = 0
-    for lookbackstr in lookback.lookback_strings:
-        count += 1
-        if lookbackstr == value:
-            index = count
-            break
+    found_index = lookback.string_indices.get(value)
+    if found_index:
+        index = found_index
 
     typ = params.get('type')
     if not typ:
@@ -240,20 +294,22 @@ def __write_lookbackstr(file_w: BinaryIO, value: str, params: dict, _element: ET
             file_w.write(pack('<I', index | 0x40000000))
     elif typ == '0':
         file_w.write(pack('<I', int(value)))
-        lookback.lookback_strings.append(value)
+        lookback.add(value)
         return
     else:
         logging.error(f'Data type tag error: unknown type "{typ}" in <lookbackstr> tag! (must be 0, 40 or 80)')
         raise GBXWriteError
+    if found_index:
+        lookback.hits += 1
+    else:
+        lookback.misses += 1
     if index == 0 or lookback.version == 2:
-        lookback.lookback_strings.append(value)
-        file_w.write(pack('<I', len(value)))
+        lookback.add(value)
         try:
-            value = bytes(value, utils.encoding)
+            file_w.write(_encode_str(value))
         except ValueError:
             logging.error(f'Data type tag error: incorrect text value "{value}" in <lookbackstr> tag!')
             raise GBXWriteError
-        file_w.write(value)
 
 
 def __write_flags(file_w: BinaryIO, _value: str, params: dict, element: ET.Element = None):
@@ -334,24 +390,39 @@ def __write_gbxclass(file_w: BinaryIO, value: str, params: dict, _element: ET.El
         raise GBXWriteError
 
 
+def encode_icon(path: str) -> bytes:
+    """
+    Returns an image as written by <icon>: its width, its height and its BGRA pixels from the bottom row up.
+    Raises an exception if it can't be read.
+    """
+    with utils.open_file(path) as icon_stream, Image.open(icon_stream) as icon_file:
+        icon_img = ImageOps.flip(icon_file)
+    data = pack('<HH', icon_img.width, icon_img.height)
+    if icon_img.mode == 'RGB' or icon_img.mode == 'RGBA':
+        channels = icon_img.split()
+        alpha = channels[3] if len(channels) == 4 else Image.new('L', icon_img.size, 255)
+        return data + Image.merge('RGBA', (channels[2], channels[1], channels[0], alpha)).tobytes()
+    pixels = bytearray()
+    for y in range(icon_img.height):
+        for x in range(icon_img.width):
+            rgba = icon_img.getpixel((x, y))
+            if len(rgba) < 4:
+                pixels += struct.pack('<BBBB', rgba[2], rgba[1], rgba[0], 255)
+            else:
+                pixels += struct.pack('<BBBB', rgba[2], rgba[1], rgba[0], rgba[3])
+    return data + pixels
+
+
 def __write_icon(file_w: BinaryIO, value: str, params: dict, element: ET.Element = None):
     path = params.get('link')
     if not path:
         logging.error(f'Data type tag error: missing "link" attribute!')
         raise GBXWriteError
     try:
-        icon_img = Image.open(path)
-        icon_img = ImageOps.flip(icon_img)
-        write_uint16(file_w, icon_img.width)
-        write_uint16(file_w, icon_img.height)
-        for y in range(icon_img.height):
-            for x in range(icon_img.width):
-                rgba = icon_img.getpixel((x, y))
-                if len(rgba) < 4:
-                    file_w.write(struct.pack('<BBBB', rgba[2], rgba[1], rgba[0], 255))
-                else:
-                    file_w.write(struct.pack('<BBBB', rgba[2], rgba[1], rgba[0], rgba[3]))
-        icon_img.close()
+        icon_data = prefetched_icons.get(utils.abspath(path)) if prefetched_icons else None
+        if icon_data is None:
+            icon_data = encode_icon(path)
+        file_w.write(icon_data)
     except Exception as e:
         logging.error(f'Icon error! {e}')
         raise GBXWriteError
@@ -377,5 +448,6 @@ data_types = {
     'id': __write_lookbackstr,
     'flags': __write_flags,
     'gbxclass': __write_gbxclass,
-    'icon': __write_icon
+    'icon': __write_icon,
+    'mesh': meshdata.write_mesh
 }
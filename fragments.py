@@ -0,0 +1,145 @@
+import hashlib
+import logging
+import os
+import struct
+import threading
+from struct import pack
+
+import linkgraph
+
+
+# A fragment is a compiled linked file, as a list of events replayed by gbx._splice_fragment:
+#   ('bytes', data)                 bytes that don't depend on where the file is linked
+#   ('node', refname or None)       a new node id
+#   ('ref', refname)                the node id of a reference (<node ref="...">)
+#   ('fid', refname)                the node id of a file reference (<fid ref="...">)
+#   ('lookbackstr', text, params)   a lookback string, its bytes depend on the strings written before it
+#   ('skip',)                       the size of a skippable chunk, patched by the next 'skip_end'
+#   ('skip_end',)
+EVENT_KINDS = ('bytes', 'node', 'ref', 'fid', 'lookbackstr', 'skip', 'skip_end')
+FRAGMENT_MAGIC = b'GBXF'
+FRAGMENT_FORMAT = 1
+
+
+def fragment_key(path: str, graph: linkgraph.LinkGraph, salt: str) -> str or None:
+    """
+    Returns the key of a linked file (see LinkGraph.key) salted with the compile settings the bytes
+    depend on. Returns None if the file can't be cached.
+    """
+    content_key = graph.key(path)
+    if content_key is None:
+        return None
+    return hashlib.sha256(f'{FRAGMENT_FORMAT} {salt} {content_key}'.encode()).hexdigest()
+
+
+def _pack_str(value: str or None) -> bytes:
+    if value is None:
+        return pack('<I', 0xFFFFFFFF)
+    data = value.encode('utf-8')
+    return pack('<I', len(data)) + data
+
+
+def _unpack_str(data: bytes, pos: int) -> tuple[str or None, int]:
+    size = struct.unpack_from('<I', data, pos)[0]
+    pos += 4
+    if size == 0xFFFFFFFF:
+        return None, pos
+    return data[pos:pos + size].decode('utf-8'), pos + size
+
+
+def dump_fragment(events: list) -> bytes:
+    out = [FRAGMENT_MAGIC, pack('<I', FRAGMENT_FORMAT)]
+    for event in events:
+        kind = event[0]
+        out.append(pack('<B', EVENT_KINDS.index(kind)))
+        if kind == 'bytes':
+            out.append(pack('<I', len(event[1])))
+            out.append(event[1])
+        elif kind == 'node' or kind == 'ref' or kind == 'fid':
+            out.append(_pack_str(event[1]))
+        elif kind == 'lookbackstr':
+            out.append(_pack_str(event[1]))
+            out.append(pack('<I', len(event[2])))
+            for name, value in event[2].items():
+                out.append(_pack_str(name))
+                out.append(_pack_str(value))
+    return b''.join(out)
+
+
+def load_fragment(data: bytes) -> list:
+    """ Reads a fragment written by dump_fragment, raises ValueError if it isn't one """
+    if data[:4] != FRAGMENT_MAGIC or struct.unpack_from('<I', data, 4)[0] != FRAGMENT_FORMAT:
+        raise ValueError('not a fragment')
+    events = []
+    pos = 8
+    try:
+        while pos < len(data):
+            kind = EVENT_KINDS[data[pos]]
+            pos += 1
+            if kind == 'bytes':
+                size = struct.unpack_from('<I', data, pos)[0]
+                events.append((kind, data[pos + 4:pos + 4 + size]))
+                pos += 4 + size
+            elif kind == 'node' or kind == 'ref' or kind == 'fid':
+                value, pos = _unpack_str(data, pos)
+                events.append((kind, value))
+            elif kind == 'lookbackstr':
+                text, pos = _unpack_str(data, pos)
+                count = struct.unpack_from('<I', data, pos)[0]
+                pos += 4
+                params = {}
+                for i in range(count):
+                    name, pos = _unpack_str(data, pos)
+                    params[name], pos = _unpack_str(data, pos)
+                events.append((kind, text, params))
+            else:
+                events.append((kind,))
+    except (IndexError, struct.error, UnicodeDecodeError):
+        raise ValueError('truncated fragment')
+    return events
+
+
+class FragmentCache:
+    """
+    Compiled linked files by fragment key, kept in memory and in a directory if given,
+    so they can be used by all the following compiles
+    """
+    def __init__(self, directory: str = None):
+        self.directory = directory
+        self.fragments: dict = {}  # key -> events
+        self.hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _file_path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.frag')
+
+    def get(self, key: str) -> list or None:
+        events = self.fragments.get(key)
+        if events is None and self.directory:
+            try:
+                with open(self._file_path(key), 'rb') as frag_file:
+                    events = self.fragments[key] = load_fragment(frag_file.read())
+            except (OSError, ValueError):  # Not cached yet, or not readable: compiled again
+                events = None
+        if events is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return events
+
+    def put(self, key: str, events: list):
+        self.fragments[key] = events
+        if self.directory:
+            file_path = self._file_path(key)
+            temp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'  # Puts can run in threads
+            try:
+                with open(temp_path, 'wb') as frag_file:
+                    frag_file.write(dump_fragment(events))
+                os.replace(temp_path, file_path)
+            except OSError as e:
+                logging.warning(f'Could not save a compiled fragment to "{file_path}"! {e}')
+
+    def log_stats(self):
+        logging.info(f'Fragment cache: {self.hits} hits, {self.misses} misses')
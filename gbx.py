@@ -1,18 +1,26 @@
+import hashlib
 import io
 import logging
-import os
+import multiprocessing
 import pathlib
-import struct
 from struct import pack
 import xml.etree.ElementTree as ET
-from typing import BinaryIO
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pickle import PicklingError
+from itertools import repeat
+from typing import BinaryIO, Iterable, Iterator
 
+import csvdata
 import datatypes
+import fragments
 import gbx_xml
+import linkgraph
+import lzo1x
+import sinks
 import utils
 from datatypes import data_types, reset_lookback
-from gbxerrors import GBXWriteError
+from gbxerrors import GBXWriteError, ValidationError
 from gbxclasses import GBXClasses
 
 
@@ -27,38 +35,33 @@ gbx_reftable: ET.Element
 gbx_body: ET.Element
 file_path_xml: pathlib.Path
 version = 6
+deferred_refs: dict = None  # refname -> (node id, usefile), see _defer_ref
+link_graph: linkgraph.LinkGraph = None  # Linked files parsed beforehand, see xml_to_gbx
+fragment_cache: fragments.FragmentCache = None  # Compiled linked files, see _start_link
+dedup_nodes = False  # Write nodes encoded like a previous node as a reference to it, see _finish_dedup
+compress_body = False  # Write the body compressed with LZO1X (BUC format)
+
+# Compile state kept out of the parsed XML tree, so the tree can be compiled again (see reset_compile_state)
+file_node_ids: dict = {}  # <file> -> node id
+file_usefiles: dict = {}  # <file> -> usefile
+file_dirs: dict = {}  # <file> -> index of its <dir>
+dir_ids: dict = {}  # <dir> -> index
+# Stateful writes (node ids, references, lookback strings, skip sizes) of the fragments being recorded,
+# as (position, kind, ...). None when no linked file is recorded, see _take_fragment
+fragment_log: list = None
+node_keys: dict = {}  # hash of an encoded node -> node id of the first node encoded that way
+deduped_nodes = utils.Counter()
+deduped_bytes = utils.Counter()
 
 
 def write_list_head(chunk_data: BinaryIO, lst: ET.Element):
+    if lst.get('source'):
+        csvdata.write_csv_list(chunk_data, lst)
+        return
     count = 0
     for _element in lst:
         count += 1
-
-    count_type_attrib = lst.get('count_type')
-    if not count_type_attrib:
-        if count > 4294967295:
-            logging.error(f'Error: list count exceeded uint32 size!')
-            raise GBXWriteError
-        chunk_data.write(pack('<I', count))  # write number of elements
-    else:
-        if count_type_attrib != 'none':
-            count_type = '<I'
-            if count_type_attrib == 'uint32':
-                count_type = '<I'
-                if count > 4294967295:
-                    logging.error(f'Error: list count exceeded uint32 size!')
-                    raise GBXWriteError
-            if count_type_attrib == 'uint16':
-                count_type = '<H'
-                if count > 65535:
-                    logging.error(f'Error: list count exceeded uint16 size!')
-                    raise GBXWriteError
-            if count_type_attrib == 'uint8':
-                count_type = '<B'
-                if count > 255:
-                    logging.error(f'Error: list count exceeded uint8 size!')
-                    raise GBXWriteError
-            chunk_data.write(pack(count_type, count))  # write number of elements
+    utils.write_count(chunk_data, count, lst.get('count_type'))  # write number of elements
     # write list data
     for element in lst:
         for data_type in element:
@@ -69,11 +72,11 @@ def write_list_head(chunk_data: BinaryIO, lst: ET.Element):
                 try:
                     data_types[data_type.tag](chunk_data, data_type.text, data_type.attrib, data_type)
                 except GBXWriteError:
-                    logging.error(f'Error @ line {element.get("_line_num")}')
+                    logging.error(f'Error @ line {gbx_xml.line_num(element)}')
                     raise GBXWriteError
                 except KeyError:
                     logging.error(f'Invalid data type <{data_type.tag}> for user data <list>!')
-                    logging.error(f'Error @ line {element.get("_line_num")}')
+                    logging.error(f'Error @ line {gbx_xml.line_num(element)}')
                     raise GBXWriteError
 
 
@@ -138,7 +141,7 @@ def write_dir(ref_tab_data: io.BytesIO, ref_file_data: io.BytesIO, direct: ET.El
     for element in direct:
         if element.tag == 'dir':
             directory_counter.increment()
-            element.set('dir_id', str(directory_counter))
+            dir_ids[element] = int(directory_counter)
             ref_tab_data.write(pack('<I', len(element.get('name'))))
             ref_tab_data.write(bytes(element.get('name'), 'utf-8'))
             sub_dirs = 0
@@ -149,12 +152,12 @@ def write_dir(ref_tab_data: io.BytesIO, ref_file_data: io.BytesIO, direct: ET.El
             write_dir(ref_tab_data, ref_file_data, element)
 
 
-def set_file_nodes(direct: ET.Element, dir_id):
+def set_file_nodes(direct: ET.Element, dir_id: int):
     for element in direct:
         if element.tag == 'dir':
-            set_file_nodes(element, element.get('dir_id'))
+            set_file_nodes(element, dir_ids[element])
         elif element.tag == 'file':
-            element.attrib['dirindex'] = dir_id
+            file_dirs[element] = dir_id
 
 
 def write_ref_table() -> bytes:
@@ -164,7 +167,7 @@ def write_ref_table() -> bytes:
     ref_tab_data = io.BytesIO()
     directory_counter.set_value(0)
     for file in gbx_reftable.iter('file'):  # Get used file count
-        if 'nodeid' in file.attrib:
+        if file in file_node_ids:
             filecount += 1
     ref_tab_data.write(pack('<I', filecount))  # write ex node count
 
@@ -184,13 +187,13 @@ def write_ref_table() -> bytes:
     ref_tab_data.write(pack('<I', sub_dirs))
 
     write_dir(ref_tab_data, ref_file_data, gbx_reftable)  # Write all directories
-    set_file_nodes(gbx_reftable, '0')
+    set_file_nodes(gbx_reftable, 0)
 
     files = []
     for file in gbx_reftable.iter('file'):
-        if 'nodeid' in file.attrib:
+        if file in file_node_ids:
             files.append(file)
-    files.sort(key=lambda x: int(x.get('nodeid')))  # write the files in order as they are used in the body
+    files.sort(key=file_node_ids.get)  # write the files in order as they are used in the body
 
     for file in files:
         flags = 1
@@ -203,12 +206,12 @@ def write_ref_table() -> bytes:
         else:
             ref_file_data.write(pack('<I', int(file.get('resindex'))))
 
-        ref_file_data.write(pack('<I', int(file.get('nodeid'))))
+        ref_file_data.write(pack('<I', file_node_ids[file]))
         if version >= 5:
-            ref_file_data.write(pack('<I', int(file.get('usefile'))))
+            ref_file_data.write(pack('<I', file_usefiles[file]))
 
         if flags & 4 == 0:
-            ref_file_data.write(pack('<I', int(file.get('dirindex'))))
+            ref_file_data.write(pack('<I', file_dirs[file]))
 
     ref_file_data.seek(0)
     ref_tab_data.write(ref_file_data.read())
@@ -219,24 +222,59 @@ def write_ref_table() -> bytes:
     return ref_tab_data_bytes
 
 
+def _defer_ref(in_ref_id: str, usefile: int = None) -> int:
+    """ Used when the <reference_table> comes after the <body> while streaming.
+    Assigns a node id to a reference that isn't a previously used node in the body,
+    the id is set to its <file> by resolve_deferred_refs once the table is read."""
+    if in_ref_id in deferred_refs:
+        return deferred_refs[in_ref_id][0]
+    node_counter.increment()
+    deferred_refs[in_ref_id] = (int(node_counter), usefile)
+    return int(node_counter)
+
+
+def resolve_deferred_refs():
+    """ Sets the node ids assigned by _defer_ref to the <file>s of the <reference_table> """
+    global deferred_refs
+    files = {}
+    if gbx_reftable:
+        for file in gbx_reftable.iter('file'):
+            files.setdefault(file.get('refname'), file)
+    for in_ref_id, (node_id, usefile) in deferred_refs.items():
+        file = files.get(in_ref_id)
+        if file is None:
+            logging.error(f'Error: failed to find node of id "{in_ref_id}"!')
+            raise GBXWriteError
+        file_node_ids[file] = node_id
+        file_usefiles[file] = usefile if usefile else _get_usefile(file)
+        node_pool.addNode(file, node_id)
+    deferred_refs = None
+
+
+def _get_usefile(file: ET.Element) -> int:
+    # if not specified, default value is 0 (compatibility with older xmls that don't use fids)
+    return int(file.get('usefile') or 0)
+
+
 def set_nodeid_to_node(in_ref_id: str, is_fid: bool = False) -> int:
     """ This function goes through every <file> in the <reference_table>
     and sets the correct node id if file with a given reference id exists.
     Alternatively, it tries to get previously used nodes in the body"""
     global gbx_reftable
+    if deferred_refs is not None:
+        node_id = node_pool.getNodeIndexByRefName(in_ref_id)
+        if node_id:
+            return node_id
+        return _defer_ref(in_ref_id, 1 if is_fid else None)
     if gbx_reftable:
         for file in gbx_reftable.iter('file'):
             if file.get('refname') == in_ref_id:
-                if 'nodeid' in file.attrib:
-                    return int(file.get('nodeid'))
+                if file in file_node_ids:
+                    return file_node_ids[file]
                 else:
                     node_counter.increment()
-                    file.attrib['nodeid'] = str(node_counter)
-                    if not file.get('usefile'):
-                        file.attrib['usefile'] = '0'
-                        # if not specified, set default value to 0 (compatibility with older xmls that don't use fids)
-                    if is_fid:
-                        file.attrib['usefile'] = '1'
+                    file_node_ids[file] = int(node_counter)
+                    file_usefiles[file] = 1 if is_fid else _get_usefile(file)
                     node_pool.addNode(file, int(node_counter))
                     return int(node_counter)
     # Not an external reference, try local node pool
@@ -250,117 +288,354 @@ def set_nodeid_to_node(in_ref_id: str, is_fid: bool = False) -> int:
 def set_fid_to_file(in_ref_id: str) -> int:
     """ This function goes through every <file> in the <reference_table>
     and sets the correct fid id if file with a given reference id exists """
+    if deferred_refs is not None:
+        return _defer_ref(in_ref_id, 1)
     if gbx_reftable:
         for file in gbx_reftable.iter('file'):
             if file.get('refname') == in_ref_id:
-                if 'nodeid' in file.attrib:
-                    return int(file.get('nodeid'))
+                if file in file_node_ids:
+                    return file_node_ids[file]
                 else:
                     node_counter.increment()
-                    file.attrib['nodeid'] = str(node_counter)
+                    file_node_ids[file] = int(node_counter)
                     node_pool.addNode(file, int(node_counter))
-                    file.attrib['usefile'] = '1'
+                    file_usefiles[file] = 1
                     return int(node_counter)
     # Fids can only use external references
     raise GBXWriteError
 
 
-def write_node(body_data: BinaryIO, xml_node: ET.Element):
-    changed = 0  # Directory level
+# Kinds of _Frame
+BODY_FRAME = 0   # Chunks of the <body>
+NODE_FRAME = 1   # Chunks of a <node>, followed by the node terminator
+LINK_FRAME = 2   # Chunks of a linked file, followed by the node terminator
+CHUNK_FRAME = 3  # Data tags of a <chunk> (or of a custom <node>)
+LIST_FRAME = 4   # Data tags of the <element>s of a <list>
 
-    node_ref_id = xml_node.get('ref')
-    link_ref = xml_node.get('link')
-    headless = xml_node.get('headless')
-    custom = xml_node.get('custom')
 
-    if custom:  # hacks, hacks, hacks
-        class_id = xml_node.get('class')
-        node_counter.increment()
-        node_pool.addNode(xml_node, node_counter.get_value())
-        xml_node.attrib['nodeid'] = str(node_counter)
-        # Write node ref id
-        body_data.write(pack('<I', int(node_counter)))
-
-        if class_id[0] == 'C':  # every class name starts with a 'C'
-            body_data.write(pack('<I', int(gbx_classes.get_dict().get(class_id), 16)))
-        else:  # otherwise it's a hex value
-            body_data.write(pack('<I', int(class_id, 16)))
-
-        write_chunk(body_data, xml_node, True)
+class _Frame:
+    """
+    A body, node, chunk or list being written by write_body_chunks, in place of a call stack frame
+    """
+    __slots__ = ('kind', 'elem', 'children', 'current', 'index', 'skip_pos', 'file_name', 'changed',
+                 'link_path', 'line_nums', 'fragment_key', 'fragment_pos', 'log_pos', 'dedup_state')
+
+    def __init__(self, kind: int, elem: ET.Element or None, children: Iterator):
+        self.kind = kind
+        self.elem = elem
+        self.children = children
+        self.current = None  # Child tag being written (the <element> for lists)
+        self.index = -1
+        self.skip_pos = None
+        self.fragment_key = None
+        self.dedup_state = None
+
+
+def _write_new_node_id(body_data: BinaryIO, xml_node: ET.Element):
+    node_counter.increment()
+    node_pool.addNode(xml_node, node_counter.get_value())
+    if fragment_log is not None:
+        fragment_log.append((body_data.tell(), 'node', xml_node.get('refname')))
+    body_data.write(pack('<I', int(node_counter)))
+
+
+def _write_ref(body_data: BinaryIO, node_ref_id: str):
+    try:
+        res = set_nodeid_to_node(node_ref_id)
+    except GBXWriteError:
+        logging.error(f'Error: failed to find node of id "{node_ref_id}"!')
+        raise GBXWriteError
+    if fragment_log is not None:
+        fragment_log.append((body_data.tell(), 'ref', node_ref_id))
+    body_data.write(pack('<I', res))
+
+
+def _write_fid_ref(body_data: BinaryIO, node_ref_id: str):
+    try:
+        res = set_fid_to_file(node_ref_id)
+    except GBXWriteError:
+        logging.error(f'Error: failed to find file of id "{node_ref_id}"!')
+        raise GBXWriteError
+    if fragment_log is not None:
+        fragment_log.append((body_data.tell(), 'fid', node_ref_id))
+    body_data.write(pack('<I', res))
+
+
+def _start_skip(body_data: BinaryIO) -> int:
+    """ Writes a placeholder for the size of a skippable chunk and returns its position """
+    skip_pos = body_data.tell()
+    if fragment_log is not None:
+        fragment_log.append((skip_pos, 'skip'))
+    body_data.write(pack('<I', 0))
+    return skip_pos
+
+
+def _finish_skip(body_data: BinaryIO, skip_pos: int):
+    end_pos = body_data.tell()
+    body_data.seek(skip_pos)
+    body_data.write(pack('<I', end_pos - skip_pos - 4))
+    body_data.seek(end_pos)
+    if fragment_log is not None:
+        fragment_log.append((end_pos, 'skip_end'))
+
+
+def _write_class_id(body_data: BinaryIO, class_id: str):
+    if class_id[0] == 'C':  # every class name starts with a 'C' (ex. CPlugTree)
+        body_data.write(pack('<I', int(gbx_classes.get_dict().get(class_id), 16)))
+    else:  # otherwise it's a hex value
+        body_data.write(pack('<I', int(class_id, 16)))
+
+
+def _start_chunk(body_data: BinaryIO, chunk: ET.Element, stack: list, custom: bool = False):
+    if not custom:
+        class_id = chunk.get('class')
+        chunk_id = chunk.get('id')
+        if class_id[0] == 'C':  # named class
+            full_class_id = f'{gbx_classes.get_dict().get(class_id)[:-3]}{chunk_id}'
+        else:  # not a named class
+            full_class_id = f'{class_id[:-3]}{chunk_id}'
+        body_data.write(pack('<I', int(full_class_id, 16)))
+
+    frame = _Frame(CHUNK_FRAME, chunk, iter(chunk))
+    if chunk.get('skip'):
+        body_data.write(b'PIKS')
+        frame.skip_pos = _start_skip(body_data)  # Chunk size, set by _finish_frame
+    stack.append(frame)
+
+
+def _start_fragment(body_data: BinaryIO, frame: _Frame, key: str):
+    global fragment_log
+    if fragment_log is None:
+        fragment_log = datatypes.lookback_log = []
+    frame.fragment_key = key
+    frame.fragment_pos = body_data.tell()
+    frame.log_pos = len(fragment_log)
+
+
+def _take_fragment(body_data: BinaryIO, frame: _Frame) -> list:
+    """ Returns the events of the linked file written by frame, see fragments.py """
+    global fragment_log
+    events = []
+    pos = frame.fragment_pos
+    with body_data.getbuffer() as data:
+        for entry in fragment_log[frame.log_pos:]:
+            if entry[0] > pos:
+                events.append(('bytes', bytes(data[pos:entry[0]])))
+            kind = entry[1]
+            if kind == 'lookbackstr' or kind == 'nodekey':
+                events.append((kind, entry[3], entry[4]))
+                pos = entry[2]
+            elif kind == 'skip_end':
+                events.append((kind,))
+                pos = entry[0]
+            else:  # A node id, a reference or a skip size
+                events.append((kind,) + entry[2:])
+                pos = entry[0] + 4
+        end_pos = body_data.tell()
+        if end_pos > pos:
+            events.append(('bytes', bytes(data[pos:end_pos])))
+    if frame.log_pos == 0:  # Not inside of another recorded file
+        fragment_log = datatypes.lookback_log = None
+    return events
+
+
+def _start_dedup(body_data: BinaryIO) -> tuple:
+    """ Starts recording a node before its id is written, returns the state to go back to for _finish_dedup """
+    global fragment_log
+    if fragment_log is None:
+        fragment_log = datatypes.lookback_log = []
+    return (body_data.tell(), len(fragment_log), int(node_counter),
+            datatypes.lookback.hits, datatypes.lookback.misses,
+            len(datatypes.lookback.lookback_strings), datatypes.lookback.has_been_used)
+
+
+def _hash_events(events: list) -> str:
+    events_hash = hashlib.sha256()
+    for event in events:
+        if event[0] == 'bytes':
+            events_hash.update(pack('<I', len(event[1])))
+            events_hash.update(event[1])
+        else:
+            events_hash.update(repr(event).encode())
+    return events_hash.hexdigest()
+
+
+def _finish_dedup(body_data: BinaryIO, frame: _Frame):
+    """
+    Hashes the events of a written node (without its own id). If a previous node was written the same way,
+    the node is removed and a reference to the previous node is written instead. Nodes with a refname are kept.
+    In the node around it, the node is then only recorded by its hash, so that nodes holding the same nodes
+    are written the same way whether these were removed or not
+    """
+    global fragment_log
+    node_pos, log_pos, counter_value, lookback_hits, lookback_misses, lookback_count, lookback_used = frame.dedup_state
+    frame.fragment_pos = node_pos
+    frame.log_pos = log_pos
+    key = _hash_events(_take_fragment(body_data, frame)[1:])
+    first_id = node_keys.setdefault(key, counter_value + 1)
+    if first_id == counter_value + 1 or frame.elem.get('refname'):
+        if fragment_log is not None:
+            _log_node_key(body_data, node_pos, log_pos, key, frame.elem.get('refname'))
         return
 
-    if node_ref_id:  # Node reference
-        try:
-            res = set_nodeid_to_node(node_ref_id)
-            body_data.write(pack('<I', res))
-        except GBXWriteError:
-            logging.error(f'Error: failed to find node of id "{node_ref_id}"!')
+    deduped_nodes.increment()
+    deduped_bytes.increment(body_data.tell() - node_pos - 4)
+    body_data.seek(node_pos)
+    body_data.truncate()
+    # Forget the node ids given while it was written
+    node_counter.set_value(counter_value)
+    for node_id in [node_id for node_id in node_pool.node_pool if node_id > counter_value]:
+        del node_pool.node_pool[node_id]
+    for file in [file for file, node_id in file_node_ids.items() if node_id > counter_value]:
+        del file_node_ids[file]
+        file_usefiles.pop(file, None)
+    if deferred_refs is not None:
+        for in_ref_id in [in_ref_id for in_ref_id, ref in deferred_refs.items() if ref[0] > counter_value]:
+            del deferred_refs[in_ref_id]
+    # Forget the lookback strings it added, the reader never sees them
+    lookback = datatypes.lookback
+    for value in lookback.lookback_strings[lookback_count:]:
+        if lookback.string_indices.get(value, 0) > lookback_count:
+            del lookback.string_indices[value]
+    del lookback.lookback_strings[lookback_count:]
+    lookback.has_been_used = lookback_used
+    lookback.hits, lookback.misses = lookback_hits, lookback_misses
+    body_data.write(pack('<I', first_id))
+    if fragment_log is not None:
+        _log_node_key(body_data, node_pos, log_pos, key, None)
+
+
+def _log_node_key(body_data: BinaryIO, node_pos: int, log_pos: int, key: str, refname: str or None):
+    """ Records a node by its hash in the node being recorded around it """
+    del fragment_log[log_pos:]
+    fragment_log.append((node_pos, 'nodekey', body_data.tell(), key, refname))
+
+
+def _can_splice(events: list) -> bool:
+    """ Tells if all the references of a fragment can be found, otherwise the file is written again to report it """
+    if deferred_refs is not None:
+        return True
+    file_refnames = {file.get('refname') for file in _reftable_files()}
+    node_refnames = set()
+    for event in events:
+        kind = event[0]
+        if kind == 'node':
+            node_refnames.add(event[1])
+        elif kind == 'ref':
+            if (event[1] not in file_refnames and event[1] not in node_refnames
+                    and not node_pool.getNodeIndexByRefName(event[1])):
+                return False
+        elif kind == 'fid' and event[1] not in file_refnames:
+            return False
+    return True
+
+
+def _splice_fragment(body_data: BinaryIO, events: list):
+    """ Writes a cached linked file, giving new node ids and writing the lookback strings where it is linked """
+    skip_positions = []
+    lookbackstr_writer = data_types['lookbackstr']
+    for event in events:
+        kind = event[0]
+        if kind == 'bytes':
+            body_data.write(event[1])
+        elif kind == 'node':
+            _write_new_node_id(body_data, ET.Element('node', {'refname': event[1]} if event[1] else {}))
+        elif kind == 'ref':
+            _write_ref(body_data, event[1])
+        elif kind == 'fid':
+            _write_fid_ref(body_data, event[1])
+        elif kind == 'lookbackstr':
+            lookbackstr_writer(body_data, event[1], event[2])
+        elif kind == 'skip':
+            skip_positions.append(_start_skip(body_data))
+        elif kind == 'skip_end':
+            _finish_skip(body_data, skip_positions.pop())
+
+
+def _start_link(body_data: BinaryIO, xml_node: ET.Element, stack: list):
+    changed = 0  # Directory level
+    # Relative file stuff
+    full_path = pathlib.Path(xml_node.get('link'))
+    link_dir = full_path.parent
+    for i in range(len(link_dir.parents)):
+        changed += 1
+    if len(link_dir.parents) > 0:
+        utils.chdir(link_dir)
+    file_name = full_path.name
+
+    link_path = utils.abspath(file_name)
+    for frame in stack:
+        if frame.kind == LINK_FRAME and frame.link_path == link_path:
+            logging.error(f'Error: infinite recursion detected! File "{file_name}" links to itself!')
             raise GBXWriteError
-    elif link_ref:  # Uses a separate file (link)
-        # Relative file stuff
-        full_path = pathlib.Path(xml_node.get('link'))
-        link_dir = full_path.parent
-        for i in range(len(link_dir.parents)):
-            changed += 1
-        if len(link_dir.parents) > 0:
-            os.chdir(link_dir)
-        file_name = full_path.name
 
+    link_gbx = link_graph.tree(link_path) if link_graph else None
+    if not link_gbx:
         link_gbx_res = gbx_xml.ParseXml(file_name)
         link_gbx = link_gbx_res[0]
         if not link_gbx:
             logging.error(f'Parsing failed for writing (somehow): {link_gbx_res[1]}')
             raise GBXWriteError
 
-        link_body = link_gbx.findall('body')[0]
-        class_id = link_gbx.getroot().get('class')
-
-        node_counter.increment()
-        node_pool.addNode(xml_node, node_counter.get_value())
-        xml_node.attrib['nodeid'] = str(node_counter)
-        body_data.write(pack('<I', int(node_counter)))
+    link_body = link_gbx.findall('body')[0]
+
+    dedup_state = _start_dedup(body_data) if dedup_nodes else None
+    _write_new_node_id(body_data, xml_node)
+    key = None
+    if fragment_cache and link_graph:
+        key = fragments.fragment_key(link_path, link_graph, f'{utils.encoding} {gbx_classes.get_comp_lvl()}')
+    if key:
+        events = fragment_cache.get(key)
+        if events is not None and _can_splice(events):
+            _splice_fragment(body_data, events)
+            link_graph.saved['encodes'] += 1
+            link_graph.saved['encode_bytes'] += sum(len(event[1]) for event in events if event[0] == 'bytes')
+            for i in range(changed):
+                utils.chdir('..')
+            return
+
+    # Chunks are written by write_body_chunks
+    frame = _Frame(LINK_FRAME, xml_node, iter(link_body))
+    frame.file_name = file_name
+    frame.changed = changed
+    frame.link_path = link_path
+    frame.dedup_state = dedup_state
+    if key:  # Recorded while it is written, then cached by _finish_frame
+        _start_fragment(body_data, frame, key)
+    _write_class_id(body_data, link_gbx.getroot().get('class'))
+    frame.line_nums = gbx_xml.use_line_nums(link_gbx)
+    frame.line_nums.__enter__()
+    stack.append(frame)
+
+
+def _start_node(body_data: BinaryIO, xml_node: ET.Element, stack: list):
+    node_ref_id = xml_node.get('ref')
+    link_ref = xml_node.get('link')
+    headless = xml_node.get('headless')
+    custom = xml_node.get('custom')
 
-        # Write class id
-        if class_id[0] == 'C':  # Every class name starts with a 'C' (ex. CPlugTree)
-            body_data.write(pack('<I', int(gbx_classes.get_dict().get(class_id), 16)))
-        else:                   # Use hex value instead
-            body_data.write(pack('<I', int(class_id, 16)))
+    if custom:  # hacks, hacks, hacks
+        _write_new_node_id(body_data, xml_node)
+        _write_class_id(body_data, xml_node.get('class'))
+        _start_chunk(body_data, xml_node, stack, True)
+        return
 
-        # Write chunks
-        for chunk in link_body:
-            try:
-                write_chunk(body_data, chunk)
-            except GBXWriteError:
-                logging.error(f'In file \"{file_name}\"')
-                raise
-        # Write terminator
-        body_data.write(pack('<I', 0xFACADE01))
-        # Go back to previous folder(s)
-        for i in range(changed):
-            os.chdir('..')
+    if node_ref_id:  # Node reference
+        _write_ref(body_data, node_ref_id)
+    elif link_ref:  # Uses a separate file (link)
+        _start_link(body_data, xml_node, stack)
     else:  # not a reference, not a link, just normal node in gbx
         class_id = xml_node.get('class')
         if headless or class_id:
+            frame = _Frame(NODE_FRAME, xml_node, iter(xml_node))
             if class_id:
-                node_counter.increment()
-                node_pool.addNode(xml_node, node_counter.get_value())
+                if dedup_nodes:
+                    frame.dedup_state = _start_dedup(body_data)
                 # Set node ref id to be able to reference it
-                xml_node.attrib['nodeid'] = str(node_counter)
-                # Write node ref id
-                body_data.write(pack('<I', int(node_counter)))
-                # Write class id
-                if class_id[0] == 'C':  # every class name starts with a 'C'
-                    body_data.write(pack('<I', int(gbx_classes.get_dict().get(class_id), 16)))
-                else:  # otherwise it's a hex value
-                    body_data.write(pack('<I', int(class_id, 16)))
-            # Write chunks
-            for chunk in xml_node:
-                try:
-                    write_chunk(body_data, chunk)
-                except GBXWriteError:
-                    raise
-            # Write terminator
-            body_data.write(pack('<I', 0xFACADE01))
+                _write_new_node_id(body_data, xml_node)
+                _write_class_id(body_data, class_id)
+            # Chunks are written by write_body_chunks
+            stack.append(frame)
         else:  # No class, not headless. empty node
             body_data.write(pack('<I', 0xFFFFFFFF))
 
@@ -370,130 +645,242 @@ def write_fid(body_data: BinaryIO, xml_node: ET.Element):
     if not node_ref_id:
         body_data.write(pack('<I', 0xFFFFFFFF))
         return
+    _write_fid_ref(body_data, node_ref_id)
 
-    try:
-        res = set_fid_to_file(node_ref_id)
-        body_data.write(pack('<I', res))
-    except GBXWriteError:
-        logging.error(f'Error: failed to find file of id "{node_ref_id}"!')
-        raise GBXWriteError
-
-
-def write_list(body_data: BinaryIO, lst: ET.Element):
-    count = 0
-    for _element in lst:
-        count += 1
-
-    count_type_attrib = lst.get('count_type')
-    if not count_type_attrib:
-        if count > 4294967295:
-            logging.error(f'Error: list count exceeded uint32 size!')
-            raise GBXWriteError
-        body_data.write(pack('<I', count))  # write number of elements
-    else:
-        if count_type_attrib != 'none':
-            count_type = '<I'
-            if count_type_attrib == 'uint32':
-                count_type = '<I'
-                if count > 4294967295:
-                    logging.error(f'Error: list count exceeded uint32 size!')
-                    raise GBXWriteError
-            if count_type_attrib == 'uint16':
-                count_type = '<H'
-                if count > 65535:
-                    logging.error(f'Error: list count exceeded uint16 size!')
-                    raise GBXWriteError
-            if count_type_attrib == 'uint8':
-                count_type = '<B'
-                if count > 255:
-                    logging.error(f'Error: list count exceeded uint8 size!')
-                    raise GBXWriteError
-            body_data.write(pack(count_type, count))  # write number of elements
-    for element in lst:
-        for c_element in element:
-            try:
-                write_chunk_element(body_data, c_element)
-            except GBXWriteError:
-                logging.error(f'Error @ line {element.get("_line_num")}')
-                raise GBXWriteError
 
-
-def write_chunk_element(body_data, element):
+def _write_chunk_element(body_data: BinaryIO, element: ET.Element, stack: list):
+    tag = element.tag
     # "Special" elements
-    if element.tag == 'node' or element.tag == 'nod':
-        try:
-            write_node(body_data, element)
-        except GBXWriteError:
-            raise GBXWriteError
-    elif element.tag == 'fid':
-        try:
-            write_fid(body_data, element)
-        except GBXWriteError:
-            raise GBXWriteError
-    elif element.tag == 'list':
-        try:
-            write_list(body_data, element)
-        except GBXWriteError:
-            raise GBXWriteError
-    elif element.tag == 'chunk':
-        try:
-            write_chunk(body_data, element)
-        except GBXWriteError:
-            raise GBXWriteError
+    if tag == 'node' or tag == 'nod':
+        _start_node(body_data, element, stack)
+    elif tag == 'fid':
+        write_fid(body_data, element)
+    elif tag == 'list':
+        if element.get('source'):
+            csvdata.write_csv_list(body_data, element)
+            return
+        utils.write_count(body_data, len(element), element.get('count_type'))  # write number of elements
+        stack.append(_Frame(LIST_FRAME, element, ((lst_element, data_type)
+                                                  for lst_element in element for data_type in lst_element)))
+    elif tag == 'chunk':
+        _start_chunk(body_data, element, stack)
     # Regular value tags (uint32, str, etc.)
     else:
-        try:
-            data_types[element.tag](body_data, element.text, element.attrib, element)
-        except GBXWriteError:
-            raise
+        data_types[tag](body_data, element.text, element.attrib, element)
+
+
+def _finish_frame(body_data: BinaryIO, frame: _Frame):
+    kind = frame.kind
+    if kind == CHUNK_FRAME:
+        if frame.skip_pos is not None:
+            _finish_skip(body_data, frame.skip_pos)
+    elif kind == NODE_FRAME:
+        body_data.write(pack('<I', 0xFACADE01))  # Write terminator
+        if frame.dedup_state:
+            _finish_dedup(body_data, frame)
+    elif kind == LINK_FRAME:
+        body_data.write(pack('<I', 0xFACADE01))  # Write terminator
+        frame.line_nums.__exit__(None, None, None)
+        if frame.fragment_key:
+            fragment_cache.put(frame.fragment_key, _take_fragment(body_data, frame))
+        if frame.dedup_state:
+            _finish_dedup(body_data, frame)
+        # Go back to previous folder(s)
+        for i in range(frame.changed):
+            utils.chdir('..')
+
+
+def _log_frame_error(frame: _Frame):
+    """ Tells where a write error happened, called for each frame from the innermost one """
+    kind = frame.kind
+    if kind == CHUNK_FRAME:
+        logging.error(f'In chunk no. {frame.index}, class "{frame.elem.get("class")}"')
+        logging.error(f'Error @ line {gbx_xml.line_num(frame.current)}')
+    elif kind == LIST_FRAME:
+        logging.error(f'Error @ line {gbx_xml.line_num(frame.current)}')
+    elif kind == LINK_FRAME:
+        logging.error(f'In file \"{frame.file_name}\"')
+        frame.line_nums.__exit__(None, None, None)
+
+
+def write_body_chunks(body_data: BinaryIO, chunks: Iterable[ET.Element], writers: dict = data_types):
+    """
+    Writes the body chunks and all the nodes, chunks and lists inside of them using an explicit
+    stack of _Frames instead of recursion, so they can be nested as deep as needed.
+    Value tags are written by writers (see _PLAN_TYPES)
+    """
+    stack = [_Frame(BODY_FRAME, None, iter(chunks))]
+    try:
+        while stack:
+            frame = stack[-1]
+            child = next(frame.children, None)
+            if child is None:
+                _finish_frame(body_data, frame)
+                stack.pop()
+                continue
+            frame.index += 1
+            kind = frame.kind
+            if kind == CHUNK_FRAME or kind == LIST_FRAME:
+                if kind == CHUNK_FRAME:
+                    frame.current = child
+                else:
+                    frame.current, child = child
+                writer = writers.get(child.tag)
+                if writer:  # Regular value tags (uint32, str, etc.)
+                    writer(body_data, child.text, child.attrib, child)
+                else:
+                    _write_chunk_element(body_data, child, stack)
+            else:  # Body or node, only has chunks
+                _start_chunk(body_data, child, stack)
+    except GBXWriteError:
+        for frame in reversed(stack):
+            _log_frame_error(frame)
+        raise
 
 
-def write_chunk(body_data: BinaryIO, chunk, custom = False):
-    global gbx_reftable
+def reset_compile_state():
+    """ Forgets the node ids and reference table indices given by the previous compile """
+    global node_pool
+    global fragment_log
+    node_counter.set_value(0)
+    node_pool = utils.GlobalNodePool()
+    file_node_ids.clear()
+    file_usefiles.clear()
+    file_dirs.clear()
+    dir_ids.clear()
+    fragment_log = datatypes.lookback_log = None
+    node_keys.clear()
+    deduped_nodes.set_value(0)
+    deduped_bytes.set_value(0)
+
+
+def _skip_data(_file_w: BinaryIO, _value: str, _params: dict, _element: ET.Element = None):
+    pass
+
+
+# Value tags written by the planning pass of _write_body_fragments, only lookback strings
+# and the compatibility level set by <gbxclass> change the state
+_PLAN_TYPES = {tag: _skip_data for tag in data_types}
+_PLAN_TYPES['lookbackstr'] = data_types['lookbackstr']
+_PLAN_TYPES['id'] = data_types['id']
+_PLAN_TYPES['gbxclass'] = data_types['gbxclass']
+
+
+def _reftable_files() -> list:
+    return list(gbx_reftable.iter('file')) if gbx_reftable is not None else []
+
+
+def _save_body_state() -> tuple:
+    """ Returns the node ids and lookback strings given so far, in a form that can be sent to a process """
+    files = _reftable_files()
+    return (int(node_counter),
+            {node_id: node.get('refname') for node_id, node in node_pool.node_pool.items() if node.get('refname')},
+            {i: file_node_ids[file] for i, file in enumerate(files) if file in file_node_ids},
+            {i: file_usefiles[file] for i, file in enumerate(files) if file in file_usefiles},
+            datatypes.lookback.has_been_used,
+            list(datatypes.lookback.lookback_strings),
+            datatypes.gbx_classes.get_comp_lvl())
+
+
+def _load_body_state(state: tuple):
+    node_id, refnames, files_ids, files_usefiles, has_been_used, lookback_strings, comp_lvl = state
+    reset_compile_state()
+    node_counter.set_value(node_id)
+    for node_id, refname in refnames.items():  # Only the refname of the nodes is looked up
+        node_pool.addNode(ET.Element('node', refname=refname), node_id)
+    files = _reftable_files()
+    for i, node_id in files_ids.items():
+        file_node_ids[files[i]] = node_id
+    for i, usefile in files_usefiles.items():
+        file_usefiles[files[i]] = usefile
+    reset_lookback()
+    datatypes.lookback.has_been_used = has_been_used
+    for value in lookback_strings:
+        datatypes.lookback.add(value)
+    datatypes.gbx_classes.set_comp_lvl(comp_lvl)
 
-    chunk_bin = io.BytesIO()
 
-    class_id = chunk.get('class')
-    chunk_id = chunk.get('id')
-    link_ref = chunk.get('link')
+def _init_body_worker():
+    logging.disable(logging.CRITICAL)  # Errors are reported by the serial writer
 
-    if not custom:
-        if class_id[0] == 'C':  # named class
-            full_class_id = f'{gbx_classes.get_dict().get(class_id)[:-3]}{chunk_id}'
-            body_data.write(pack('<I', int(full_class_id, 16)))
-        else:  # not a named class
-            full_class_id = f'{class_id[:-3]}{chunk_id}'
-            body_data.write(pack('<I', int(full_class_id, 16)))
 
-    for i, data_type in enumerate(chunk):  # Iterate over chunks
+def _write_body_fragment(chunk_range: tuple[int, int], state: tuple, directory: str) -> bytes or None:
+    """ Writes some of the body chunks in a worker process, starting from the state given by the planning pass """
+    try:
+        utils.chdir(directory)
+        _load_body_state(state)
+        body_data = io.BytesIO()
+        write_body_chunks(body_data, gbx_body[chunk_range[0]:chunk_range[1]])
+        return body_data.getvalue()
+    except GBXWriteError:
+        return None
+
+
+def _write_body_fragments(jobs: int) -> list[bytes] or None:
+    """
+    Writes the body chunks in jobs processes. A planning pass first gives the node ids and lookback
+    strings in the same order as the serial writer, without writing the other value tags.
+    The chunks are then split in groups, written from the state saved at their start and joined in order.
+    Returns None if the serial writer has to be used, it then reports the errors.
+    """
+    chunk_count = len(gbx_body)
+    group_count = min(chunk_count, jobs * 4)
+    if group_count < 2 or 'fork' not in multiprocessing.get_all_start_methods():
+        return None  # Workers need the parsed tree of this process
+    bounds = [chunk_count * i // group_count for i in range(group_count + 1)]
+    chunk_ranges = list(zip(bounds, bounds[1:]))
+    lookback_stats = (datatypes.lookback.hits, datatypes.lookback.misses)
+    comp_lvl = datatypes.gbx_classes.get_comp_lvl()
+
+    global fragment_cache
+    cache = fragment_cache
+    fragment_cache = None  # Nothing is recorded from the planning pass
+    states = []
+    og_dir = utils.getcwd()
+    disabled_level = logging.root.manager.disable
+    logging.disable(logging.CRITICAL)
+    try:
+        for start, end in chunk_ranges:
+            states.append(_save_body_state())
+            write_body_chunks(io.BytesIO(), gbx_body[start:end], _PLAN_TYPES)
+    except GBXWriteError:
+        states = None
+    finally:
+        fragment_cache = cache
+        logging.disable(disabled_level)
+        utils.chdir(og_dir)
+    if states is None:
+        logging.info('Planning the body failed, it is written by one process')
+    else:
         try:
-            write_chunk_element(chunk_bin, data_type)
-        except GBXWriteError:
-            logging.error(f'In chunk no. {i}, class "{class_id}"')
-            logging.error(f'Error @ line {data_type.get("_line_num")}')
-            raise GBXWriteError
-
-    chunk_bin.seek(0)
-    chunk_bytes = chunk_bin.read()
-
-    if chunk.get('skip'):
-        chunk_size = len(chunk_bytes)
-        body_data.write(b'PIKS')
-        body_data.write(struct.pack('<I', chunk_size))
+            with ProcessPoolExecutor(jobs, multiprocessing.get_context('fork'),
+                                     initializer=_init_body_worker) as pool:
+                fragments = list(pool.map(_write_body_fragment, chunk_ranges, states, repeat(og_dir)))
+            if None not in fragments:
+                return fragments
+            logging.info('Writing a group of body chunks failed, the body is written by one process')
+        except (BrokenProcessPool, PicklingError, OSError) as e:
+            logging.warning(f'The body writer processes failed ({e!r}), the body is written by one process')
 
-    body_data.write(chunk_bytes)
+    reset_lookback()
+    reset_compile_state()
+    datatypes.lookback.hits, datatypes.lookback.misses = lookback_stats
+    datatypes.gbx_classes.set_comp_lvl(comp_lvl)
+    return None
 
 
-def write_body_data() -> bytes:
+def write_body_data(chunks: Iterable[ET.Element] = None, jobs: int = 0) -> bytes:
+    """ Writes the body, from the <body> of the compiled file by default. Jobs are only used for that body """
     reset_lookback()
-    node_counter.set_value(0)
-
+    reset_compile_state()
     body_data = io.BytesIO()
-    for chunk in gbx_body:
-        try:
-            write_chunk(body_data, chunk)
-        except GBXWriteError:
-            raise GBXWriteError
+    # Deduplicated nodes depend on all the nodes written before them
+    fragments = _write_body_fragments(jobs) if jobs and chunks is None and not dedup_nodes else None
+    if fragments is not None:
+        for fragment in fragments:
+            body_data.write(fragment)
+    else:
+        write_body_chunks(body_data, gbx_body if chunks is None else chunks)
 
     body_data.write(pack('<I', 0xFACADE01))  # End of body (end of file)
     node_counter.increment()
@@ -503,34 +890,21 @@ def write_body_data() -> bytes:
     return body_data_bytes
 
 
-def xml_to_gbx(xml_path: str, path: str, gbx: ET.Element):
-    logging.info(f'Compiling file "{path}"...')
+def write_gbx_head(gbx: ET.Element):
+    """ Starts a new gbx file buffer and writes the magic, version, format and main class id """
     global gbx_file
-    global gbx_reftable
-    global gbx_body
-    global file_path_xml
     global version
 
-    file_path_xml = pathlib.Path(xml_path)
-
-    # Create missing directories in output path
-    try:
-        os.makedirs(os.path.dirname(path))
-    except IOError:
-        pass
-
-    if 'complvl' in gbx.attrib:
-        comp_lvl = int(gbx.get('complvl'))
-        gbx_classes.set_comp_lvl(comp_lvl)
-
-    if 'encoding' in gbx.attrib:
-        utils.encoding = gbx.get('encoding')
+    # Not kept from the previous compile
+    gbx_classes.set_comp_lvl(int(gbx.get('complvl', 1)))
+    datatypes.gbx_classes.set_comp_lvl(1)  # Until a <gbxclass complvl="..."> sets it
+    utils.encoding = gbx.get('encoding', 'ascii')
 
     gbx_file = io.BytesIO()  # Make a file buffer before writing to file
     gbx_file.write(b'GBX')
     version = int(gbx.get('version'))
     gbx_file.write(pack('<H', version))
-    gbx_file.write(b'BUU')
+    gbx_file.write(b'BUC' if compress_body else b'BUU')
     if version >= 4:
         gbx_file.write(bytes(gbx.get('unknown'), 'utf-8'))
 
@@ -540,13 +914,104 @@ def xml_to_gbx(xml_path: str, path: str, gbx: ET.Element):
     else:
         gbx_file.write(pack('<i', int(class_id, 16)))
 
-    og_dir = os.path.abspath(os.getcwd())
-    os.chdir(file_path_xml.parent)
+    datatypes.lookback.version = 2 if version <= 5 else 3
+    datatypes.reset_lookback_stats()
+
+
+def write_gbx_tail(body_data: bytes) -> bytes:
+    """ Writes the reference table and the body to the gbx file buffer and returns the whole file """
+    if gbx_reftable:
+        reftable_data = write_ref_table()
+        if not reftable_data:
+            return b''
+        gbx_file.write(pack('<I', int(node_counter)))
+        gbx_file.write(reftable_data)
+    else:  # No ex nodes
+        gbx_file.write(pack('<I', int(node_counter)))
+        gbx_file.write(pack('<I', 0))
+
+    if compress_body:
+        compressed_data = lzo1x.compress(body_data)
+        gbx_file.write(pack('<II', len(body_data), len(compressed_data)))
+        gbx_file.write(compressed_data)
+        logging.info(f'Body: {len(body_data)} bytes, compressed to {len(compressed_data)} bytes')
+    else:
+        gbx_file.write(body_data)
+    logging.info(f'Lookback strings: {datatypes.lookback.hits} hits, {datatypes.lookback.misses} misses')
+    if fragment_cache:
+        fragment_cache.log_stats()
+    if dedup_nodes:
+        logging.info(f'Deduplicated nodes: {int(deduped_nodes)} ({int(deduped_bytes)} bytes)')
+
+    gbx_file.seek(0, 0)
+    return gbx_file.read()
+
+
+def save_gbx(path: str, gbx_data: bytes, sink: sinks.Sink = None):
+    """ Saves the gbx file at path in sink, in the directory of path if None """
+    (sink or sinks.DirectorySink()).write(path, gbx_data)
+
+
+def xml_to_gbx(xml_path: str, path: str, gbx: ET.Element, graph: linkgraph.LinkGraph = None, jobs: int = 0,
+               cache: fragments.FragmentCache = None, dedup: bool = False, compress: bool = False,
+               sink: sinks.Sink = None):
+    """
+    Compiles a validated XML tree to the gbx file at path (saved in sink if given), see compile_gbx
+    """
+    logging.info(f'Compiling file "{path}"...')
+
+    gbx_data = compile_gbx(xml_path, gbx, graph, jobs, cache, dedup, compress)
+    if not gbx_data:
+        return 1
+
+    # No issues, ready to write to file
+
+    save_gbx(path, gbx_data, sink)
+
+    return 0
+
+
+def compile_gbx(xml_path: str, gbx: ET.Element, graph: linkgraph.LinkGraph = None, jobs: int = 0,
+                cache: fragments.FragmentCache = None, dedup: bool = False, compress: bool = False) -> bytes:
+    """
+    Compiles a validated XML tree and returns the gbx file, or b'' if its reference table couldn't be written.
+    Linked files are taken from graph when given.
+    With jobs, the body chunks are written in that many processes.
+    With cache (and graph), compiled linked files are taken from it and added to it. Without it, files
+    linked more than once or with the same content as another one are still compiled once.
+    With dedup, nodes encoded like a previous node are written as a reference to it (without cache and jobs).
+    With compress, the body is compressed
+    """
+    global gbx_reftable
+    global gbx_body
+    global file_path_xml
+    global deferred_refs
+    global link_graph
+    global fragment_cache
+    global dedup_nodes
+    global compress_body
+
+    file_path_xml = pathlib.Path(xml_path)
+    deferred_refs = None
+    link_graph = graph
+    fragment_cache = cache
+    dedup_nodes = dedup
+    compress_body = compress
+    # Only files whose key tells they are written the same way wherever they are linked are spliced,
+    # see LinkGraph.key
+    if cache is None and graph and graph.has_repeats():
+        fragment_cache = fragments.FragmentCache()
+    if dedup:  # A cached file is the same wherever it is linked, a deduplicated node isn't
+        fragment_cache = None
+    datatypes.prefetched_icons = graph.icons if graph else None
+
+    write_gbx_head(gbx)
+
+    og_dir = utils.getcwd()
+    utils.chdir(file_path_xml.parent)
 
     # Write head
-    if int(gbx.get('version')) <= 5:
-        datatypes.lookback.version = 2
-    if int(gbx.get('version')) >= 6:
+    if version >= 6:
         head_tag = gbx.find('head')
         if head_tag:
             try:
@@ -560,32 +1025,200 @@ def xml_to_gbx(xml_path: str, path: str, gbx: ET.Element):
     gbx_reftable = gbx.find('reference_table')
 
     try:
-        body_data = write_body_data()
+        body_data = write_body_data(jobs=jobs)
     except GBXWriteError:
         logging.error(f'In file \"{xml_path}\"')
         raise GBXWriteError
+    if graph:
+        graph.log_savings()
+
+    gbx_data = write_gbx_tail(body_data)
+    if gbx_data:
+        utils.chdir(og_dir)
+    return gbx_data
+
+
+def compile_xml(xml_data: str or bytes, resolver=None, stats: dict = None, name: str = 'input.xml',
+                dedup: bool = False, compress: bool = False) -> bytes:
+    """
+    Validates and compiles XML text (encoded as UTF-8) or bytes and returns the gbx file, without using the disk.
+    The linked files, icons, meshes and list sources are read with resolver: it is called with their path
+    relative to the XML (like "Solids/1.CPlugSolid.xml") and returns their bytes, or None if there is no such file.
+    Without it, the XML can't use other files. The XML is named name in the messages.
+    If stats is given, the size of the file, its number of nodes and linked files and the lookback string hits
+    and misses are set in it.
+    Raises ValidationError or GBXWriteError, the errors are logged.
+    """
+    if isinstance(xml_data, str):
+        xml_data = xml_data.encode('utf-8')
+
+    def read_file(path: str) -> bytes or None:
+        if path == name:
+            return xml_data
+        return resolver(path) if resolver else None
+
+    with utils.use_resolver(read_file):
+        gbx_tree, error = gbx_xml.ParseXml(name)
+        if not gbx_tree:
+            raise ValidationError
+        graph = linkgraph.build_link_graph(name, gbx_tree)
+        gbx_xml.validate_gbx_xml(gbx_tree, name, graph)
+        with gbx_xml.use_line_nums(gbx_tree):
+            gbx_data = compile_gbx(name, gbx_tree.getroot(), graph, dedup=dedup, compress=compress)
+    if not gbx_data:
+        raise GBXWriteError
+    if stats is not None:
+        stats.update(size=len(gbx_data), nodes=int(node_counter), links=len(graph.links) - 1,
+                     lookback_hits=datatypes.lookback.hits, lookback_misses=datatypes.lookback.misses)
+    return gbx_data
 
-    if gbx_reftable:
-        reftable_data = write_ref_table()
-        if not reftable_data:
-            return 1
-        gbx_file.write(pack('<I', int(node_counter)))
-        gbx_file.write(reftable_data)
-    else:  # No ex nodes
-        gbx_file.write(pack('<I', int(node_counter)))
-        gbx_file.write(pack('<I', 0))
-
-    gbx_file.write(body_data)
 
-    gbx_file.seek(0, 0)
-    gbx_data = gbx_file.read()
+def _forget_lines(elem: ET.Element, line_nums: dict):
+    for sub_elem in elem.iter():
+        line_nums.pop(sub_elem, None)
 
-    # No issues, ready to write to file
 
-    os.chdir(og_dir)
-    Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
-    out_file = open(path, 'wb', 0)
-    out_file.write(gbx_data)
-    out_file.close()
+def _stream_body_chunks(events: Iterator[tuple[str, ET.Element]], xml_path: str,
+                        line_nums: dict) -> Iterator[ET.Element]:
+    """ Yields the <body> chunks as soon as they are parsed and validated, then drops them """
+    i = 0
+    depth = 0
+    for event, elem in events:
+        if event == 'start':
+            depth += 1
+            continue
+        if depth == 0:  # </body>
+            return
+        depth -= 1
+        if depth == 0:  # a whole child tag of <body>
+            i += 1
+            link_graph.resolve(elem)
+            gbx_xml.validate_body_chunk(elem, i, xml_path)
+            yield elem
+            _forget_lines(elem, line_nums)
+            elem.clear()
+            gbx_body.remove(elem)
+
+
+def stream_xml_to_gbx(xml_path: str, path: str, threads: int = 0, cache: fragments.FragmentCache = None,
+                      dedup: bool = False, compress: bool = False, sink: sinks.Sink = None) -> int:
+    """
+    Validates and compiles a XML file while it is being parsed, without building the whole tree.
+    Each <body> chunk is written and dropped as soon as it is complete, so only the biggest chunk
+    is kept in memory. The links of each chunk are added to a link graph before it is validated,
+    with threads its linked files and icons are loaded in a thread pool.
+    Compiled linked files are taken from cache and added to it, nodes are deduplicated with dedup
+    and the body is compressed with compress, the file is saved in sink, see xml_to_gbx.
+    """
+    logging.info(f'Compiling file "{path}"...')
+    global gbx_reftable
+    global gbx_body
+    global file_path_xml
+    global deferred_refs
+    global link_graph
+    global fragment_cache
+    global dedup_nodes
+    global compress_body
 
+    file_path_xml = pathlib.Path(xml_path)
+    deferred_refs = None
+    link_graph = linkgraph.LinkGraph(xml_path, threads)
+    fragment_cache = cache or fragments.FragmentCache()  # Links are only known while streaming
+    dedup_nodes = dedup
+    compress_body = compress
+    if dedup:
+        fragment_cache = None
+    gbx_xml.link_graph = link_graph
+    datatypes.prefetched_icons = link_graph.icons
+    gbx_reftable = None
+    gbx_body = None
+    gbx_tag = None
+    head_found = False
+    head_written = False
+    body_data = None
+    depth = 0
+
+    og_dir = utils.getcwd()
+    line_nums = {}
+    xml_file = utils.open_file(xml_path)
+    utils.chdir(file_path_xml.parent)
+    try:
+        events = gbx_xml.iterparse_xml(xml_file, line_nums)
+        with gbx_xml.use_line_nums(line_nums):
+            for event, elem in events:
+                if event == 'start':
+                    depth += 1
+                    if depth == 1:  # <gbx>, attributes are already parsed
+                        gbx_tag = elem
+                        gbx_xml.validate_gbx_tag(gbx_tag, xml_path)
+                        write_gbx_head(gbx_tag)
+                    elif depth == 2 and elem.tag == 'body':
+                        if body_data is not None:
+                            logging.error('XML Error: <gbx> tag must have one and only one <body> child tag!')
+                            raise ValidationError
+                        gbx_body = elem
+                        if gbx_reftable is None:  # Node ids of the reference table are set later
+                            deferred_refs = {}
+                        try:
+                            body_data = write_body_data(_stream_body_chunks(events, xml_path, line_nums))
+                        except GBXWriteError:
+                            logging.error(f'In file \"{xml_path}\"')
+                            raise GBXWriteError
+                        depth -= 1
+                    continue
+
+                depth -= 1
+                if depth != 1:
+                    continue
+                if elem.tag == 'body':
+                    continue
+                elif elem.tag == 'reference_table':
+                    if gbx_reftable is not None:
+                        logging.error('XML Error: <gbx> tag must have only one <reference_table> child tag!')
+                        raise ValidationError
+                    if elem:
+                        gbx_xml.validate_reference_table(elem, xml_path)
+                    gbx_reftable = elem
+                elif elem.tag == 'head':
+                    if head_found:
+                        logging.error('XML Error: <gbx> tag must have only one <head> child tag!')
+                        raise ValidationError
+                    head_found = True
+                    if elem:
+                        gbx_xml.validate_head(elem, xml_path)
+                    if version >= 6 and elem:
+                        # The head can come after the body, keep the lookback strings of the body
+                        datatypes.push_lookback_scope()
+                        write_head_data(elem)
+                        datatypes.pop_lookback_scope()
+                        head_written = True
+                    _forget_lines(elem, line_nums)
+                    gbx_tag.remove(elem)
+                else:
+                    _forget_lines(elem, line_nums)
+                    gbx_tag.remove(elem)
+    except ET.ParseError as e:
+        logging.error(f'Failed to parse XML file! (code: {e.code}, pos: {e.position})')
+        raise ValidationError
+    finally:
+        xml_file.close()
+        gbx_xml.link_graph = None
+
+    if body_data is None:
+        logging.error('XML Error: <gbx> tag must have one and only one <body> child tag!')
+        raise ValidationError
+    if deferred_refs is not None:
+        resolve_deferred_refs()
+    link_graph.log_stats()
+    link_graph.log_savings()
+
+    if version >= 6 and not head_written:
+        gbx_file.write(pack('<I', 0))  # Head size = 0
+
+    gbx_data = write_gbx_tail(body_data)
+    if not gbx_data:
+        return 1
+
+    utils.chdir(og_dir)
+    save_gbx(path, gbx_data, sink)
     return 0
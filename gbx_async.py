@@ -0,0 +1,163 @@
+"""
+Asyncio compile API, for services compiling many files from an event loop.
+The XML files, their linked files, icons, meshes and list sources are read in threads, then the compile
+(with the encoding of the icons and lists) runs in an executor, so the event loop never waits for them.
+At most max_concurrency compiles run at once and max_queue more wait for their turn, the others are refused.
+"""
+import asyncio
+import logging
+import os
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import Executor
+
+import gbx
+import meshdata
+from gbxerrors import ValidationError, QueueFullError
+
+_compile_lock = threading.Lock()  # The compiler state is global, the compiles of a process take turns
+
+
+def _compile(xml_data: bytes, files: dict, name: str, dedup: bool, compress: bool) -> tuple[bytes, dict]:
+    """ Runs in the executor, returns the gbx file and its stats """
+    stats = {}
+    with _compile_lock:
+        gbx_data = gbx.compile_xml(xml_data, files.get, stats, name, dedup, compress)
+    return gbx_data, stats
+
+
+def _find_files(data: bytes, path: str) -> tuple[list[str], list[str]]:
+    """
+    Returns the absolute paths of the XML files linked from the XML file at path, and of the other files
+    it uses. A file that can't be parsed uses nothing, its error is reported by the compile.
+    """
+    try:
+        root = ET.fromstring(data)
+    except ET.ParseError:
+        return [], []
+    xml_files = []
+    data_files = []
+    for elem in root.iter():
+        if (elem.tag == 'node' or elem.tag == 'nod') and elem.get('link') and 'custom' not in elem.attrib:
+            xml_files.append(elem.get('link'))
+        elif elem.tag == 'icon' and elem.get('link'):
+            data_files.append(elem.get('link'))
+        elif elem.tag == 'list' and elem.get('source'):
+            data_files.append(elem.get('source'))
+        elif elem.tag == 'mesh':
+            data_files += [elem.get(attr) for attr in ('source',) + meshdata.MESH_FIELDS if elem.get(attr)]
+    directory = os.path.dirname(path)
+    return ([os.path.normpath(os.path.join(directory, link)) for link in xml_files],
+            [os.path.normpath(os.path.join(directory, link)) for link in data_files])
+
+
+def _load_file(path: str, is_xml: bool) -> tuple[bytes or None, list[str], list[str]]:
+    """ Runs in a thread, returns the bytes of the file (None if it can't be read) and the files it uses """
+    try:
+        with open(path, 'rb') as in_file:
+            data = in_file.read()
+    except OSError:
+        return None, [], []
+    if not is_xml:
+        return data, [], []
+    return (data,) + _find_files(data, path)
+
+
+async def read_xml_files(xml_path: str) -> tuple[str, dict]:
+    """
+    Reads a XML file and all the files it uses without blocking the event loop, each level of linked files at once.
+    Returns the name of the XML file and a dict of all the files by name, names are relative to the directory
+    holding all of them. The missing files aren't in it, the compile reports them.
+    """
+    xml_path = os.path.abspath(xml_path)
+    files = {}
+    seen = {xml_path}
+    pending = [(xml_path, True)]
+    while pending:
+        results = await asyncio.gather(*(asyncio.to_thread(_load_file, path, is_xml) for path, is_xml in pending))
+        next_pending = []
+        for (path, is_xml), (data, xml_files, data_files) in zip(pending, results):
+            if data is not None:
+                files[path] = data
+            for file_path, file_is_xml in [(p, True) for p in xml_files] + [(p, False) for p in data_files]:
+                if file_path not in seen:
+                    seen.add(file_path)
+                    next_pending.append((file_path, file_is_xml))
+        pending = next_pending
+    # Links above the XML file stay inside the directory the names are relative to
+    base_dir = os.path.commonpath([os.path.dirname(path) for path in seen])
+    names = {path: os.path.relpath(path, base_dir).replace(os.sep, '/') for path in files}
+    return names.get(xml_path, os.path.basename(xml_path)), {names[path]: data for path, data in files.items()}
+
+
+class AsyncCompiler:
+    """
+    Compiles from an event loop. The compiles run in executor, the event loop's default thread pool if None.
+    With threads the compiles take turns (reading the files of the next ones meanwhile), a ProcessPoolExecutor
+    runs max_concurrency of them at the same time.
+    """
+    def __init__(self, executor: Executor = None, max_concurrency: int = 0, max_queue: int = 100):
+        self.executor = executor
+        self.max_queue = max_queue
+        self.waiting = 0
+        self.compiled = 0
+        self.failed = 0
+        self.refused = 0
+        self._slots = asyncio.Semaphore(max_concurrency or os.cpu_count() or 1)
+
+    async def _run(self, xml_data: bytes, files: dict, name: str, stats: dict or None, dedup: bool,
+                   compress: bool, gbx_path: str = None) -> bytes:
+        loop = asyncio.get_running_loop()
+        try:
+            gbx_data, compile_stats = await loop.run_in_executor(self.executor, _compile, xml_data, files, name,
+                                                                 dedup, compress)
+            if gbx_path:
+                await asyncio.to_thread(gbx.save_gbx, gbx_path, gbx_data)
+        except BaseException:
+            self.failed += 1
+            raise
+        self.compiled += 1
+        if stats is not None:
+            stats.update(compile_stats)
+        return gbx_data
+
+    async def _take_slot(self):
+        """ Waits for a free compile slot, raises QueueFullError if max_queue compiles are already waiting """
+        if self._slots.locked() and self.waiting >= self.max_queue:
+            self.refused += 1
+            logging.error(f'Error: {self.waiting} compiles are already waiting, compile refused!')
+            raise QueueFullError
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+    async def compile_xml(self, xml_data: str or bytes, files: dict = None, stats: dict = None,
+                          name: str = 'input.xml', dedup: bool = False, compress: bool = False) -> bytes:
+        """
+        Compiles XML text or bytes like gbx.compile_xml, its linked files, icons, meshes and list sources
+        are taken from files (their bytes by path relative to the XML).
+        """
+        if isinstance(xml_data, str):
+            xml_data = xml_data.encode('utf-8')
+        await self._take_slot()
+        try:
+            return await self._run(xml_data, files or {}, name, stats, dedup, compress)
+        finally:
+            self._slots.release()
+
+    async def compile_file(self, xml_path: str, gbx_path: str = None, stats: dict = None,
+                           dedup: bool = False, compress: bool = False) -> bytes:
+        """ Compiles the XML file at xml_path, saves it to gbx_path if given and returns it """
+        await self._take_slot()
+        try:
+            name, files = await read_xml_files(xml_path)
+            if name not in files:
+                self.failed += 1
+                logging.error(f'Error: failed to read XML file "{xml_path}"!')
+                raise ValidationError
+            xml_data = files.pop(name)
+            return await self._run(xml_data, files, name, stats, dedup, compress, gbx_path)
+        finally:
+            self._slots.release()
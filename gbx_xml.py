@@ -1,11 +1,20 @@
+import contextlib
+import gc
+import hashlib
 import os
+import sys
+import threading
+import csvdata
 from datatypes import data_types
 from gbxclasses import GBXClasses
 import utils
 import pathlib
 import logging
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from gbxerrors import ValidationError
 import xml.etree.ElementTree as ET
+from xml.parsers import expat
+from typing import BinaryIO, Generator, Iterator
 
 
 REQUIRED_ATTRIB_LIST: list = ['version', 'unknown', 'class']
@@ -15,47 +24,158 @@ reference_table: ET.Element
 body: ET.Element
 gbx: ET.ElementTree
 file_path_xml: pathlib.Path
+link_graph = None  # linkgraph.LinkGraph of the file being validated, if any
+# Linked files validated apart by validate_links, path -> None or the error that stopped it
+link_results: dict = None
+link_records: dict = None  # path -> log records of its validation, see _log_link
+_worker_records: list = None  # Log records of the file being validated in a worker process
+tree_cache = None  # treecache.TreeCache parsed files are taken from and added to, only used on the disk
+revalidate = False  # Validate the files again even if tree_cache holds their validation
+# Modules the validation result depends on, see validator_version
+VALIDATOR_MODULES = ('gbx_xml', 'gbxclasses', 'datatypes', 'csvdata', 'meshdata', 'linkgraph', 'utils')
+_validator_version = None
+_gc_lock = threading.Lock()  # The prefetch threads parse files at the same time, see _pause_gc
+_gc_pauses = 0  # Parses running with the collector disabled
+_gc_was_enabled = False
+
+
+# Size of the blocks fed to the XML parser
+PARSE_BLOCK_SIZE: int = 1 << 16
+# Trees (or line number tables) being validated/written, innermost (linked) file last
+_line_tables: list = []
+
+
+class GbxTree(ET.ElementTree):
+    """
+    ElementTree of a parsed XML file. Line numbers are only needed for error messages, so they are
+    recovered by parsing the file again the first time "line_nums" is used
+    """
+    def __init__(self, element: ET.Element, path: str, line_nums: dict = None):
+        super().__init__(element)
+        self.path = path
+        self._line_nums = line_nums
 
+    @property
+    def line_nums(self) -> dict:
+        if self._line_nums is None:
+            self._line_nums = _recover_line_nums(self.getroot(), self.path)
+        return self._line_nums
 
-class XmlLineReader:
-    def __init__(self, xml_file) -> None:
-        self._iter = iter(xml_file)
-        self._current_line = -1
 
-    @property
-    def line(self):
-        return self._current_line
+def _create_parser() -> expat.XMLParserType:
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    return parser
 
-    def read(self, *_):
-        try:
-            self._current_line += 1
-            return next(self._iter)
-        except:
-            return None
+
+def _parse_error(e: expat.ExpatError) -> ET.ParseError:
+    """ Converts an expat error to the ET.ParseError ET.parse would raise """
+    err = ET.ParseError(str(e))
+    err.code = e.code
+    err.position = e.lineno, e.offset
+    return err
+
+
+def _parse_line_nums(path: str) -> list[int]:
+    """ Returns the line number of each element of a XML file in document order, without building a tree """
+    lines = []
+    parser = expat.ParserCreate()
+
+    def start(_tag, _attrib, _add_line=lines.append, _p=parser):
+        _add_line(_p.CurrentLineNumber)
+
+    parser.StartElementHandler = start
+    with utils.open_file(path) as xml_file:
+        parser.ParseFile(xml_file)
+    return lines
 
 
-def ParseXml(path: str) -> tuple[ET.ElementTree or None, str]:
+def _recover_line_nums(root: ET.Element, path: str) -> dict:
+    logging.info(f'Recovering line numbers of "{path}"')
+    try:
+        lines = _parse_line_nums(path)
+    except (OSError, expat.ExpatError):
+        return {}
+    elements = list(root.iter())
+    if len(elements) != len(lines):  # File has changed since
+        return {}
+    return dict(zip(elements, lines))
+
+
+@contextlib.contextmanager
+def _pause_gc():
+    """
+    Disables the cyclic garbage collector while parsing, new elements don't form reference cycles so there
+    is no need to rescan them. It is enabled again (if it was) when the parses of all the threads are done
+    """
+    global _gc_pauses
+    global _gc_was_enabled
+    with _gc_lock:
+        if _gc_pauses == 0:
+            _gc_was_enabled = gc.isenabled()
+            gc.disable()
+        _gc_pauses += 1
+    try:
+        yield
+    finally:
+        with _gc_lock:
+            _gc_pauses -= 1
+            if _gc_pauses == 0 and _gc_was_enabled:
+                gc.enable()
+
+
+def ParseXml(path: str, log_errors: bool = True) -> tuple[GbxTree or None, str]:
     """
-    Parses XML file and automatically assigns a line number to each element using "_line_num" attribute
+    Parses XML file without tracking positions, line numbers are recovered on errors (see line_num).
+    With tree_cache, a file that didn't change since it was parsed is loaded from it
     """
-    gbx_tree: ET.ElementTree
-    gbx_elem: ET.Element = None
-    og_cwd = os.getcwd()
-    gbx_io = XmlLineReader(open(path, 'r'))
+    cache = tree_cache if utils.resolver is None else None
     try:
-        for _, elem in ET.iterparse(gbx_io, ['start']):
-            elem: ET.Element
-            elem.set('_line_num', str(gbx_io.line + 1))
-            if gbx_elem is None:  # set first element to be the tree
-                gbx_elem = elem
-        gbx_tree = ET.ElementTree(gbx_elem)
+        with _pause_gc():
+            root = cache.get(path) if cache else None
+            if root is not None:
+                return GbxTree(root, utils.abspath(path)), ""
+            with utils.open_file(path) as xml_file:
+                if cache is None:
+                    gbx_tree = GbxTree(ET.parse(xml_file).getroot(), utils.abspath(path))
+                else:
+                    data = xml_file.read()
+                    gbx_tree = GbxTree(ET.fromstring(data), utils.abspath(path))
+                    cache.put(path, hashlib.sha256(data).hexdigest(), gbx_tree.getroot())
     except ET.ParseError as e:
-        logging.error(f'Failed to parse XML file! (code: {e.code}, pos: {e.position})')
+        if log_errors:
+            logging.error(f'Failed to parse XML file! (code: {e.code}, pos: {e.position})')
         return None, f'Failed to parse XML file! (code: {e.code}, pos: {e.position})'
-    os.chdir(og_cwd)
     return gbx_tree, ""
 
 
+def line_num(element: ET.Element) -> int or None:
+    """
+    Returns the line number of an element of a tree in use (see use_line_nums), None if unknown
+    """
+    for entry in reversed(_line_tables):
+        line_nums = entry.line_nums if isinstance(entry, GbxTree) else entry
+        line = line_nums.get(element)
+        if line is not None:
+            return line
+    return None
+
+
+@contextlib.contextmanager
+def use_line_nums(gbx_tree: ET.ElementTree or dict):
+    """
+    Makes line_num find the elements of a tree parsed by ParseXml (or of a line number table)
+    """
+    if not isinstance(gbx_tree, (GbxTree, dict)):
+        yield
+        return
+    _line_tables.append(gbx_tree)
+    try:
+        yield
+    finally:
+        _line_tables.pop()
+
+
 def _validate_class_id(class_id: str):
     if len(class_id) != 8:  # Class id must be 4 bytes (8 hex characters)
         logging.error(f'XML Error: "class" attribute ("{class_id}") must be 8 characters long!')
@@ -113,12 +233,12 @@ def _validate_head_chunk(chunk: ET.Element):
         i += 1
         if tag.tag == 'node' or tag.tag == 'nod' or tag.tag == 'fid':
             logging.error(f'XML Error: a head <chunk> cannot contain any <node>s or <fid>s!\n'
-                          f'(tag no. {i}, class "{class_id}", chunk "{chunk_id}") @ line {tag.get("_line_num")}')
+                          f'(tag no. {i}, class "{class_id}", chunk "{chunk_id}") @ line {line_num(tag)}')
             raise ValidationError
         if tag.tag not in data_types:
             if tag.tag != 'list':  # HAXXXX
                 logging.error(f'XML Error: unknown data type tag <{tag.tag}>!\n'
-                              f'(tag no. {i}, class "{class_id}", chunk "{chunk_id}") @ line {tag.get("_line_num")}')
+                              f'(tag no. {i}, class "{class_id}", chunk "{chunk_id}") @ line {line_num(tag)}')
                 raise ValidationError
 
 
@@ -163,13 +283,37 @@ def _validate_ref_table_entry(entry: ET.Element):
                 _validate_ref_table_entry(directory)
             except ValidationError:
                 name = entry.get('name')
-                logging.error(f'In {name} @ line {directory.get("_line_num")}')
+                logging.error(f'In {name} @ line {line_num(directory)}')
                 raise ValidationError
     else:
         logging.error(f'XML Error: unknown <{entry.tag}> tag in reference table!')
         raise ValidationError
 
 
+def _run_validation(validator: Generator):
+    """
+    Runs a validator and the validators of the child tags it yields with a stack instead of recursion,
+    so tags can be nested as deep as needed. A ValidationError of a child is raised in its parent at the yield,
+    which logs where it happened like a recursive call would.
+    """
+    stack = [validator]
+    error = None
+    while stack:
+        thrown, error = error, None
+        try:
+            child = next(stack[-1]) if thrown is None else stack[-1].throw(thrown)
+        except StopIteration:
+            stack.pop()
+            continue
+        except ValidationError as e:
+            stack.pop()
+            if not stack:
+                raise
+            error = e
+            continue
+        stack.append(child)
+
+
 def _validate_node(node: ET.Element):
     logging.info(f'Validating <{node.tag} {node.attrib}>')
     global reference_table
@@ -187,16 +331,27 @@ def _validate_node(node: ET.Element):
             changed += 1
 
         if len(link_dir.parents) > 0:
-            os.chdir(link_dir)
+            utils.chdir(link_dir)
 
         file_name = full_path.name
+        link_path = utils.abspath(file_name)
+        if link_graph and link_graph.is_validated(link_path):  # Already linked and validated before
+            if link_path not in link_graph.validated:  # Same content as a validated file
+                link_graph.saved['validations'] += 1
+            for i in range(changed):
+                utils.chdir('..')
+            return
         try:
-            f = open(file_name, 'r')
-            f.close()
+            utils.open_file(file_name).close()
         except IOError:
             logging.error(f'XML Error: Linking error! File "{node.get("link")}" does not exist!')
             raise ValidationError
-        link_xml_res = ParseXml(file_name)
+        if link_graph and link_path in link_graph.parsed:
+            link_xml_res = link_graph.parsed[link_path]
+            if not link_xml_res[0]:
+                logging.error(link_xml_res[1])  # Like ParseXml does
+        else:
+            link_xml_res = ParseXml(file_name)
         link_xml = link_xml_res[0]
         if not link_xml:
             logging.error(f'XML Error: Linking error! In file "{full_path}"!')
@@ -204,16 +359,24 @@ def _validate_node(node: ET.Element):
             raise ValidationError
         # XML Parsed
         try:
-            validate_gbx_xml(link_xml, str(file_name))
+            if link_results is not None and link_path in link_results:  # Validated apart by validate_links
+                _log_link(link_path)
+                if link_results[link_path]:
+                    raise link_results[link_path]
+            else:
+                with use_line_nums(link_xml):
+                    _validate_gbx_xml(link_xml, str(file_name))
         except ValidationError:
             logging.error(f'XML Error: Linking error! In file "{full_path}"!')
             raise ValidationError
         except RecursionError:
             logging.error(f'XML Error: Infinite recursion detected! In file "{full_path}"!')
             raise ValidationError
-        
+        if link_graph:
+            link_graph.set_validated(link_path)
+
         for i in range(changed):
-            os.chdir('..')
+            utils.chdir('..')
         return
     if 'headless' not in node.attrib:
         if 'class' in node.attrib:
@@ -240,7 +403,7 @@ def _validate_node(node: ET.Element):
                                   f'In <node> no. {i} "{class_id}"')
                     raise ValidationError
                 try:
-                    _validate_chunk(chunk)
+                    yield _validate_chunk(chunk)
                 except ValidationError:
                     logging.error(f'In <node> no. {i} "{class_id}"')
                     raise ValidationError
@@ -254,7 +417,7 @@ def _validate_node(node: ET.Element):
                               f'In <node> no. {i}')
                 raise ValidationError
             try:
-                _validate_chunk(chunk)
+                yield _validate_chunk(chunk)
             except ValidationError:
                 logging.error(f'In <node> no. {i}')
                 raise ValidationError
@@ -269,44 +432,72 @@ def _validate_fid(fid: ET.Element):
     logging.info('<fid> valid')
 
 
-def _validate_chunk_element(element: ET.Element):
-    if element.tag == 'chunk':
-        logging.error('XML Error: <chunk> tag cannot contain <chunk> child tags!')
+def _validate_list_source(lst: ET.Element):
+    source = lst.get('source')
+    if len(lst) > 0:
+        logging.error(f'XML Error: <list> with a "source" attribute cannot contain child tags!'
+                      f'@ line {line_num(lst)}')
+        raise ValidationError
+    if 'schema' not in lst.attrib:
+        logging.error(f'XML Error: missing required "schema" attribute in <list source="{source}">!'
+                      f'@ line {line_num(lst)}')
+        raise ValidationError
+    try:
+        csvdata.parse_schema(lst.get('schema'))
+    except ValueError as e:
+        logging.error(f'XML Error: unsupported data type "{e}" in <list> schema!'
+                      f'@ line {line_num(lst)}')
+        raise ValidationError
+    if not utils.isfile(source):
+        logging.error(f'XML Error: list source file "{source}" does not exist!'
+                      f'@ line {line_num(lst)}')
         raise ValidationError
 
-    if element.tag == 'node' or element.tag == 'nod':
+
+def _validate_list(lst: ET.Element):
+    i = 0
+    logging.info(f'Validating <list>')
+    if 'source' in lst.attrib:
         try:
-            _validate_node(element)
+            _validate_list_source(lst)
         except ValidationError:
             raise ValidationError
+    for element in lst:
+        i += 1
+        if element.tag != 'element':
+            logging.error('XML Error: <list> must only contain <element> child tags!'
+                          f'In <element> no {i} @ line {line_num(element)}')
+            raise ValidationError
+        for sub_element in element:
+            if sub_element.tag == 'chunk':
+                logging.error(f'XML Error: <element> tag cannot contain <chunk> child tags!'
+                              f'In <element> no {i} @ line {line_num(sub_element)}')
+                raise ValidationError
+            validator = _validate_chunk_element(sub_element)
+            if validator:
+                yield validator
+    logging.info('<list> valid')
+
+
+def _validate_chunk_element(element: ET.Element) -> Generator or None:
+    """ Validates a tag of a chunk, returns the validator of its child tags for _run_validation if it has some """
+    if element.tag == 'chunk':
+        logging.error('XML Error: <chunk> tag cannot contain <chunk> child tags!')
+        raise ValidationError
+
+    if element.tag == 'node' or element.tag == 'nod':
+        return _validate_node(element)
     elif element.tag == 'fid':
         try:
             _validate_fid(element)
         except ValidationError:
             raise ValidationError
     elif element.tag == 'list':
-        i = 0
-        logging.info(f'Validating <list>')
-        for element in element:
-            i += 1
-            if element.tag != 'element':
-                logging.error('XML Error: <list> must only contain <element> child tags!'
-                              f'In <element> no {i} @ line {element.get("_line_num")}')
-                raise ValidationError
-            for sub_element in element:
-                if sub_element.tag == 'chunk':
-                    logging.error(f'XML Error: <element> tag cannot contain <chunk> child tags!'
-                                  f'In <element> no {i} @ line {sub_element.get("_line_num")}')
-                    raise ValidationError
-                try:
-                    _validate_chunk_element(sub_element)
-                except ValidationError:
-                    raise ValidationError
-        logging.info('<list> valid')
+        return _validate_list(element)
     else:
         if element.tag not in data_types:
             logging.error(f'XML Error: unknown tag <{element.tag}>!'
-                          f'@ line {element.get("_line_num")}')
+                          f'@ line {line_num(element)}')
             raise ValidationError
 
 
@@ -319,14 +510,14 @@ def _validate_chunk(chunk: ET.Element):
     class_id = chunk.get('class')
     if 'id' not in chunk.attrib:
         logging.error(f'XML Error: missing required "id" attribute in <chunk> tag!'
-                      f'@ line {chunk.get("_line_num")}')
+                      f'@ line {line_num(chunk)}')
         raise ValidationError
 
     chunk_id = chunk.get('id')
     if class_id[0] == 'C':  # Is a named class
         if class_id not in gbx_classes.get_dict():
             logging.error(f'XML Error: "class" attribute ("{class_id}") not found in GBX class dictionary!'
-                          f'Please use hex value instead. @ line {chunk.get("_line_num")}')
+                          f'Please use hex value instead. @ line {line_num(chunk)}')
             raise ValidationError
     else:  # Not a named class (hex value)
         try:
@@ -341,23 +532,244 @@ def _validate_chunk(chunk: ET.Element):
     # Validate chunk elements
     for tag in chunk:
         try:
-            _validate_chunk_element(tag)
+            validator = _validate_chunk_element(tag)
+            if validator:
+                yield validator
         except ValidationError:
             logging.error(f'In <chunk> class "{class_id}", id "{chunk_id}"'
-                          f'@ line {tag.get("_line_num")}')
+                          f'@ line {line_num(tag)}')
             raise ValidationError
     logging.info('<chunk> valid')
 
 
-def validate_gbx_xml(gbx_xml: ET.ElementTree, file_path: str):
+def iterparse_xml(xml_file: BinaryIO, line_nums: dict) -> Iterator[tuple[str, ET.Element]]:
+    """
+    Yields the "start" and "end" events of an opened binary XML file, parsing it in big blocks.
+    The line number of each element goes to line_nums like ParseXml does. Raises ET.ParseError.
+    """
+    events = []
+    builder = ET.TreeBuilder()
+    parser = _create_parser()
+
+    def start(tag, attrib, _start=builder.start, _add=events.append, _lines=line_nums, _p=parser):
+        elem = _start(tag, attrib)
+        _lines[elem] = _p.CurrentLineNumber
+        _add(('start', elem))
+
+    def end(tag, _end=builder.end, _add=events.append):
+        _add(('end', _end(tag)))
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = builder.data
+    while True:
+        block = xml_file.read(PARSE_BLOCK_SIZE)
+        try:
+            parser.Parse(block, not block)
+        except expat.ExpatError as e:
+            yield from events  # Tags before the error are still handled, like with line by line parsing
+            raise _parse_error(e)
+        yield from events
+        events.clear()
+        if not block:
+            return
+
+
+def validate_gbx_tag(gbx_tag: ET.Element, file_path: str):
+    if gbx_tag.tag != 'gbx':
+        logging.error('XML Error: the xml file does not contain the <gbx> root tag!')
+        raise ValidationError
+
+    for req_attrib in REQUIRED_ATTRIB_LIST:
+        if req_attrib not in gbx_tag.attrib:
+            logging.error(f'XML Error: missing required "{req_attrib}" attribute in <gbx> tag!\n'
+                          f'In {file_path} @ line {line_num(gbx_tag)}')
+            raise ValidationError
+
+    encoding = gbx_tag.get('encoding')
+    if not encoding:
+        logging.info(f'XML Info for \"{file_path}\": missing \"encoding\" attribute. Using \"ascii\" as default...')
+    else:
+        if encoding != 'ascii' and encoding != 'cp1251':
+            logging.error(f'XML Error: \"encoding\" attribute can only be either \"ascii\" or \"cp1251\"')
+            raise ValidationError
+
+
+def validate_reference_table(ref_tag: ET.Element, file_path: str):
+    global reference_table
+    if 'ancestor' not in ref_tag.attrib:
+        logging.error(f'XML Error: missing required "ancestor" attribute in <reference_table>!'
+                      f'In {file_path} @ line {line_num(ref_tag)}')
+        raise ValidationError
+
+    i = 0
+    for entry in ref_tag:
+        i += 1
+        try:
+            _validate_ref_table_entry(entry)
+        except ValidationError:
+            logging.error(f'Error in entry no. {i} in <reference_table>'
+                          f'In {file_path} @ line {line_num(entry)}')
+            raise ValidationError
+    reference_table = ref_tag
+
+
+def validate_head(head_tag: ET.Element, file_path: str):
+    i = 0
+    for chunk in head_tag:
+        i += 1
+        try:
+            _validate_head_chunk(chunk)
+        except ValidationError:
+            logging.error(f'Error in chunk no. {i} in <head>'
+                          f'In {file_path} @ line {line_num(chunk)}')
+            raise ValidationError
+
+
+def validate_body_chunk(chunk: ET.Element, i: int, file_path: str):
+    """
+    Validates the i-th (counting from 1) child tag of <body>
+    """
+    if chunk.tag != 'chunk':
+        logging.error(f'XML Error: <body> tag must only contain <chunk> child tags! (element no. {i})'
+                      f'In {file_path} @ line {line_num(chunk)}')
+        raise ValidationError
+
+    try:
+        _run_validation(_validate_chunk(chunk))
+    except ValidationError:
+        logging.error(f'In {file_path} @ line {line_num(chunk)}')
+        raise ValidationError
+
+
+class _KeepRecords(logging.Handler):
+    """ Keeps the log records of a worker process, they are logged by the main process """
+    def emit(self, record: logging.LogRecord):
+        _worker_records.append(record)
+
+
+def _init_link_worker(level: int):
+    root_logger = logging.getLogger()
+    root_logger.handlers = [_KeepRecords()]
+    root_logger.setLevel(level)
+
+
+def _validate_link_apart(path: str, results: dict) -> tuple[type or None, list]:
+    """
+    Validates a linked file in a worker process. Its own links must be in results,
+    they are noted in the records instead of being validated again.
+    """
+    global link_results
+    global _worker_records
+    link_results = results
+    _worker_records = []
+    if link_graph:
+        link_graph.validated = set()  # Nothing is skipped, the main process logs the records of every link
+    link_xml = link_graph.tree(path) if link_graph else None
+    if link_xml is None:  # Not inherited from the main process
+        link_xml = ParseXml(path)[0]
+    utils.chdir(os.path.dirname(path))
+    try:
+        with use_line_nums(link_xml):
+            _validate_gbx_xml(link_xml, os.path.basename(path))
+    except (ValidationError, RecursionError) as e:
+        return type(e), _worker_records
+    return None, _worker_records
+
+
+def _log_link(path: str):
+    """ Logs the records of a file validated apart, where it would have been validated """
+    if _worker_records is not None:  # In a worker, the main process logs them
+        _worker_records.append(path)
+        return
+    if link_graph.is_validated(path):  # Linked before, like in _validate_node
+        if path not in link_graph.validated:
+            link_graph.saved['validations'] += 1
+        return
+    root_logger = logging.getLogger()
+    for record in link_records[path]:
+        if isinstance(record, str):  # A file linked from this one
+            _log_link(record)
+        elif root_logger.isEnabledFor(record.levelno):
+            root_logger.handle(record)
+    if not link_results[path]:
+        link_graph.set_validated(path)
+
+
+def validate_links(graph, workers: int):
+    """
+    Validates all the files linked from the root file of graph (a linkgraph.LinkGraph) in a pool of
+    worker processes, each file after the files it links to. Their log records are kept and logged
+    by validate_gbx_xml in source order, so errors are reported like in a single process.
+    """
+    global link_results
+    global link_records
+    link_results = {}
+    link_records = {}
+    paths = {path for path in graph.links if path != graph.root_path and not graph.is_validated(path)}
+    waiting = {path: paths.intersection(graph.links[path]) for path in paths}
+    running = {}
+    with ProcessPoolExecutor(workers, initializer=_init_link_worker,
+                             initargs=(logging.getLogger().getEffectiveLevel(),)) as pool:
+        while waiting or running:
+            for path in [path for path, linked in waiting.items() if linked.issubset(link_results)]:
+                del waiting[path]
+                results = {link_path: link_results[link_path]
+                           for link_path in graph.links[path] if link_path in link_results}
+                running[pool.submit(_validate_link_apart, path, results)] = path
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = running.pop(future)
+                link_results[path], link_records[path] = future.result()
+
+
+def validator_version() -> str:
+    """ Returns a hash of the code of the validator, validations cached by another version aren't used """
+    global _validator_version
+    if _validator_version is None:
+        version_hash = hashlib.sha256()
+        for name in VALIDATOR_MODULES:
+            try:
+                with open(sys.modules[name].__file__, 'rb') as module_file:
+                    version_hash.update(module_file.read())
+            except (KeyError, AttributeError, OSError):  # Not loaded, or no source (frozen)
+                version_hash.update(name.encode())
+        _validator_version = version_hash.hexdigest()
+    return _validator_version
+
+
+def validate_gbx_xml(gbx_xml: ET.ElementTree, file_path: str, graph=None, workers: int = 0):
     """
     Validates the GBX XML file. If an error occurred, 1 is returned.
     Otherwise, returns 0.
 
     :param gbx_xml: ET.ElementTree
     :param file_path: str
+    :param graph: linkgraph.LinkGraph of the file, linked files are then parsed and validated only once
+    :param workers: number of processes validating the linked files of graph at the same time
     :return:
     """
+    global link_graph
+    global link_results
+    global link_records
+    link_graph = graph
+    if graph and graph.is_validated(graph.root_path):  # The file and its linked files didn't change
+        logging.info(f'XML file "{file_path}" is unchanged since it was validated')
+        graph.saved['validations'] += 1
+        return
+    try:
+        if graph and workers:
+            validate_links(graph, workers)
+        with use_line_nums(gbx_xml):
+            _validate_gbx_xml(gbx_xml, file_path)
+        if graph:
+            graph.set_validated(graph.root_path)
+    finally:
+        link_results = None
+        link_records = None
+
+
+def _validate_gbx_xml(gbx_xml: ET.ElementTree, file_path: str):
     logging.info(f'Validating XML file "{file_path}"')
     global reference_table
     global body
@@ -366,27 +778,11 @@ def validate_gbx_xml(gbx_xml: ET.ElementTree, file_path: str):
     file_path_x = pathlib.Path(file_path)
     gbx = gbx_xml
 
-    og_dir = os.getcwd()
-    os.chdir(file_path_x.parent)
+    og_dir = utils.getcwd()
+    utils.chdir(file_path_x.parent)
 
     gbx_tag = gbx_xml.getroot()
-    if gbx_tag and gbx_tag.tag != 'gbx':
-        logging.error('XML Error: the xml file does not contain the <gbx> root tag!')
-        raise ValidationError
-
-    for req_attrib in REQUIRED_ATTRIB_LIST:
-        if req_attrib not in gbx_tag.attrib:
-            logging.error(f'XML Error: missing required "{req_attrib}" attribute in <gbx> tag!\n'
-                          f'In {file_path} @ line {gbx_tag.get("_line_num")}')
-            raise ValidationError
-
-    encoding = gbx_tag.get('encoding')
-    if not encoding:
-        logging.info(f'XML Info for \"{file_path}\": missing \"encoding\" attribute. Using \"ascii\" as default...')
-    else:
-        if encoding != 'ascii' and encoding != 'cp1251':
-            logging.error(f'XML Error: \"encoding\" attribute can only be either \"ascii\" or \"cp1251\"')
-            raise ValidationError
+    validate_gbx_tag(gbx_tag, file_path)
 
     # Check if "gbx" tag has one and only one "body" tag
     i = 0
@@ -419,51 +815,18 @@ def validate_gbx_xml(gbx_xml: ET.ElementTree, file_path: str):
 
     # If it has a reference table, validate it as well
     if ref_tag:
-        if 'ancestor' not in ref_tag.attrib:
-            logging.error(f'XML Error: missing required "ancestor" attribute in <reference_table>!'
-                          f'In {file_path} @ line {ref_tag.get("_line_num")}')
-            raise ValidationError
+        validate_reference_table(ref_tag, file_path)
 
     # Validate head data
     if head_tag:
-        i = 0
-        for chunk in head_tag:
-            i += 1
-            try:
-                _validate_head_chunk(chunk)
-            except ValidationError:
-                logging.error(f'Error in chunk no. {i} in <head>'
-                              f'In {file_path} @ line {chunk.get("_line_num")}')
-                raise ValidationError
-
-    # Validate reference table
-    if ref_tag:
-        i = 0
-        for entry in ref_tag:
-            i += 1
-            try:
-                _validate_ref_table_entry(entry)
-            except ValidationError:
-                logging.error(f'Error in entry no. {i} in <reference_table>'
-                              f'In {file_path} @ line {entry.get("_line_num")}')
-                raise ValidationError
-        reference_table = ref_tag
+        validate_head(head_tag, file_path)
 
     # Validate body
     body = body_tag
     i = 0
     for chunk in body_tag:
         i += 1
-        if chunk.tag != 'chunk':
-            logging.error(f'XML Error: <body> tag must only contain <chunk> child tags! (element no. {i})'
-                          f'In {file_path} @ line {chunk.get("_line_num")}')
-            raise ValidationError
-
-        try:
-            _validate_chunk(chunk)
-        except ValidationError:
-            logging.error(f'In {file_path} @ line {chunk.get("_line_num")}')
-            raise ValidationError
+        validate_body_chunk(chunk, i, file_path)
 
-    os.chdir(og_dir)
+    utils.chdir(og_dir)
     logging.info('XML Validation passed!')
@@ -1155,6 +1155,7 @@ class GBXClasses:
         "CGameCtnMediaBlockFxBloom": "240CF000",
     }
     _comp_lvl = 0  # 0 TMF+/1 TMO,TMS,TMN,TMU
+    _all_classes: dict = None  # _classes and _old_class_mappings, made once
 
     def __init__(self, comp_lvl: int = 1):
         self._comp_lvl = comp_lvl
@@ -1167,5 +1168,7 @@ class GBXClasses:
 
     def get_dict(self):
         if self._comp_lvl > 0:
-            return dict(list(self._classes.items()) + list(self._old_class_mappings.items()))
+            if GBXClasses._all_classes is None:
+                GBXClasses._all_classes = {**self._classes, **self._old_class_mappings}
+            return GBXClasses._all_classes
         return self._classes
@@ -7,4 +7,10 @@ class ValidationError(BaseException):
 class GBXWriteError(BaseException):
     """
     Raised when failed to write the Gbx file.
-    """
\ No newline at end of file
+    """
+
+
+class QueueFullError(BaseException):
+    """
+    Raised when too many compiles are already waiting for their turn.
+    """
@@ -0,0 +1,258 @@
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
+import xml.etree.ElementTree as ET
+
+import datatypes
+import gbx_xml
+import utils
+from gbxerrors import ValidationError
+
+
+# Tags whose data comes from other files than the linked XML files, see LinkGraph.key
+EXTERNAL_DATA_TAGS = ('icon', 'mesh')
+# Tags written from the state of the compile (the level <gbxclass complvl="..."> sets), see LinkGraph.key
+COMPILE_STATE_TAGS = ('gbxclass',)
+
+
+class LinkGraph:
+    """
+    The XML files linked with <node link="..."> from a root file, parsed once.
+    Files are identified by their absolute path. Missing or broken files are kept as failed parses,
+    so that the validator reports them like it always did.
+    Files are hashed when they are loaded, a file with the same content as another one isn't parsed again.
+    With threads, the linked files and the <icon> images are loaded ahead in a thread pool.
+    """
+    def __init__(self, root_path: str, threads: int = 0):
+        self.root_path = utils.abspath(root_path)
+        self.threads = threads
+        self.links: dict = {self.root_path: []}  # path -> linked paths, once for every link
+        self.parsed: dict = {}  # path -> ParseXml result, (tree or None, error message)
+        self.validated: set = set()  # paths and keys of the linked files already checked by the validator
+        self._done: set = set()  # files whose links have all been followed
+        self.icons: dict = {}  # icon path -> datatypes.encode_icon result, only filled with threads
+        self.hashes: dict = {}  # path -> sha256 of the file
+        self._hash_paths: dict = {}  # sha256 -> first path loaded with that content
+        self._keys: dict = {}  # path -> key, see key
+        # Work not done again for files with the same content (or linked again), see log_savings
+        self.saved = {'parses': 0, 'parse_bytes': 0, 'validations': 0, 'encodes': 0, 'encode_bytes': 0}
+
+    def tree(self, path: str) -> gbx_xml.GbxTree or None:
+        return self.parsed.get(path, (None, ''))[0]
+
+    def resolve(self, elem: ET.Element, path: str = None):
+        """
+        Adds the links found in elem, a tag of the file at path (the root file by default),
+        and follows them through all the linked files. Raises ValidationError on a link cycle.
+        """
+        path = path or self.root_path
+        new_links = list(_find_links(elem, path))
+        self.links.setdefault(path, []).extend(new_links)
+        if self.threads:
+            self._prefetch(new_links, list(_find_icons(elem, path)))
+
+        trail = [path]  # Files being followed, to tell cycles apart from files linked twice
+        pending = [iter(new_links)]
+        while pending:
+            link_path = next(pending[-1], None)
+            if link_path is None:
+                pending.pop()
+                if len(trail) > 1:  # The starting file can still get new links
+                    self._done.add(trail.pop())
+                continue
+            if link_path in trail:
+                cycle = trail[trail.index(link_path):] + [link_path]
+                logging.error(f'XML Error: Infinite recursion detected! Link cycle: '
+                              f'{" -> ".join(_short_path(p) for p in cycle)}')
+                raise ValidationError
+            if link_path in self._done:
+                continue
+            tree = self._parse(link_path)
+            if tree is None:
+                self._done.add(link_path)
+                continue
+            self.links[link_path] = list(_find_links(tree.getroot(), link_path))
+            trail.append(link_path)
+            pending.append(iter(self.links[link_path]))
+
+    def _parse(self, path: str) -> gbx_xml.GbxTree or None:
+        if path not in self.parsed:
+            cached = gbx_xml.tree_cache.lookup(path) if gbx_xml.tree_cache and utils.resolver is None else None
+            if cached:  # Unchanged since it was cached, no need to read it
+                size, file_hash = cached
+            else:
+                try:
+                    with utils.open_file(path) as xml_file:
+                        data = xml_file.read()
+                except OSError:  # Reported by the validator
+                    self.parsed[path] = (None, '')
+                    return None
+                size = len(data)
+                file_hash = hashlib.sha256(data).hexdigest()
+            self.hashes[path] = file_hash
+            same_path = self._hash_paths.setdefault(file_hash, path)
+            if same_path != path and same_path in self.parsed:
+                self.parsed[path] = self.parsed[same_path]  # The tree is only read, it can be shared
+                self.saved['parses'] += 1
+                self.saved['parse_bytes'] += size
+            else:
+                self.parsed[path] = gbx_xml.ParseXml(path, False)
+        return self.parsed[path][0]
+
+    def key(self, path: str) -> str or None:
+        """
+        Returns a hash of the content of a linked file and of all the files it links to, files with the
+        same key are validated and compiled the same way. Returns None for files that can't be parsed,
+        that use data from other files (icons, meshes, list sources), which depend on their directory,
+        or that use <gbxclass>, which depends on where the file is linked.
+        """
+        if path in self._keys:
+            return self._keys[path]
+        self._keys[path] = None
+        tree = self.tree(path)
+        if tree is None:
+            return None
+        for elem in tree.iter():
+            if (elem.tag in EXTERNAL_DATA_TAGS or elem.tag in COMPILE_STATE_TAGS
+                    or (elem.tag == 'list' and 'source' in elem.attrib)):
+                return None
+        content_hash = hashlib.sha256(self.hashes[path].encode())
+        for link_path in self.links.get(path, ()):
+            link_key = self.key(link_path)
+            if link_key is None:
+                return None
+            content_hash.update(link_key.encode())
+        self._keys[path] = content_hash.hexdigest()
+        return self._keys[path]
+
+    def has_repeats(self) -> bool:
+        """ Tells if a file is linked more than once, or if linked files have the same content """
+        link_count = sum(len(link_paths) for link_paths in self.links.values())
+        return link_count > len(self._hash_paths)
+
+    def _validation_key(self, path: str) -> str or None:
+        """ Returns the key of a file in the validations kept by gbx_xml.tree_cache, None if it can't be kept """
+        if gbx_xml.tree_cache is None or utils.resolver is not None or self.key(path) is None:
+            return None
+        return hashlib.sha256(f'{gbx_xml.validator_version()} {self.key(path)}'.encode()).hexdigest()
+
+    def is_validated(self, path: str) -> bool:
+        """ Tells if the file, or a file with the same key, was validated, by this run or a previous one """
+        if path in self.validated or self.key(path) in self.validated:
+            return True
+        validation_key = None if gbx_xml.revalidate else self._validation_key(path)
+        return validation_key is not None and gbx_xml.tree_cache.is_validated(validation_key)
+
+    def set_validated(self, path: str):
+        self.validated.add(path)
+        key = self.key(path)
+        if key:
+            self.validated.add(key)
+        validation_key = self._validation_key(path)
+        if validation_key:
+            gbx_xml.tree_cache.set_validated(validation_key)
+
+    def set_root(self, gbx_tree: gbx_xml.GbxTree):
+        """ Adds the tree of the root file, so its key (and cached validation) is known """
+        cached = gbx_xml.tree_cache.lookup(self.root_path) if gbx_xml.tree_cache else None
+        if cached:
+            self.hashes[self.root_path] = cached[1]
+        else:
+            try:
+                with utils.open_file(self.root_path) as xml_file:
+                    self.hashes[self.root_path] = hashlib.sha256(xml_file.read()).hexdigest()
+            except OSError:
+                return
+        self.parsed[self.root_path] = (gbx_tree, '')
+
+    def _prefetch(self, link_paths: list, icon_paths: list):
+        """
+        Parses the linked files one link level at a time, then reads all their icons, in a thread pool.
+        Icons that can't be read are left to the writer, which reports the error.
+        """
+        with ThreadPoolExecutor(self.threads) as pool:
+            while link_paths:
+                link_paths = [link_path for link_path in dict.fromkeys(link_paths) if link_path not in self.parsed]
+                next_paths = []
+                for link_path, tree in zip(link_paths, pool.map(self._parse, link_paths)):
+                    if tree is not None:
+                        next_paths.extend(_find_links(tree.getroot(), link_path))
+                        icon_paths.extend(_find_icons(tree.getroot(), link_path))
+                link_paths = next_paths
+            icon_paths = [icon_path for icon_path in dict.fromkeys(icon_paths) if icon_path not in self.icons]
+            for icon_path, icon_data in zip(icon_paths, pool.map(_load_icon, icon_paths)):
+                if icon_data is not None:
+                    self.icons[icon_path] = icon_data
+
+    def stats(self) -> dict:
+        """ Returns the fan-out (links in a file) and fan-in (links to a file) of each file """
+        fan_in = {}
+        for links in self.links.values():
+            for link_path in links:
+                fan_in[link_path] = fan_in.get(link_path, 0) + 1
+        return {'fan_out': {path: len(links) for path, links in self.links.items()}, 'fan_in': fan_in}
+
+    def log_stats(self):
+        stats = self.stats()
+        link_count = sum(stats['fan_out'].values())
+        logging.info(f'Link graph: {len(self.links)} files, {link_count} links')
+        if link_count:
+            path, count = max(stats['fan_out'].items(), key=lambda item: item[1])
+            logging.info(f'Max fan-out: {count} links in "{_short_path(path)}"')
+            path, count = max(stats['fan_in'].items(), key=lambda item: item[1])
+            logging.info(f'Max fan-in: {count} links to "{_short_path(path)}"')
+
+    def log_savings(self):
+        saved = self.saved
+        same_content = len(self.hashes) - len(self._hash_paths)
+        logging.info(f'Linked files: {same_content} of {len(self.hashes)} have the same content as another file')
+        logging.info(f'Saved: {saved["parses"]} parses ({saved["parse_bytes"]} bytes), '
+                     f'{saved["validations"]} validations, '
+                     f'{saved["encodes"]} encodes ({saved["encode_bytes"]} bytes)')
+
+
+def _find_links(elem: ET.Element, path: str) -> Iterator[str]:
+    """ Yields the absolute path of each <node link="..."> in elem, links are relative to the file at path """
+    directory = os.path.dirname(path)
+    for node in elem.iter():
+        if (node.tag == 'node' or node.tag == 'nod') and 'link' in node.attrib and 'custom' not in node.attrib:
+            yield os.path.normpath(os.path.join(directory, node.get('link')))
+
+
+def _find_icons(elem: ET.Element, path: str) -> Iterator[str]:
+    """ Yields the absolute path of each <icon link="..."> in elem, links are relative to the file at path """
+    directory = os.path.dirname(path)
+    for icon in elem.iter('icon'):
+        if icon.get('link'):
+            yield os.path.normpath(os.path.join(directory, icon.get('link')))
+
+
+def _load_icon(path: str) -> bytes or None:
+    try:
+        return datatypes.encode_icon(path)
+    except Exception:
+        return None
+
+
+def _short_path(path: str) -> str:
+    try:
+        return os.path.relpath(path, utils.getcwd())
+    except ValueError:  # On another drive
+        return path
+
+
+def build_link_graph(xml_path: str, gbx_tree: ET.ElementTree, threads: int = 0) -> LinkGraph:
+    """
+    Parses all the files linked from the root file and checks that no file links back to itself.
+    With threads, the files and icons are loaded in a pool of that many threads.
+    Raises ValidationError on a link cycle.
+    """
+    link_graph = LinkGraph(xml_path, threads)
+    if gbx_xml.tree_cache:
+        link_graph.set_root(gbx_tree)
+    link_graph.resolve(gbx_tree.getroot())
+    link_graph.log_stats()
+    return link_graph
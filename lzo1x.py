@@ -0,0 +1,184 @@
+"""
+LZO1X compression of the gbx body (the "C" body format), written in Python so no native library is needed.
+The output is a regular LZO1X stream, read by the game with lzo1x_decompress.
+"""
+
+M2_MAX_LEN = 8
+M2_MAX_DIST = 0x0800
+M3_MAX_DIST = 0x4000
+M4_MAX_DIST = 0xBFFF
+MIN_MATCH = 3
+EOF_MARKER = b'\x11\x00\x00'  # M4 match of distance 0
+
+
+def _write_extended(out: bytearray, count: int):
+    """ Writes the part of a length that doesn't fit in the instruction byte """
+    while count > 255:
+        out.append(0)
+        count -= 255
+    out.append(count)
+
+
+def _write_literals(out: bytearray, data: bytes, start: int, end: int, state_index: int or None):
+    count = end - start
+    if count == 0:
+        return
+    if state_index is None and count <= 238:  # First instruction of the stream
+        out.append(17 + count)
+    elif count <= 3:  # Set in the last 2 bits of the previous match
+        out[state_index] |= count
+    elif count - 3 <= 15:
+        out.append(count - 3)
+    else:
+        out.append(0)
+        _write_extended(out, count - 3 - 15)
+    out += data[start:end]
+
+
+def _write_match(out: bytearray, distance: int, length: int) -> int:
+    """ Writes a match and returns the index of the byte holding the count of the literals after it """
+    if length <= M2_MAX_LEN and distance <= M2_MAX_DIST:
+        distance -= 1
+        out.append(((length - 1) << 5) | ((distance & 7) << 2))
+        out.append(distance >> 3)
+        return len(out) - 2
+    if distance <= M3_MAX_DIST:
+        distance -= 1
+        if length - 2 <= 31:
+            out.append(32 | (length - 2))
+        else:
+            out.append(32)
+            _write_extended(out, length - 2 - 31)
+    else:
+        distance -= M3_MAX_DIST
+        marker = 16 | ((distance >> 11) & 8)
+        if length - 2 <= 7:
+            out.append(marker | (length - 2))
+        else:
+            out.append(marker)
+            _write_extended(out, length - 2 - 7)
+    out.append((distance << 2) & 0xFF)
+    out.append((distance >> 6) & 0xFF)
+    return len(out) - 2
+
+
+def _match_length(data: bytes, match_pos: int, pos: int, max_length: int) -> int:
+    length = MIN_MATCH
+    while (length + 32 <= max_length
+           and data[match_pos + length:match_pos + length + 32] == data[pos + length:pos + length + 32]):
+        length += 32
+    while length < max_length and data[match_pos + length] == data[pos + length]:
+        length += 1
+    return length
+
+
+def compress(data: bytes) -> bytes:
+    """ Compresses data with greedy matching of the last position of each 3 bytes sequence """
+    out = bytearray()
+    size = len(data)
+    last_pos = {}  # 3 bytes -> last position
+    state_index = None  # Byte of the last match holding the count of the literals after it
+    literal_start = 0
+    pos = 0
+    while pos + MIN_MATCH <= size:
+        key = data[pos:pos + MIN_MATCH]
+        match_pos = last_pos.get(key)
+        last_pos[key] = pos
+        if match_pos is None or pos - match_pos > M4_MAX_DIST:
+            pos += 1
+            continue
+        length = _match_length(data, match_pos, pos, size - pos)
+        _write_literals(out, data, literal_start, pos, state_index)
+        state_index = _write_match(out, pos - match_pos, length)
+        for i in range(pos + 1, min(pos + length, size - MIN_MATCH)):
+            last_pos[data[i:i + MIN_MATCH]] = i
+        pos += length
+        literal_start = pos
+    _write_literals(out, data, literal_start, size, state_index)
+    out += EOF_MARKER
+    return bytes(out)
+
+
+def _read_length(data: bytes, pos: int, base: int) -> tuple[int, int]:
+    length = 0
+    while data[pos] == 0:
+        length += 255
+        pos += 1
+    return length + base + data[pos], pos + 1
+
+
+def _copy_match(out: bytearray, distance: int, length: int):
+    start = len(out) - distance
+    if start < 0:
+        raise ValueError('match before the start of the data')
+    if distance >= length:
+        out += out[start:start + length]
+    else:  # Repeats the bytes being copied
+        for i in range(length):
+            out.append(out[start + i])
+
+
+def decompress(data: bytes) -> bytes:
+    """ Decompresses a LZO1X stream, raises ValueError if it is broken """
+    out = bytearray()
+    pos = 0
+    state = 0  # Literals copied after the last instruction, 4 for a literal run
+    try:
+        if data[0] > 17:
+            count = data[0] - 17
+            out += data[1:1 + count]
+            pos = 1 + count
+            state = 4 if count >= 4 else count
+        while True:
+            t = data[pos]
+            pos += 1
+            if t < 16:
+                if state == 0:  # Literal run
+                    count = t
+                    if not count:
+                        count, pos = _read_length(data, pos, 15)
+                    count += 3
+                    out += data[pos:pos + count]
+                    pos += count
+                    state = 4
+                    continue
+                if state == 4:  # Match of 3 bytes after a literal run
+                    distance = 1 + M2_MAX_DIST + (t >> 2) + (data[pos] << 2)
+                    length = 3
+                else:  # Match of 2 bytes after short literals
+                    distance = 1 + (t >> 2) + (data[pos] << 2)
+                    length = 2
+                pos += 1
+                state_byte = t
+            elif t >= 64:
+                distance = 1 + ((t >> 2) & 7) + (data[pos] << 3)
+                length = (t >> 5) + 1
+                pos += 1
+                state_byte = t
+            elif t >= 32:
+                length = t & 31
+                if not length:
+                    length, pos = _read_length(data, pos, 31)
+                length += 2
+                distance = 1 + (data[pos] >> 2) + (data[pos + 1] << 6)
+                state_byte = data[pos]
+                pos += 2
+            else:
+                length = t & 7
+                if not length:
+                    length, pos = _read_length(data, pos, 7)
+                length += 2
+                distance = ((t & 8) << 11) + (data[pos] >> 2) + (data[pos + 1] << 6)
+                state_byte = data[pos]
+                pos += 2
+                if distance == 0:
+                    return bytes(out)
+                distance += M3_MAX_DIST
+            _copy_match(out, distance, length)
+            state = state_byte & 3
+            out += data[pos:pos + state]
+            pos += state
+            if pos > len(data):
+                raise IndexError
+    except IndexError:
+        raise ValueError('truncated data')
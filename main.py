@@ -1,11 +1,16 @@
 import os
 import sys
-import hashlib
 import xml.etree.ElementTree as ET
 
 import gbx_xml
 import gbx_xml as gbx_xml_tools
-from gbx import xml_to_gbx
+from gbx import xml_to_gbx, stream_xml_to_gbx
+import sinks
+import utils
+import vfs
+from linkgraph import build_link_graph
+from fragments import FragmentCache
+from treecache import TreeCache
 from gbxerrors import ValidationError, GBXWriteError
 import argparse
 import logging
@@ -30,12 +35,12 @@ arg_parser = argparse.ArgumentParser(
         )
 
 
-arg_parser.add_argument(dest='xml_file',
-                        help='xml input file that will be "compiled" to gbx',
-                        metavar='file.xml',
-                        type=lambda x: is_valid_file(arg_parser, x))
+arg_parser.add_argument(dest='xml_files',
+                        help='xml input files that will be "compiled" to gbx',
+                        metavar='file.xml', nargs='+'
+                        )
 arg_parser.add_argument('-o', '--out', dest='out',
-                        help='output path'
+                        help='output path (only with one file)'
                         )
 arg_parser.add_argument('-d', '--dir', dest='dir',
                         help='the directory where the output file will be saved (only without -o)'
@@ -46,20 +51,137 @@ arg_parser.add_argument('-l', '--log', dest='logfile',
 arg_parser.add_argument('-c', '--checksum', dest='do_checksum', action='store_true',
                         help='whether the program should do a md5 checksum on the compiled file'
                         )
+arg_parser.add_argument('--hash', dest='hash', choices=sinks.HASH_ALGORITHMS, default='md5',
+                        help='checksum algorithm of -c and --manifest, only md5 is checked against the md5 '
+                             'attribute (default: md5)'
+                        )
+arg_parser.add_argument('--manifest', dest='manifest', metavar='FILE',
+                        help='save the checksums of all the compiled files in this file, '
+                             'in the format of md5sum/sha256sum'
+                        )
+arg_parser.add_argument('-s', '--stream', dest='stream', action='store_true',
+                        help='validate and compile the xml file while parsing it, '
+                             'uses less memory on huge files'
+                        )
+arg_parser.add_argument('-p', '--prefetch', dest='threads', type=int, default=0, metavar='THREADS',
+                        help='load the linked xml files and icons ahead in this many threads'
+                        )
+arg_parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=0,
+                        help='validate the linked xml files and write the body in this many processes'
+                        )
+arg_parser.add_argument('--fragment-cache', dest='fragment_cache', metavar='DIR',
+                        help='directory where the compiled linked xml files are kept, to be reused '
+                             'by the next compiles'
+                        )
+arg_parser.add_argument('--tree-cache', dest='tree_cache', metavar='DIR',
+                        help='directory where the parsed xml files are kept, the next compiles load the files '
+                             'that didn\'t change from there instead of parsing them'
+                        )
+arg_parser.add_argument('--revalidate', dest='revalidate', action='store_true',
+                        help='validate all the xml files again, even the ones that --tree-cache knows are valid'
+                        )
+arg_parser.add_argument('--dedup-nodes', dest='dedup_nodes', action='store_true',
+                        help='write the nodes that are encoded like a previous node as a reference to it, '
+                             'makes smaller files (not used with --fragment-cache and -j)'
+                        )
+arg_parser.add_argument('-z', '--compress', dest='compress', action='store_true',
+                        help='compress the body of the gbx file (BUC format), makes smaller files'
+                        )
+arg_parser.add_argument('--source', dest='source', metavar='DIR_OR_ARCHIVE',
+                        help='read the xml file and the files it uses from this directory, zip or tar archive, '
+                             'file.xml being a path inside of it'
+                        )
+arg_parser.add_argument('-a', '--archive', dest='archive', metavar='ARCHIVE',
+                        help='save the compiled files in this zip or tar archive (.zip, .tar, .tar.gz, .tgz, '
+                             '.tar.bz2, .tar.xz) with their output path, instead of one file each'
+                        )
 arg_parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
                         help='show additional information when compiling'
                         )
 
 
-def main() -> None:
-    argv = arg_parser.parse_args()
-    xml_path = argv.xml_file
-    gbx_path = f'{xml_path[:-4]}.Gbx'
+def output_path(argv, xml_path: str) -> str:
     if argv.out:
-        gbx_path = argv.out
+        return argv.out
+    gbx_path = f'{xml_path[:-4]}.Gbx'
+    if argv.dir:
+        gbx_path = os.path.join(argv.dir, gbx_path)
+    return gbx_path
+
+
+def compile_file(argv, xml_path: str, gbx_path: str, fragment_cache: FragmentCache or None,
+                 sink: sinks.Sink) -> str or None:
+    """ Compiles a xml file to gbx_path in sink, returns its expected md5. Exits on errors """
+    start_time = time.time()
+    print(f'Parsing "{xml_path}"...')
+    if argv.stream:
+        try:
+            with utils.open_file(xml_path) as xml_file:
+                exp_md5 = next(ET.iterparse(xml_file, ['start']))[1].get('md5')
+            stream_xml_to_gbx(xml_path, gbx_path, argv.threads, fragment_cache, argv.dedup_nodes, argv.compress,
+                              sink)
+        except (ValidationError, ET.ParseError):
+            logging.error('GBX XML parsing failed!')
+            sys.exit('GBX XML parsing failed!')
+        except GBXWriteError:
+            sys.exit(f'There was an error while writing the "{gbx_path}" GBX file!')
     else:
-        if argv.dir:
-            gbx_path = os.path.join(argv.dir, gbx_path)
+        gbx_parse_res = gbx_xml.ParseXml(xml_path)
+        gbx_tree: ET.ElementTree = gbx_parse_res[0]
+        if not gbx_tree:
+            sys.exit(gbx_parse_res[1])
+        exp_md5 = gbx_tree.getroot().get('md5')
+        try:
+            link_graph = build_link_graph(xml_path, gbx_tree, argv.threads)
+            gbx_xml_tools.validate_gbx_xml(gbx_tree, xml_path, link_graph, argv.jobs)
+        except ValidationError:
+            logging.error('GBX XML parsing failed!')
+            sys.exit('GBX XML parsing failed!')
+
+        # Writing
+        try:
+            with gbx_xml.use_line_nums(gbx_tree):
+                xml_to_gbx(xml_path, gbx_path, gbx_tree.getroot(), link_graph, argv.jobs, fragment_cache,
+                           argv.dedup_nodes, argv.compress, sink)
+        except GBXWriteError:
+            sys.exit(f'There was an error while writing the "{gbx_path}" GBX file!')
+
+    print(f'Successfully compiled to "{gbx_path}"!')
+    logging.info(f'Successfully compiled to "{gbx_path}"!')
+    elapsed_time = time.time() - start_time
+    print(f'Elapsed time: {elapsed_time}')
+    logging.info(f'Elapsed time: {elapsed_time}')
+    return exp_md5
+
+
+def check_md5(new_md5: str, exp_md5: str or None):
+    print(f'{new_md5}')
+    if exp_md5:
+        if new_md5 == exp_md5:
+            print('MD5 Checksum: OK')
+            logging.info('MD5 Checksum: OK')
+        else:
+            print(f'MD5 Checksum: FAIL, expected checksum is incorrect!\n'
+                  f'Expected "{exp_md5}", got "{new_md5}".')
+            logging.warning(f'MD5 Checksum: FAIL, expected checksum is incorrect!\n'
+                            f'Expected "{exp_md5}", got "{new_md5}".')
+
+
+def main() -> None:
+    argv = arg_parser.parse_args()
+    if argv.out and len(argv.xml_files) > 1:
+        arg_parser.error('-o can only be used with one file')
+    resolver = None
+    if argv.source:
+        try:
+            resolver = vfs.open_resolver(is_valid_file(arg_parser, argv.source))
+        except (OSError, ValueError) as e:
+            arg_parser.error(str(e))
+    for xml_path in argv.xml_files:
+        if resolver is None:
+            is_valid_file(arg_parser, xml_path)
+        elif resolver(xml_path) is None:
+            arg_parser.error(f'The file {xml_path} does not exist in {argv.source}!')
 
     loglevel = logging.WARNING
     logfile = None
@@ -73,48 +195,40 @@ def main() -> None:
         format='%(asctime)s (%(levelname)s) %(message)s',
         filename=logfile
     )
-    start_time = time.time()
     print(f'-------GBXC v.{VERSION_STR}-------')
     logging.info(f'Logging level set to {loglevel}')
-    print(f'Parsing "{xml_path}"...')
-    gbx_parse_res = gbx_xml.ParseXml(xml_path)
-    gbx_tree: ET.ElementTree = gbx_parse_res[0]
-    if not gbx_tree:
-        sys.exit(gbx_parse_res[1])
+    fragment_cache = FragmentCache(argv.fragment_cache) if argv.fragment_cache else None
+    if argv.tree_cache:
+        gbx_xml.tree_cache = TreeCache(argv.tree_cache)
+    gbx_xml.revalidate = argv.revalidate
     try:
-        gbx_xml_tools.validate_gbx_xml(gbx_tree, xml_path)
-    except ValidationError:
-        logging.error('GBX XML parsing failed!')
-        sys.exit('GBX XML parsing failed!')
-
-    # Writing
+        sink = sinks.open_sink(argv.archive, argv.hash if argv.do_checksum or argv.manifest else None)
+    except (OSError, ValueError) as e:
+        arg_parser.error(str(e))
     try:
-        xml_to_gbx(xml_path, gbx_path, gbx_tree.getroot())
-    except GBXWriteError:
-        sys.exit(f'There was an error while writing the "{gbx_path}" GBX file!')
-
-    print(f'Successfully compiled to "{gbx_path}"!')
-    logging.info(f'Successfully compiled to "{gbx_path}"!')
-    elapsed_time = time.time() - start_time
-    print(f'Elapsed time: {elapsed_time}')
-    logging.info(f'Elapsed time: {elapsed_time}')
-
-    if argv.do_checksum:
-        with open(gbx_path, 'rb') as fb:
-            gbx_data = fb.read()
-            new_md5 = hashlib.md5(gbx_data).digest().hex()
-            fb.close()
-            print(f'{new_md5}')
-            exp_md5 = gbx_tree.getroot().get('md5')
-            if exp_md5:
-                if new_md5 == exp_md5:
-                    print('MD5 Checksum: OK')
-                    logging.info('MD5 Checksum: OK')
-                else:
-                    print(f'MD5 Checksum: FAIL, expected checksum is incorrect!\n'
-                          f'Expected "{exp_md5}", got "{new_md5}".')
-                    logging.warning(f'MD5 Checksum: FAIL, expected checksum is incorrect!\n'
-                                    f'Expected "{exp_md5}", got "{new_md5}".')
+        with sink, utils.use_resolver(resolver):  # Reads from the disk without a resolver
+            for xml_path in argv.xml_files:
+                gbx_path = output_path(argv, xml_path)
+                exp_md5 = compile_file(argv, xml_path, gbx_path, fragment_cache, sink)
+                if argv.do_checksum and argv.hash == 'md5':
+                    check_md5(sink.checksums[gbx_path], exp_md5)
+                elif argv.do_checksum:
+                    print(f'{sink.checksums[gbx_path]}')
+    finally:
+        if gbx_xml.tree_cache:
+            gbx_xml.tree_cache.log_stats()
+            gbx_xml.tree_cache.save()
+    if argv.archive:
+        print(f'Saved {sink.files} files to "{argv.archive}" ({sink.size} bytes)')
+        logging.info(f'Saved {sink.files} files to "{argv.archive}" ({sink.size} bytes)')
+    else:
+        if len(argv.xml_files) > 1:
+            print(f'{sink.changed} of {sink.files} files changed')
+        logging.info(f'{sink.changed} of {sink.files} files changed')
+    if argv.manifest:
+        sink.write_manifest(argv.manifest)
+        print(f'Saved the {argv.hash} checksums to "{argv.manifest}"')
+        logging.info(f'Saved the {argv.hash} checksums to "{argv.manifest}"')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,381 @@
+import array
+import ast
+import logging
+import math
+import os
+import struct
+import sys
+from typing import BinaryIO
+
+import xml.etree.ElementTree as ET
+
+import utils
+from gbxerrors import GBXWriteError
+
+try:
+    import numpy
+except ImportError:  # Optional, only makes the surface triangles faster
+    numpy = None
+
+
+NPY_MAGIC = b'\x93NUMPY'
+MESH_CACHE_SIZE = 16
+MESH_FIELDS = ('positions', 'normals', 'colors', 'uvs', 'indices')
+# Number of components per element of each mesh field
+FIELD_WIDTH = {'positions': 3, 'normals': 3, 'colors': 4, 'uvs': 2, 'indices': 1}
+
+_mesh_cache: dict = {}
+
+
+class Mesh:
+    """
+    Flat, packed mesh buffers. Vertex fields are float32 arrays, indices are an uint32 array
+    of triangle corners. Missing fields are None.
+    """
+    def __init__(self):
+        self.positions: array.array = None
+        self.normals: array.array = None
+        self.colors: array.array = None
+        self.uvs: array.array = None
+        self.indices: array.array = None
+
+
+def _le_bytes(values: array.array) -> bytes:
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _obj_index(value: str, count: int) -> int:
+    index = int(value)
+    if index < 0:  # relative to the end of the list read so far
+        return count + index
+    return index - 1
+
+
+def load_obj(path: str) -> Mesh:
+    """
+    Loads a Wavefront OBJ file. Polygons are triangulated as fans. Vertices that use the same
+    position, uv and normal index are kept in file order, otherwise they are unified by first use.
+    Vertex colors ("v x y z r g b") are read as well.
+    """
+    positions = array.array('f')
+    colors = array.array('f')
+    uvs = array.array('f')
+    normals = array.array('f')
+    corners = []
+    with utils.open_file(path, 'r') as obj_file:
+        for line_num, line in enumerate(obj_file, 1):
+            parts = line.split()
+            if not parts:
+                continue
+            key = parts[0]
+            try:
+                if key == 'v':
+                    positions.extend(map(float, parts[1:4]))
+                    if len(parts) >= 7:
+                        colors.extend(map(float, parts[4:7]))
+                        colors.append(1.0)
+                elif key == 'vt':
+                    uvs.extend(map(float, parts[1:3]))
+                elif key == 'vn':
+                    normals.extend(map(float, parts[1:4]))
+                elif key == 'f':
+                    face = []
+                    for corner in parts[1:]:
+                        refs = corner.split('/')
+                        v = _obj_index(refs[0], len(positions) // 3)
+                        t = _obj_index(refs[1], len(uvs) // 2) if len(refs) > 1 and refs[1] else -1
+                        n = _obj_index(refs[2], len(normals) // 3) if len(refs) > 2 and refs[2] else -1
+                        face.append((v, t, n))
+                    for i in range(1, len(face) - 1):
+                        corners.append(face[0])
+                        corners.append(face[i])
+                        corners.append(face[i + 1])
+            except ValueError:
+                logging.error(f'Mesh error: incorrect OBJ line "{line.strip()}" in "{path}" @ line {line_num}')
+                raise GBXWriteError
+
+    vertex_count = len(positions) // 3
+    if colors and len(colors) // 4 != vertex_count:
+        logging.error(f'Mesh error: either all or none of the vertices in "{path}" must have a color!')
+        raise GBXWriteError
+
+    uv_count = len(uvs) // 2
+    normal_count = len(normals) // 3
+    for v, t, n in corners:
+        if not 0 <= v < vertex_count or t >= uv_count or n >= normal_count:
+            logging.error(f'Mesh error: face index out of range in "{path}"!')
+            raise GBXWriteError
+
+    mesh = Mesh()
+    has_uvs = any(t >= 0 for _, t, _ in corners)
+    has_normals = any(n >= 0 for _, _, n in corners)
+    shared = (
+        (not has_uvs or uv_count == vertex_count) and
+        (not has_normals or normal_count == vertex_count) and
+        all((t < 0 or t == v) and (n < 0 or n == v) for v, t, n in corners)
+    )
+    if shared:  # One index per vertex, keep the vertex order of the file
+        mesh.positions = positions
+        mesh.colors = colors if colors else None
+        mesh.uvs = uvs if has_uvs else None
+        mesh.normals = normals if has_normals else None
+        mesh.indices = array.array('I', [v for v, _, _ in corners])
+    else:  # Split into unique position/uv/normal combinations
+        mesh.positions = array.array('f')
+        mesh.colors = array.array('f') if colors else None
+        mesh.uvs = array.array('f') if has_uvs else None
+        mesh.normals = array.array('f') if has_normals else None
+        mesh.indices = array.array('I')
+        unique = {}
+        for corner in corners:
+            index = unique.get(corner)
+            if index is None:
+                index = len(unique)
+                unique[corner] = index
+                v, t, n = corner
+                mesh.positions.extend(positions[v * 3:v * 3 + 3])
+                if mesh.colors is not None:
+                    mesh.colors.extend(colors[v * 4:v * 4 + 4])
+                if mesh.uvs is not None:
+                    mesh.uvs.extend(uvs[t * 2:t * 2 + 2] if t >= 0 else (0.0, 0.0))
+                if mesh.normals is not None:
+                    mesh.normals.extend(normals[n * 3:n * 3 + 3] if n >= 0 else (0.0, 0.0, 0.0))
+            mesh.indices.append(index)
+    return mesh
+
+
+def load_npy(path: str) -> tuple[array.array, tuple]:
+    """
+    Loads a NumPy .npy file (C order, numeric dtype) into a flat array and its shape.
+    """
+    with utils.open_file(path) as npy_file:
+        if npy_file.read(6) != NPY_MAGIC:
+            logging.error(f'Mesh error: "{path}" is not a .npy file!')
+            raise GBXWriteError
+        major = npy_file.read(2)[0]
+        header_len_size = 2 if major == 1 else 4
+        header_len = int.from_bytes(npy_file.read(header_len_size), 'little')
+        header = ast.literal_eval(npy_file.read(header_len).decode('latin1'))
+        descr: str = header['descr']
+        shape: tuple = header['shape']
+        if header['fortran_order']:
+            logging.error(f'Mesh error: "{path}" must be stored in C order!')
+            raise GBXWriteError
+
+        byte_order, kind, size = descr[0], descr[1], int(descr[2:])
+        typecode = None
+        for code in ('bBhHiIlLqQ' if kind in 'iu' else 'fd'):
+            if array.array(code).itemsize == size and (kind == 'f' or code.isupper() == (kind == 'u')):
+                typecode = code
+                break
+        if kind not in 'iuf' or typecode is None:
+            logging.error(f'Mesh error: unsupported dtype "{descr}" in "{path}"!')
+            raise GBXWriteError
+
+        values = array.array(typecode)
+        count = math.prod(shape)
+        values.frombytes(npy_file.read(count * size))
+        if len(values) != count:
+            logging.error(f'Mesh error: "{path}" is truncated!')
+            raise GBXWriteError
+        if size > 1 and {'<': 'little', '>': 'big'}.get(byte_order, sys.byteorder) != sys.byteorder:
+            values.byteswap()
+    return values, shape
+
+
+def _load_npy_field(path: str, field: str) -> array.array:
+    values, shape = load_npy(path)
+    width = FIELD_WIDTH[field]
+    if field == 'colors' and len(shape) == 2 and shape[1] == 3:  # RGB, add alpha
+        rgba = array.array('f', bytes(4 * shape[0] * 4))
+        for i in range(3):
+            rgba[i::4] = array.array('f', values[i::3])
+        rgba[3::4] = array.array('f', [1.0]) * shape[0]
+        return rgba
+    if field != 'indices' and (len(shape) != 2 or shape[1] != width) and not (len(shape) == 1 and width == 1):
+        logging.error(f'Mesh error: "{path}" must have the shape (n, {width}) for "{field}", got {shape}!')
+        raise GBXWriteError
+    if field == 'indices':
+        try:
+            return values if values.typecode == 'I' else array.array('I', values)
+        except OverflowError:
+            if min(values) < 0:
+                logging.error(f'Mesh error: negative index {min(values)} in "{path}"!')
+            else:
+                logging.error(f'Mesh error: index {max(values)} is out of the uint32 range in "{path}"!')
+            raise GBXWriteError
+    return values if values.typecode == 'f' else array.array('f', values)
+
+
+def _cached(path: str, loader, *args):
+    if utils.resolver is not None:  # Files aren't on the disk, they may not be the same in the next compile
+        return loader(path, *args)
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size) + args
+    value = _mesh_cache.get(key)
+    if value is None:
+        if len(_mesh_cache) >= MESH_CACHE_SIZE:
+            del _mesh_cache[next(iter(_mesh_cache))]
+        value = loader(path, *args)
+        _mesh_cache[key] = value
+    return value
+
+
+def load_mesh(params: dict) -> Mesh:
+    """
+    Builds the mesh of a <mesh> tag. "source" is an OBJ file, or a .npy file holding the field
+    selected by "data". Fields can also be given (or overridden) one by one with .npy files using
+    the "positions", "normals", "colors", "uvs" and "indices" attributes.
+    """
+    mesh = Mesh()
+    source = params.get('source')
+    try:
+        if source and source.lower().endswith('.obj'):
+            obj_mesh: Mesh = _cached(source, load_obj)
+            for field in MESH_FIELDS:
+                setattr(mesh, field, getattr(obj_mesh, field))
+        elif source:
+            field = DATA_FIELDS.get(params.get('data'), (None,))[0]
+            setattr(mesh, field, _cached(source, _load_npy_field, field))
+        for field in MESH_FIELDS:
+            if params.get(field):
+                setattr(mesh, field, _cached(params.get(field), _load_npy_field, field))
+    except (OSError, KeyError, ValueError, SyntaxError) as e:
+        logging.error(f'Mesh error! {e}')
+        raise GBXWriteError
+    return mesh
+
+
+def _require(mesh: Mesh, data: str, *fields: str):
+    for field in fields:
+        if getattr(mesh, field) is None:
+            logging.error(f'Mesh error: "{data}" data needs mesh {field}!')
+            raise GBXWriteError
+
+
+def _write_floats(file_w: BinaryIO, mesh: Mesh, field: str, count_type: str):
+    values = getattr(mesh, field)
+    utils.write_count(file_w, len(values) // FIELD_WIDTH[field], count_type)
+    file_w.write(_le_bytes(values))
+
+
+def _write_indices(file_w: BinaryIO, mesh: Mesh, count_type: str):
+    if mesh.indices and max(mesh.indices) > 65535:
+        logging.error('Mesh error: index exceeded uint16 size!')
+        raise GBXWriteError
+    utils.write_count(file_w, len(mesh.indices), count_type)
+    file_w.write(_le_bytes(array.array('H', mesh.indices)))
+
+
+def _write_vertices(file_w: BinaryIO, mesh: Mesh, count_type: str):
+    """ CPlugVisual3D vertices: position, normal and RGBA color (white if missing) """
+    count = len(mesh.positions) // 3
+    if len(mesh.normals) // 3 != count or (mesh.colors is not None and len(mesh.colors) // 4 != count):
+        logging.error('Mesh error: vertex positions, normals and colors must have the same count!')
+        raise GBXWriteError
+    packed = array.array('f', bytes(40 * count))
+    for i in range(3):
+        packed[i::10] = mesh.positions[i::3]
+        packed[3 + i::10] = mesh.normals[i::3]
+    if mesh.colors is not None:
+        for i in range(4):
+            packed[6 + i::10] = mesh.colors[i::4]
+    else:
+        white = array.array('f', [1.0]) * count
+        for i in range(4):
+            packed[6 + i::10] = white
+    utils.write_count(file_w, count, count_type)
+    file_w.write(_le_bytes(packed))
+
+
+def _surface_triangles_numpy(positions: array.array, indices: array.array) -> bytes:
+    """ CPlugSurfaceGeom triangles of all the corners at once, computed like _surface_triangles """
+    positions = numpy.asarray(positions, dtype=numpy.float64).reshape(-1, 3)
+    corners = numpy.asarray(indices, dtype=numpy.int64).reshape(-1, 3)
+    a, b, c = positions[corners[:, 0]], positions[corners[:, 1]], positions[corners[:, 2]]
+    u = b - a
+    v = c - a
+    nx = u[:, 1] * v[:, 2] - u[:, 2] * v[:, 1]
+    ny = u[:, 2] * v[:, 0] - u[:, 0] * v[:, 2]
+    nz = u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0]
+    length = numpy.sqrt(nx * nx + ny * ny + nz * nz)
+    length[length == 0.0] = 1.0
+    nx, ny, nz = nx / length, ny / length, nz / length
+    triangles = numpy.zeros(len(corners), [('plane', '<f4', 4), ('corners', '<i4', 3), ('material', '<i4')])
+    triangles['plane'] = numpy.column_stack((nx, ny, nz, -(nx * a[:, 0] + ny * a[:, 1] + nz * a[:, 2])))
+    triangles['corners'] = corners
+    return triangles.tobytes()
+
+
+def _surface_triangles(positions: array.array, indices: array.array) -> bytes:
+    """ CPlugSurfaceGeom triangles one at a time, without numpy """
+    triangle = struct.Struct('<4f3ihbb')
+    out = []
+    for i in range(0, len(indices) - 2, 3):
+        a, b, c = indices[i], indices[i + 1], indices[i + 2]
+        ax, ay, az = positions[a * 3:a * 3 + 3]
+        ux, uy, uz = positions[b * 3] - ax, positions[b * 3 + 1] - ay, positions[b * 3 + 2] - az
+        vx, vy, vz = positions[c * 3] - ax, positions[c * 3 + 1] - ay, positions[c * 3 + 2] - az
+        nx, ny, nz = uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx
+        length = math.sqrt(nx * nx + ny * ny + nz * nz) or 1.0
+        nx, ny, nz = nx / length, ny / length, nz / length
+        out.append(triangle.pack(nx, ny, nz, -(nx * ax + ny * ay + nz * az), a, b, c, 0, 0, 0))
+    return b''.join(out)
+
+
+def _write_surface_triangles(file_w: BinaryIO, mesh: Mesh, count_type: str):
+    """
+    CPlugSurfaceGeom triangles: plane (normal, distance), 3 vertex indices and material info (zeros).
+    Computed with numpy if it is installed
+    """
+    count = len(mesh.indices) // 3
+    indices = mesh.indices[:count * 3]
+    vertex_count = len(mesh.positions) // 3
+    if count and max(indices) >= vertex_count:
+        bad = next(i for i in range(len(indices)) if indices[i] >= vertex_count) // 3
+        logging.error(f'Mesh error: triangle no. {bad} uses a vertex out of range!')
+        raise GBXWriteError
+    if numpy is not None:
+        data = _surface_triangles_numpy(mesh.positions, indices)
+    else:
+        data = _surface_triangles(mesh.positions, indices)
+    utils.write_count(file_w, count, count_type)
+    file_w.write(data)
+
+
+# data attribute -> (field loaded from a .npy "source", required fields)
+DATA_FIELDS = {
+    'positions': ('positions', ('positions',)),
+    'normals': ('normals', ('normals',)),
+    'colors': ('colors', ('colors',)),
+    'uvs': ('uvs', ('uvs',)),
+    'indices': ('indices', ('indices',)),
+    'vertices': ('positions', ('positions', 'normals')),
+    'surface_triangles': ('indices', ('positions', 'indices')),
+}
+
+
+def write_mesh(file_w: BinaryIO, _value: str, params: dict, _element: ET.Element = None):
+    data = params.get('data')
+    if data not in DATA_FIELDS:
+        logging.error(f'Data type tag error: unknown data "{data}" in <mesh> tag! '
+                      f'(must be one of: {", ".join(DATA_FIELDS)})')
+        raise GBXWriteError
+    if not params.get('source') and not any(params.get(field) for field in MESH_FIELDS):
+        logging.error('Data type tag error: missing "source" attribute in <mesh> tag!')
+        raise GBXWriteError
+
+    mesh = load_mesh(params)
+    _require(mesh, data, *DATA_FIELDS[data][1])
+    count_type = params.get('count_type')
+    if data == 'indices':
+        _write_indices(file_w, mesh, count_type)
+    elif data == 'vertices':
+        _write_vertices(file_w, mesh, count_type)
+    elif data == 'surface_triangles':
+        _write_surface_triangles(file_w, mesh, count_type)
+    else:
+        _write_floats(file_w, mesh, data, count_type)
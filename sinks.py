@@ -0,0 +1,159 @@
+"""
+Sinks the compiled gbx files are saved to: a directory (one file per gbx) or a zip or tar archive holding all of them.
+"""
+import hashlib
+import logging
+import os
+import tarfile
+import threading
+import time
+import zipfile
+from io import BytesIO
+from pathlib import Path
+
+import vfs
+
+BLOCK_SIZE = 1 << 20  # Archives are written in blocks of this size
+HASH_ALGORITHMS = ('md5', 'blake2b', 'sha256')
+ARCHIVE_MODES = {  # Extension -> tarfile mode, None for zip
+    '.zip': None,
+    '.tar': 'w|',
+    '.tar.gz': 'w|gz',
+    '.tgz': 'w|gz',
+    '.tar.bz2': 'w|bz2',
+    '.tar.xz': 'w|xz',
+}
+
+
+class Sink:
+    """
+    Base of the sinks, save returns False if the file was already saved with the same bytes.
+    With checksum (one of HASH_ALGORITHMS), the digest of each file is kept in checksums by path,
+    from the bytes given to the sink so nothing is read back
+    """
+    def __init__(self, checksum: str = None):
+        self.checksum = checksum
+        self.checksums: dict = {}
+        self.files = 0
+        self.changed = 0
+        self.size = 0
+
+    def save(self, path: str, data: bytes) -> bool:
+        return True
+
+    def write(self, path: str, data: bytes):
+        if self.save(path, data):
+            self.changed += 1
+        self.files += 1
+        self.size += len(data)
+        if self.checksum:
+            self.checksums[path] = hashlib.new(self.checksum, data).hexdigest()
+
+    def name(self, path: str) -> str:
+        """ Returns the name of a saved file in the manifest """
+        return path
+
+    def write_manifest(self, path: str):
+        """ Saves the checksums in the format of md5sum/sha256sum, so the files can be checked with "md5sum -c" """
+        Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+        with open(path, 'w', encoding='utf-8', newline='\n') as manifest_file:
+            for file_path, digest in self.checksums.items():
+                manifest_file.write(f'{digest}  {self.name(file_path)}\n')
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _same_file(path: str, data: bytes) -> bool:
+    """ Returns whether the file at path holds data, compared by size then by a hash read in blocks """
+    try:
+        if os.path.getsize(path) != len(data):
+            return False
+        file_hash = hashlib.blake2b()
+        with open(path, 'rb') as in_file:
+            while block := in_file.read(BLOCK_SIZE):
+                file_hash.update(block)
+    except OSError:
+        return False
+    return file_hash.digest() == hashlib.blake2b(data).digest()
+
+
+class DirectorySink(Sink):
+    """
+    Saves each file at its path, the missing directories are created. A file is written to a temporary
+    file then renamed, so it is never seen half written. A file already holding the same bytes isn't
+    written again, so its modification time stays the same
+    """
+    def save(self, path: str, data: bytes) -> bool:
+        if _same_file(path, data):
+            logging.info(f'"{path}" is unchanged, not saved again')
+            return False
+        Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'  # gbx_async saves from threads
+        try:
+            with open(temp_path, 'wb') as out_file:
+                out_file.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return True
+
+
+def archive_mode(path: str) -> str or None:
+    """ Returns the tarfile mode of an archive path, None for a zip. Raises ValueError if it isn't an archive """
+    for extension, mode in ARCHIVE_MODES.items():
+        if path.lower().endswith(extension):
+            return mode
+    raise ValueError(f'"{path}" is not a zip or tar archive ({", ".join(ARCHIVE_MODES)})')
+
+
+class ArchiveSink(Sink):
+    """
+    Appends each file to a zip or tar archive (picked by the extension of path), named by its path
+    relative to the working directory. The archive is complete once closed.
+    """
+    def __init__(self, path: str, checksum: str = None):
+        super().__init__(checksum)
+        self.path = path
+        mode = archive_mode(path)
+        Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+        self.out_file = open(path, 'wb', BLOCK_SIZE)
+        if mode is None:
+            self.archive = zipfile.ZipFile(self.out_file, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            self.archive = tarfile.open(fileobj=self.out_file, mode=mode, bufsize=BLOCK_SIZE)
+
+    def name(self, path: str) -> str:
+        return vfs.member_name(os.path.relpath(path))
+
+    def save(self, path: str, data: bytes) -> bool:
+        name = self.name(path)
+        if isinstance(self.archive, zipfile.ZipFile):
+            self.archive.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self.archive.addfile(info, BytesIO(data))
+        return True
+
+    def close(self):
+        if self.archive:
+            self.archive.close()
+            self.out_file.close()
+            self.archive = None
+
+
+def open_sink(path: str = None, checksum: str = None) -> Sink:
+    """ Returns an archive sink if path is given, else the directory sink """
+    if path:
+        return ArchiveSink(path, checksum)
+    return DirectorySink(checksum)
@@ -1,19 +1,39 @@
+import asyncio
+import gc
+import hashlib
+import logging
 import os
+import struct
+import tarfile
+import tempfile
+import zipfile
 
-from gbx import xml_to_gbx
+import gbx
+from gbx import xml_to_gbx, stream_xml_to_gbx, compile_xml
 import xml.etree.ElementTree as ET
+import gbx_xml
 from gbx_xml import validate_gbx_xml
+from linkgraph import build_link_graph
+from fragments import FragmentCache
+from treecache import TreeCache
+from gbx_async import AsyncCompiler
+import lzo1x
+import sinks
+import vfs
 from hashlib import md5
 
-from gbxerrors import ValidationError, GBXWriteError
+from gbxerrors import ValidationError, GBXWriteError, QueueFullError
 
 
 def checksum_file(path, exp_md5: str) -> bool:
-    if not exp_md5:
-        return False
     with open(path, 'rb') as fb:
         gbx_data = fb.read()
-        new_md5 = md5(gbx_data).digest().hex()
+    return check_md5(md5(gbx_data).digest().hex(), exp_md5)
+
+
+def check_md5(new_md5: str, exp_md5: str) -> bool:
+    if not exp_md5:
+        return False
     if new_md5 == exp_md5:
         print('\nMD5 Checksum: OK')
         return True
@@ -37,8 +57,9 @@ def do_file(xml_path: str, gbx_path: str, do_checksum: bool) -> bool:
         print('\nGBX XML parsing failed!')
         os.chdir(og_path)
         return False
+    sink = sinks.DirectorySink('md5')  # Checksum of the bytes being saved, the file isn't read back
     try:
-        xml_to_gbx(xml_path, gbx_path, gbx_tree.getroot())
+        xml_to_gbx(xml_path, gbx_path, gbx_tree.getroot(), sink=sink)
     except GBXWriteError:
         print(f'\nThere was an error while writing the "{gbx_path}" GBX file!')
         os.chdir(og_path)
@@ -46,11 +67,25 @@ def do_file(xml_path: str, gbx_path: str, do_checksum: bool) -> bool:
 
     os.chdir(og_path)
     if do_checksum:
-        assert checksum_file(gbx_path, gbx_tree.getroot().get('md5')) is True
+        assert check_md5(sink.checksums[gbx_path], gbx_tree.getroot().get('md5')) is True
 
     return True
 
 
+def do_file_stream(xml_path: str, gbx_path: str) -> bool:
+    og_path = os.getcwd()
+    sink = sinks.DirectorySink('md5')
+    try:
+        stream_xml_to_gbx(xml_path, gbx_path, sink=sink)
+    except (ValidationError, GBXWriteError):
+        print(f'\nThere was an error while streaming the "{gbx_path}" GBX file!')
+        os.chdir(og_path)
+        return False
+
+    os.chdir(og_path)
+    return check_md5(sink.checksums[gbx_path], ET.parse(xml_path).getroot().get('md5'))
+
+
 def test_collection_tm1():
     assert do_file('Samples/TM1.0/GameData/Collections/Alpine.TMCollection.xml',
                    'Samples/TM1.0/GameData/Collections/Alpine.TMCollection.Gbx', True) is True
@@ -76,12 +111,413 @@ def test_slope_tmo():
                    'Samples/TMO/TMEDSlope/SpeedSlope/SpeedSlope.TMEDSlope.Gbx', True) is True
 
 
+def test_mesh_visual_tm1():
+    assert do_file('Samples/TM1.0/Custom/Mesh/Visual.CPlugVisualIndexedTriangles.xml',
+                   'Samples/TM1.0/Custom/Mesh/Visual.CPlugVisualIndexedTriangles.Gbx', True) is True
+
+
+def test_mesh_surface_tm1():
+    assert do_file('Samples/TM1.0/Custom/Mesh/Surface.CPlugSurfaceGeom.xml',
+                   'Samples/TM1.0/Custom/Mesh/Surface.CPlugSurfaceGeom.Gbx', True) is True
+
+
+def test_list_source_tm1():
+    assert do_file('Samples/TM1.0/Custom/ListSource/Units.Inline.xml',
+                   'Samples/TM1.0/Custom/ListSource/Units.Inline.Gbx', True) is True
+    assert do_file('Samples/TM1.0/Custom/ListSource/Units.Csv.xml',
+                   'Samples/TM1.0/Custom/ListSource/Units.Csv.Gbx', True) is True
+
+
+def test_stream_tm1():
+    assert do_file_stream('Samples/TM1.0/Custom/Scene3d/RallyBase32x32.Scene3d.xml',
+                          'Samples/TM1.0/Custom/Scene3d/RallyBase32x32.Scene3d.Gbx') is True
+
+
+def test_stream_tmo():
+    assert do_file_stream('Samples/TMO/TMEDFrontier/DesertToDesert2/DesertToDesert2.TMEDFrontier.xml',
+                          'Samples/TMO/TMEDFrontier/DesertToDesert2/DesertToDesert2.TMEDFrontier.Gbx') is True
+
+
+def test_compile_twice_tm1():
+    xml_path = 'Samples/TM1.0/Custom/Scene3d/RallyBase32x32.Scene3d.xml'
+    gbx_path = 'Samples/TM1.0/Custom/Scene3d/RallyBase32x32.Scene3d.Gbx'
+    gbx_tree = ET.parse(xml_path)
+    xml_data = ET.tostring(gbx_tree.getroot())
+    for _ in range(2):  # The parsed tree is left untouched and can be compiled again
+        og_path = os.getcwd()
+        validate_gbx_xml(gbx_tree, xml_path)
+        xml_to_gbx(xml_path, gbx_path, gbx_tree.getroot())
+        os.chdir(og_path)
+        assert checksum_file(gbx_path, gbx_tree.getroot().get('md5')) is True
+    assert ET.tostring(gbx_tree.getroot()) == xml_data
+
+
+def test_link_graph_tmo():
+    xml_path = 'Samples/TMO/TMEDFrontier/DesertToDesert2/DesertToDesert2.TMEDFrontier.xml'
+    gbx_path = 'Samples/TMO/TMEDFrontier/DesertToDesert2/DesertToDesert2.TMEDFrontier.Gbx'
+    gbx_tree = ET.parse(xml_path)
+    for threads, workers in ((0, 0), (4, 2)):  # Without and with prefetching and worker processes
+        link_graph = build_link_graph(xml_path, gbx_tree, threads)
+        assert gc.isenabled()  # Enabled again once the parses of all the threads are done
+        assert len(link_graph.links) == 66
+        assert link_graph.stats()['fan_out'][link_graph.root_path] == 33
+        assert len(link_graph.icons) == (1 if threads else 0)
+        og_path = os.getcwd()
+        validate_gbx_xml(gbx_tree, xml_path, link_graph, workers)
+        xml_to_gbx(xml_path, gbx_path, gbx_tree.getroot(), link_graph, workers)
+        os.chdir(og_path)
+        assert checksum_file(gbx_path, gbx_tree.getroot().get('md5')) is True
+
+
+def test_gbxclass_jobs():
+    chunk = '<chunk class="0A005000" id="003"><gbxclass{}>CGameCtnCollector</gbxclass></chunk>'
+    xml_data = ('<gbx version="6" unknown="R" class="0A005000" complvl="1"><body>'
+                + ''.join(chunk.format(attrib) for attrib in (' complvl="1"', '', ' complvl="0"', '')) + '</body></gbx>')
+    gbx_data = gbx.compile_gbx('Gbxclass.xml', ET.fromstring(xml_data))
+    assert gbx_data.count(struct.pack('<I', 0x2E001000)) == 2  # The class ids after complvl="0"
+    # Each group of chunks is written by a process with the compatibility level set before it
+    assert gbx.compile_gbx('Gbxclass.xml', ET.fromstring(xml_data), jobs=2) == gbx_data
+
+
+def test_link_cycle():
+    class KeepMessages(logging.Handler):
+        def emit(self, record: logging.LogRecord):
+            messages.append(record.getMessage())
+
+    messages = []
+    handler = KeepMessages(logging.ERROR)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name, link in (('A.xml', 'B.xml'), ('B.xml', 'A.xml')):
+            with open(os.path.join(temp_dir, name), 'w') as xml_file:
+                xml_file.write(f'<gbx version="6" unknown="R" class="0A005000"><body>'
+                               f'<chunk class="0A005000" id="003"><node link="{link}"/></chunk></body></gbx>')
+        xml_path = os.path.join(temp_dir, 'A.xml')
+        logging.getLogger().addHandler(handler)
+        try:
+            build_link_graph(xml_path, ET.parse(xml_path))
+            assert False
+        except ValidationError:
+            pass
+        finally:
+            logging.getLogger().removeHandler(handler)
+        cycle = ' -> '.join(os.path.relpath(os.path.join(temp_dir, name)) for name in ('A.xml', 'B.xml', 'A.xml'))
+        assert messages == [f'XML Error: Infinite recursion detected! Link cycle: {cycle}']
+
+
+def test_fragment_cache_tmo():
+    xml_path = 'Samples/TMO/TMEDFrontier/DesertToDesert2/DesertToDesert2.TMEDFrontier.xml'
+    gbx_path = 'Samples/TMO/TMEDFrontier/DesertToDesert2/DesertToDesert2.TMEDFrontier.Gbx'
+    gbx_tree = ET.parse(xml_path)
+    link_graph = build_link_graph(xml_path, gbx_tree)
+    fragment_cache = FragmentCache()
+    for _ in range(2):  # The linked files are compiled, then taken from the cache
+        og_path = os.getcwd()
+        xml_to_gbx(xml_path, gbx_path, gbx_tree.getroot(), link_graph, cache=fragment_cache)
+        os.chdir(og_path)
+        assert checksum_file(gbx_path, gbx_tree.getroot().get('md5')) is True
+    assert fragment_cache.hits == 33
+
+
+def test_gbxclass_links():
+    header = '<gbx version="6" unknown="R" class="0A005000"><body><chunk class="0A005000" id="003">'
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name, content in (('M.xml', '<gbxclass>CGameCtnCollector</gbxclass>'),
+                              ('Root.xml', '<node link="M.xml"/><gbxclass complvl="0">CGameCtnCollector</gbxclass>'
+                                           '<node link="M.xml"/>')):
+            with open(os.path.join(temp_dir, name), 'w') as xml_file:
+                xml_file.write(f'{header}{content}</chunk></body></gbx>')
+        xml_path = os.path.join(temp_dir, 'Root.xml')
+        gbx_tree = ET.parse(xml_path)
+        og_path = os.getcwd()
+        gbx_data = gbx.compile_gbx(xml_path, gbx_tree.getroot())  # Nothing is cached without link graph
+        assert gbx_data.count(struct.pack('<I', 0x2E001000)) == 2  # The class ids after complvl="0"
+        # The class id written by M.xml depends on where it is linked, it isn't cached
+        link_graph = build_link_graph(xml_path, gbx_tree)
+        fragment_cache = FragmentCache()
+        for _ in range(2):
+            assert gbx.compile_gbx(xml_path, gbx_tree.getroot(), link_graph, cache=fragment_cache) == gbx_data
+        # M.xml is linked twice, the compile uses its own cache
+        assert gbx.compile_gbx(xml_path, gbx_tree.getroot(), link_graph) == gbx_data
+        os.chdir(og_path)
+
+
+def test_same_content_tmnesw():
+    xml_path = 'Samples/TMNESWC/TMEDRoad/StadiumRoadMain/StadiumRoadMain.TMEDRoad.xml'
+    gbx_path = 'Samples/TMNESWC/TMEDRoad/StadiumRoadMain/StadiumRoadMain.TMEDRoad.Gbx'
+    gbx_tree = ET.parse(xml_path)
+    gbx_data = []
+    for link_graph in (None, build_link_graph(xml_path, gbx_tree)):  # Two linked files have the same content
+        og_path = os.getcwd()
+        validate_gbx_xml(gbx_tree, xml_path, link_graph)
+        xml_to_gbx(xml_path, gbx_path, gbx_tree.getroot(), link_graph)
+        os.chdir(og_path)
+        with open(gbx_path, 'rb') as fb:
+            gbx_data.append(fb.read())
+    assert gbx_data[0] == gbx_data[1]
+    assert link_graph.saved['parses'] == 1
+    assert link_graph.saved['validations'] == 1
+    assert link_graph.saved['encodes'] == 1
+
+
+def test_dedup_nodes():
+    xml_path = 'Samples/TMO/TMEDFrontier/DesertToDesert2/DesertToDesert2.TMEDFrontier.xml'
+    gbx_path = 'Samples/TMO/TMEDFrontier/DesertToDesert2/DesertToDesert2.TMEDFrontier.Gbx'
+    gbx_tree = ET.parse(xml_path)
+    og_path = os.getcwd()
+    validate_gbx_xml(gbx_tree, xml_path)
+    xml_to_gbx(xml_path, gbx_path, gbx_tree.getroot(), dedup=True)  # No node is encoded like another one
+    os.chdir(og_path)
+    assert checksum_file(gbx_path, gbx_tree.getroot().get('md5')) is True
+    xml_path = 'Samples/TMNESWC/TMEDRoad/StadiumRoadMain/StadiumRoadMain.TMEDRoad.xml'
+    gbx_path = 'Samples/TMNESWC/TMEDRoad/StadiumRoadMain/StadiumRoadMain.TMEDRoad.Gbx'
+    gbx_tree = ET.parse(xml_path)
+    for node in gbx_tree.iter('node'):
+        if node.get('link') == '3.CGameCtnBlockUnitInfo.xml':  # Same content as the file linked as "1"
+            del node.attrib['refname']
+    gbx_sizes = []
+    for dedup in (False, True):
+        og_path = os.getcwd()
+        validate_gbx_xml(gbx_tree, xml_path)
+        xml_to_gbx(xml_path, gbx_path, gbx_tree.getroot(), dedup=dedup)
+        os.chdir(og_path)
+        gbx_sizes.append(os.path.getsize(gbx_path))
+    assert int(gbx.deduped_nodes) == 1
+    assert gbx_sizes[0] - gbx_sizes[1] == int(gbx.deduped_bytes)
+    # The lookback strings of a removed node are forgotten: with version 5 all of them are kept in the table,
+    # with version 6 the ones of type 0
+    for version, string_type, value in ((5, '40', 'A'), (6, '0', '1')):
+        node = ('<node class="0A005000"{}><chunk class="0A005000" id="003">'
+                f'<lookbackstr type="{string_type}">{value}</lookbackstr></chunk></node>')
+        head = f'<gbx version="{version}" unknown="R" class="0A005000"><body><chunk class="0A005000" id="003">'
+        tail = '<lookbackstr type="40">B</lookbackstr>' * 2 + '</chunk></body></gbx>'
+        gbx_data = compile_xml(head + node.format('') * 2 + tail, dedup=True)
+        assert int(gbx.deduped_nodes) == 1
+        assert gbx_data == compile_xml(head + node.format(' refname="1"') + '<node ref="1"/>' + tail)
+
+
+def test_compress_tmo():
+    xml_path = 'Samples/TMO/TMEDFrontier/DesertToDesert2/DesertToDesert2.TMEDFrontier.xml'
+    gbx_path = 'Samples/TMO/TMEDFrontier/DesertToDesert2/DesertToDesert2.TMEDFrontier.Gbx'
+    gbx_tree = ET.parse(xml_path)
+    gbx_data = []
+    for compress in (False, True):
+        og_path = os.getcwd()
+        validate_gbx_xml(gbx_tree, xml_path)
+        xml_to_gbx(xml_path, gbx_path, gbx_tree.getroot(), compress=compress)
+        os.chdir(og_path)
+        with open(gbx_path, 'rb') as fb:
+            gbx_data.append(fb.read())
+    uncompressed, compressed = gbx_data
+    assert compressed[:8] == uncompressed[:7] + b'C'  # Magic, version and format
+    body_pos = next(i for i in range(8, len(uncompressed)) if compressed[i] != uncompressed[i])
+    body_size, compressed_size = struct.unpack_from('<II', compressed, body_pos)
+    assert body_size == len(uncompressed) - body_pos
+    assert len(compressed) == body_pos + 8 + compressed_size
+    assert lzo1x.decompress(compressed[body_pos + 8:]) == uncompressed[body_pos:]
+
+
+def test_compile_xml_tmo():
+    xml_dir = 'Samples/TMO/TMEDFrontier/DesertToDesert2'
+    files = {}
+    for file_name in os.listdir(xml_dir):
+        with open(os.path.join(xml_dir, file_name), 'rb') as fb:
+            files[file_name] = fb.read()
+    xml_data = files.pop('DesertToDesert2.TMEDFrontier.xml')
+    og_path = os.getcwd()
+    stats = {}
+    gbx_data = compile_xml(xml_data, files.get, stats)  # Linked files are only read from files
+    assert os.getcwd() == og_path
+    assert md5(gbx_data).hexdigest() == ET.fromstring(xml_data).get('md5')
+    assert stats['size'] == len(gbx_data) and stats['links'] == 65
+    # A version 5 file writes the lookback strings of version 2, the next files don't
+    compile_xml('<gbx version="5" unknown="R" class="0A005000"><body><chunk class="0A005000" id="003">'
+                '<lookbackstr type="40">A</lookbackstr></chunk></body></gbx>')
+    assert compile_xml(xml_data, files.get) == gbx_data
+    try:
+        compile_xml(xml_data)  # No linked files
+        assert False
+    except ValidationError:
+        pass
+
+
+def test_deep_nodes():
+    depth = 2000  # Past the recursion limit
+    xml_data = ('<gbx version="6" unknown="R" class="0A005000" complvl="1"><body><chunk class="0A005000" id="003">'
+                + '<node class="0A005000"><chunk class="0A005000" id="003">' * depth + '<uint32>1</uint32>'
+                + '</chunk></node>' * depth + '</chunk></body></gbx>')
+    gbx_data = compile_xml(xml_data)
+    assert gbx_data.count(struct.pack('<I', 0xFACADE01)) == depth + 1  # The end of each node and of the body
+    with tempfile.TemporaryDirectory() as temp_dir:
+        xml_path = os.path.join(temp_dir, 'Deep.xml')
+        with open(xml_path, 'w') as xml_file:
+            xml_file.write(xml_data)
+        og_path = os.getcwd()
+        sink = sinks.DirectorySink('md5')
+        stream_xml_to_gbx(xml_path, os.path.join(temp_dir, 'Deep.Gbx'), sink=sink)
+        os.chdir(og_path)
+        assert list(sink.checksums.values()) == [md5(gbx_data).hexdigest()]
+
+
+def test_async_compile_tmo():
+    xml_path = 'Samples/TMO/TMEDFrontier/DesertToDesert2/DesertToDesert2.TMEDFrontier.xml'
+    exp_md5 = ET.parse(xml_path).getroot().get('md5')
+
+    async def compile_all():
+        compiler = AsyncCompiler(max_concurrency=1, max_queue=1)
+        stats = {}
+        results = await asyncio.gather(compiler.compile_file(xml_path, stats=stats), compiler.compile_file(xml_path),
+                                       compiler.compile_file(xml_path), return_exceptions=True)
+        assert md5(results[0]).hexdigest() == exp_md5 and results[1] == results[0]
+        assert isinstance(results[2], QueueFullError)  # One compile running, one waiting
+        assert stats['links'] == 65 and compiler.compiled == 2 and compiler.refused == 1
+
+    asyncio.run(compile_all())
+
+
+def test_archive_source_tmo():
+    xml_dir = 'Samples/TMO/TMEDFrontier/DesertToDesert2'
+    xml_name = 'TMO/DesertToDesert2/DesertToDesert2.TMEDFrontier.xml'
+    with tempfile.TemporaryDirectory() as temp_dir:
+        zip_path = os.path.join(temp_dir, 'sources.zip')
+        tar_path = os.path.join(temp_dir, 'sources.tar.gz')
+        with zipfile.ZipFile(zip_path, 'w') as zip_file, tarfile.open(tar_path, 'w:gz') as tar_file:
+            for file_name in os.listdir(xml_dir):
+                if file_name.endswith('.Gbx'):  # Compiled by test_frontier_tmo
+                    continue
+                zip_file.write(os.path.join(xml_dir, file_name), f'TMO/DesertToDesert2/{file_name}')
+                tar_file.add(os.path.join(xml_dir, file_name), f'./TMO/DesertToDesert2/{file_name}')
+        for resolver in (vfs.open_resolver(zip_path), vfs.open_resolver(tar_path)):
+            xml_data = resolver(xml_name)
+            gbx_data = compile_xml(xml_data, resolver, name=xml_name)
+            assert md5(gbx_data).hexdigest() == ET.fromstring(xml_data).get('md5')
+            assert resolver.reads == len(resolver.members)  # Each file is read once
+            resolver.close()
+
+
+def test_archive_sink_tm1():
+    xml_dir = 'Samples/TM1.0/Custom/ListSource'
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for archive_name in ('out.zip', 'out.tar.gz'):
+            archive_path = os.path.join(temp_dir, archive_name)
+            exp_md5s = {}
+            with sinks.open_sink(archive_path, checksum='md5') as sink:
+                for file_name in ('Units.Csv.xml', 'Units.Inline.xml'):
+                    xml_path = os.path.join(xml_dir, file_name)
+                    gbx_path = os.path.join(xml_dir, f'{file_name[:-4]}.Gbx')
+                    gbx_tree = ET.parse(xml_path)
+                    exp_md5s[gbx_path.replace(os.sep, '/')] = gbx_tree.getroot().get('md5')
+                    xml_to_gbx(xml_path, gbx_path, gbx_tree.getroot(), sink=sink)
+                    assert sink.checksums[gbx_path] == gbx_tree.getroot().get('md5')
+            assert sink.files == 2
+            resolver = vfs.open_resolver(archive_path)
+            for name, exp_md5 in exp_md5s.items():
+                assert md5(resolver(name)).hexdigest() == exp_md5
+            resolver.close()
+
+
+def test_unchanged_output_tm1():
+    xml_path = 'Samples/TM1.0/Custom/ListSource/Units.Inline.xml'
+    gbx_tree = ET.parse(xml_path)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        gbx_path = os.path.join(temp_dir, 'out', 'Units.Inline.Gbx')
+        sink = sinks.DirectorySink()
+        xml_to_gbx(xml_path, gbx_path, gbx_tree.getroot(), sink=sink)
+        os.utime(gbx_path, (0, 0))
+        xml_to_gbx(xml_path, gbx_path, gbx_tree.getroot(), sink=sink)  # Same bytes, not written
+        assert os.path.getmtime(gbx_path) == 0 and sink.changed == 1 and sink.files == 2
+        with open(gbx_path, 'r+b') as gbx_file:
+            gbx_file.write(b'X')
+        xml_to_gbx(xml_path, gbx_path, gbx_tree.getroot(), sink=sink)
+        assert checksum_file(gbx_path, gbx_tree.getroot().get('md5')) and sink.changed == 2
+        assert os.listdir(os.path.dirname(gbx_path)) == ['Units.Inline.Gbx']  # No temporary file left
+
+
+def test_manifest_tm1():
+    xml_dir = 'Samples/TM1.0/Custom/ListSource'
+    with tempfile.TemporaryDirectory() as temp_dir:
+        sink = sinks.DirectorySink('sha256')
+        for file_name in ('Units.Csv.xml', 'Units.Inline.xml'):
+            xml_path = os.path.join(xml_dir, file_name)
+            xml_to_gbx(xml_path, os.path.join(temp_dir, f'{file_name[:-4]}.Gbx'), ET.parse(xml_path).getroot(),
+                       sink=sink)
+        manifest_path = os.path.join(temp_dir, 'SHA256SUMS')
+        sink.write_manifest(manifest_path)
+        with open(manifest_path) as manifest_file:
+            lines = manifest_file.read().splitlines()
+        assert len(lines) == 2
+        for line in lines:
+            digest, path = line.split('  ')
+            with open(path, 'rb') as gbx_file:
+                assert hashlib.sha256(gbx_file.read()).hexdigest() == digest
+
+
+def test_tree_cache_tmo():
+    xml_path = 'Samples/TMO/TMEDFrontier/DesertToDesert2/DesertToDesert2.TMEDFrontier.xml'
+    gbx_path = 'Samples/TMO/TMEDFrontier/DesertToDesert2/DesertToDesert2.TMEDFrontier.Gbx'
+    with tempfile.TemporaryDirectory() as temp_dir:
+        try:
+            for run in range(2):  # Parsed by the first run, loaded from the cache by the second one
+                tree_cache = gbx_xml.tree_cache = TreeCache(temp_dir)
+                gbx_tree = gbx_xml.ParseXml(xml_path)[0]
+                link_graph = build_link_graph(xml_path, gbx_tree)
+                validate_gbx_xml(gbx_tree, xml_path, link_graph)
+                og_path = os.getcwd()
+                xml_to_gbx(xml_path, gbx_path, gbx_tree.getroot(), link_graph)
+                os.chdir(og_path)
+                assert checksum_file(gbx_path, gbx_tree.getroot().get('md5')) is True
+                assert (tree_cache.hits, tree_cache.misses) == ((0, 66) if run == 0 else (66, 0))
+                tree_cache.save()
+        finally:
+            gbx_xml.tree_cache = None
+
+
+def test_validation_cache_tmo():
+    xml_path = 'Samples/TMO/TMEDFrontier/DesertToDesert2/DesertToDesert2.TMEDFrontier.xml'
+    with tempfile.TemporaryDirectory() as temp_dir:
+        try:
+            for run in range(3):  # Validated, skipped as unchanged, then validated again by revalidate
+                gbx_xml.revalidate = run == 2
+                tree_cache = gbx_xml.tree_cache = TreeCache(temp_dir)
+                gbx_tree = gbx_xml.ParseXml(xml_path)[0]
+                link_graph = build_link_graph(xml_path, gbx_tree)
+                validate_gbx_xml(gbx_tree, xml_path, link_graph)
+                assert (link_graph.saved['validations'] > 0) == (run == 1)
+                assert len(tree_cache.validated) == 65
+                tree_cache.save()
+        finally:
+            gbx_xml.tree_cache = None
+            gbx_xml.revalidate = False
+
+
 def main():
     test_collection_tm1()
     test_script_tm1()
     test_resindex_tm1()
     test_frontier_tmo()
     test_slope_tmo()
+    test_mesh_visual_tm1()
+    test_mesh_surface_tm1()
+    test_list_source_tm1()
+    test_stream_tm1()
+    test_stream_tmo()
+    test_compile_twice_tm1()
+    test_link_graph_tmo()
+    test_gbxclass_jobs()
+    test_link_cycle()
+    test_fragment_cache_tmo()
+    test_gbxclass_links()
+    test_same_content_tmnesw()
+    test_dedup_nodes()
+    test_compress_tmo()
+    test_compile_xml_tmo()
+    test_deep_nodes()
+    test_async_compile_tmo()
+    test_archive_source_tmo()
+    test_archive_sink_tm1()
+    test_unchanged_output_tm1()
+    test_manifest_tm1()
+    test_tree_cache_tmo()
+    test_validation_cache_tmo()
 
 
 if __name__ == '__main__':
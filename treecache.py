@@ -0,0 +1,187 @@
+"""
+Parsed XML files kept in a directory between runs (see --tree-cache), loading a tree from it is faster than
+parsing the XML file again. Trees are stored by the hash of the file content, and an index remembers the size,
+modification time and hash of each file so an unchanged file isn't read at all.
+The least recently used trees are removed once they take more than max_size bytes.
+The keys of the linked files that passed validation are kept too (see LinkGraph.is_validated).
+"""
+import logging
+import marshal
+import os
+import struct
+import threading
+import time
+import xml.etree.ElementTree as ET
+from struct import pack
+
+TREE_MAGIC = b'GBXT'
+TREE_FORMAT = 1
+INDEX_FORMAT = 2
+INDEX_NAME = 'index'
+DEFAULT_MAX_SIZE = 256 << 20
+MAX_VALIDATED = 100000  # Validation keys kept, the least recently used ones are dropped
+
+
+def dump_tree(root: ET.Element) -> bytes:
+    """ Serializes a tree as tag, attributes, text and number of children of each element in document order """
+    items = []
+    for elem in root.iter():  # The tails are whitespace between tags, nothing reads them
+        items += (elem.tag, elem.attrib or None, elem.text, len(elem))
+    return TREE_MAGIC + pack('<I', TREE_FORMAT) + marshal.dumps(items, 4)
+
+
+def load_tree(data: bytes) -> ET.Element:
+    """ Reads a tree written by dump_tree, raises ValueError if it isn't one """
+    if data[:4] != TREE_MAGIC or struct.unpack_from('<I', data, 4)[0] != TREE_FORMAT:
+        raise ValueError('not a tree')
+    try:
+        items = marshal.loads(data[8:])
+        sub_element = ET.SubElement
+        root = ET.Element(items[0], items[1] or {})
+        root.text = items[2]
+        parents = [root]
+        counts = [items[3]]
+        for i in range(4, len(items), 4):
+            while not counts[-1]:
+                parents.pop()
+                counts.pop()
+            counts[-1] -= 1
+            elem = sub_element(parents[-1], items[i])
+            if items[i + 1]:
+                elem.attrib = items[i + 1]
+            elem.text = items[i + 2]
+            if items[i + 3]:
+                parents.append(elem)
+                counts.append(items[i + 3])
+    except (EOFError, TypeError, IndexError):
+        raise ValueError('truncated tree')
+    return root
+
+
+class TreeCache:
+    """
+    Parsed XML files by content hash, in directory. The index is read when created and written by save,
+    it also holds when each tree was last used so nothing is written to the trees when they are read
+    """
+    def __init__(self, directory: str, max_size: int = DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.files: dict = {}  # absolute path -> (size, modification time, content hash)
+        self.trees: dict = {}  # content hash -> [last use, size of the tree file]
+        self.validated: dict = {}  # validation key -> None, the most recently used last
+        self._checked: dict = {}  # absolute path -> (size, content hash) or None, files looked up by this run
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(os.path.join(directory, INDEX_NAME), 'rb') as index_file:
+                index_format, self.files, self.trees, self.validated = marshal.load(index_file)
+            if index_format != INDEX_FORMAT:
+                raise ValueError
+        except (OSError, EOFError, ValueError, TypeError):  # No index yet: the files are parsed again
+            self.files = {}
+            self.trees = {}
+            self.validated = {}
+
+    def _file_path(self, file_hash: str) -> str:
+        return os.path.join(self.directory, f'{file_hash}.tree')
+
+    def lookup(self, path: str) -> tuple[int, str] or None:
+        """ Returns the size and content hash of the file at path if it didn't change since it was cached """
+        path = os.path.abspath(path)
+        if path in self._checked:
+            return self._checked[path]
+        entry = self.files.get(path)
+        result = None
+        if entry is not None and entry[2] in self.trees:
+            try:
+                stat = os.stat(path)
+                if (stat.st_size, stat.st_mtime_ns) == entry[:2]:
+                    result = entry[0], entry[2]
+            except OSError:
+                pass
+        self._checked[path] = result
+        return result
+
+    def get(self, path: str) -> ET.Element or None:
+        """ Returns the tree of the file at path if it didn't change since it was cached """
+        entry = self.lookup(path)
+        root = None
+        if entry is not None:
+            try:
+                with open(self._file_path(entry[1]), 'rb') as tree_file:
+                    root = load_tree(tree_file.read())
+                self.trees[entry[1]][0] = time.time()
+            except (OSError, ValueError):
+                root = None
+        if root is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return root
+
+    def put(self, path: str, file_hash: str, root: ET.Element):
+        """ Adds the tree of the file at path, file_hash being the sha256 of its content """
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        self.files[path] = (stat.st_size, stat.st_mtime_ns, file_hash)
+        self._checked[path] = stat.st_size, file_hash
+        tree_path = self._file_path(file_hash)
+        if file_hash in self.trees and os.path.exists(tree_path):
+            self.trees[file_hash][0] = time.time()
+            return
+        data = dump_tree(root)
+        # The prefetch threads can parse files with the same content at the same time
+        temp_path = f'{tree_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(temp_path, 'wb') as tree_file:
+                tree_file.write(data)
+            os.replace(temp_path, tree_path)
+        except OSError as e:
+            logging.warning(f'Could not save a parsed tree to "{tree_path}"! {e}')
+            return
+        self.trees[file_hash] = [time.time(), len(data)]
+
+    def is_validated(self, key: str) -> bool:
+        if key in self.validated:
+            self.validated[key] = self.validated.pop(key)
+            return True
+        return False
+
+    def set_validated(self, key: str):
+        self.validated.pop(key, None)
+        self.validated[key] = None
+
+    def _evict(self):
+        """ Removes the least recently used trees while they take more than max_size bytes """
+        total_size = sum(size for last_use, size in self.trees.values())
+        for file_hash, (last_use, size) in sorted(self.trees.items(), key=lambda item: item[1][0]):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(self._file_path(file_hash))
+            except OSError:
+                pass
+            del self.trees[file_hash]
+            total_size -= size
+
+    def save(self):
+        """ Saves the index, after removing the trees past max_size """
+        self._evict()
+        self.files = {path: entry for path, entry in self.files.items() if entry[2] in self.trees}
+        for key in list(self.validated)[:-MAX_VALIDATED]:
+            del self.validated[key]
+        index_path = os.path.join(self.directory, INDEX_NAME)
+        temp_path = f'{index_path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, 'wb') as index_file:
+                marshal.dump((INDEX_FORMAT, self.files, self.trees, self.validated), index_file, 4)
+            os.replace(temp_path, index_path)
+        except OSError as e:
+            logging.warning(f'Could not save the parsed tree index to "{index_path}"! {e}')
+
+    def log_stats(self):
+        logging.info(f'Tree cache: {self.hits} hits, {self.misses} misses')
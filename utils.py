@@ -1,8 +1,43 @@
+import contextlib
+import logging
 import os
+import posixpath
+from io import BytesIO, TextIOWrapper
+from struct import pack
 from typing import io
 import xml.etree.ElementTree as ET
 
+from gbxerrors import GBXWriteError
+
 encoding = 'ascii'
+# When set, files are read with resolver instead of the disk (see gbx.compile_xml): it is called with the path of
+# a file relative to the compiled file and returns its bytes, or None if there is no such file.
+# The working directory is then a virtual one, "/" being the directory of the compiled file
+resolver = None
+_virtual_cwd = '/'
+
+
+COUNT_TYPES = {
+    'uint32': ('<I', 4294967295),
+    'uint16': ('<H', 65535),
+    'uint8': ('<B', 255),
+}
+
+
+def write_count(file_w, count: int, count_type: str = None):
+    """
+    Writes an element count using the "count_type" attribute rules of <list>.
+    Defaults to uint32, "none" writes nothing.
+    """
+    if count_type == 'none':
+        return
+    if count_type not in COUNT_TYPES:
+        count_type = 'uint32'
+    fmt, max_count = COUNT_TYPES[count_type]
+    if count > max_count:
+        logging.error(f'Error: list count exceeded {count_type} size!')
+        raise GBXWriteError
+    file_w.write(pack(fmt, count))
 
 
 class GlobalNodePool:
@@ -113,3 +148,55 @@ class Counter:
         :return:
         """
         self.__default_decr_value = decr_value
+
+
+def _virtual_path(path: str) -> str:
+    return posixpath.normpath(posixpath.join(_virtual_cwd, str(path).replace('\\', '/')))
+
+
+def chdir(path: str):
+    global _virtual_cwd
+    if resolver is None:
+        os.chdir(path)
+    else:
+        _virtual_cwd = _virtual_path(path)
+
+
+def getcwd() -> str:
+    return os.getcwd() if resolver is None else _virtual_cwd
+
+
+def abspath(path: str) -> str:
+    return os.path.abspath(path) if resolver is None else _virtual_path(path)
+
+
+def open_file(path: str, mode: str = 'rb', **kwargs):
+    """ Opens a file for reading, from resolver if it is set. Raises FileNotFoundError if there is no such file """
+    if resolver is None:
+        return open(path, mode, **kwargs)
+    data = resolver(_virtual_path(path).lstrip('/'))
+    if data is None:
+        raise FileNotFoundError(f'No such file: \'{path}\'')
+    if 'b' in mode:
+        return BytesIO(data)
+    return TextIOWrapper(BytesIO(data), kwargs.get('encoding') or 'utf-8', newline=kwargs.get('newline'))
+
+
+def isfile(path: str) -> bool:
+    if resolver is None:
+        return os.path.isfile(path)
+    return resolver(_virtual_path(path).lstrip('/')) is not None
+
+
+@contextlib.contextmanager
+def use_resolver(new_resolver):
+    """ Reads the files with new_resolver (see resolver) inside of the with block """
+    global resolver
+    global _virtual_cwd
+    previous = resolver, _virtual_cwd
+    resolver = new_resolver
+    _virtual_cwd = '/'
+    try:
+        yield
+    finally:
+        resolver, _virtual_cwd = previous
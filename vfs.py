@@ -0,0 +1,140 @@
+"""
+Resolvers reading the source files from a directory, a zip or tar archive or a dict instead of the working
+directory (see utils.resolver). A resolver is called with the path of a file relative to its root, like
+"Solids/1.CPlugSolid.xml", and returns its bytes or None if there is no such file.
+"""
+import os
+import posixpath
+import tarfile
+import threading
+import zipfile
+
+CACHE_SIZE = 256  # Files kept by each resolver, a file is often looked up right before being read
+
+
+def member_name(path: str) -> str:
+    """ Returns the name a file is looked up by: relative, with forward slashes and no "." or ".." """
+    return posixpath.normpath('/' + path.replace('\\', '/')).lstrip('/')
+
+
+class Resolver:
+    """ Base of the resolvers, read reads a file by its member name. The last CACHE_SIZE files read are kept """
+    def __init__(self):
+        self._cache: dict = {}  # member name -> bytes or None, in the order of use
+        self._cache_lock = threading.Lock()  # The prefetch threads look up files at the same time
+        self.reads = 0
+
+    def read(self, name: str) -> bytes or None:
+        return None
+
+    def __call__(self, path: str) -> bytes or None:
+        name = member_name(path)
+        with self._cache_lock:
+            if name in self._cache:
+                data = self._cache[name] = self._cache.pop(name)
+                return data
+        data = self.read(name)
+        with self._cache_lock:
+            self.reads += 1
+            self._cache[name] = data
+            if len(self._cache) > CACHE_SIZE:
+                del self._cache[next(iter(self._cache))]
+        return data
+
+    def close(self):
+        self._cache.clear()
+
+
+class LocalResolver(Resolver):
+    """ Files of the directory root """
+    def __init__(self, root: str = '.'):
+        super().__init__()
+        self.root = os.path.abspath(root)
+
+    def read(self, name: str) -> bytes or None:
+        try:
+            with open(os.path.join(self.root, name), 'rb') as in_file:
+                return in_file.read()
+        except OSError:
+            return None
+
+
+class DictResolver(Resolver):
+    """ Bytes by path """
+    def __init__(self, files: dict):
+        super().__init__()
+        self.files = {member_name(path): data for path, data in files.items()}
+
+    def read(self, name: str) -> bytes or None:
+        return self.files.get(name)
+
+
+class ZipResolver(Resolver):
+    """ Files of a zip archive, opened again by each process so they don't share the file position """
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._archive = None
+        self._pid = None
+        self.members = {member_name(info.filename): info.filename
+                        for info in self._open().infolist() if not info.is_dir()}
+
+    def _open(self) -> zipfile.ZipFile:
+        if self._pid != os.getpid():
+            self._archive = zipfile.ZipFile(self.path)
+            self._pid = os.getpid()
+        return self._archive
+
+    def read(self, name: str) -> bytes or None:
+        member = self.members.get(name)
+        if member is None:
+            return None
+        return self._open().read(member)
+
+    def close(self):
+        super().close()
+        if self._archive and self._pid == os.getpid():
+            self._archive.close()
+        self._archive = None
+
+
+class TarResolver(Resolver):
+    """ Files of a tar archive (compressed or not), read by one thread at a time """
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._archive = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.members = {member_name(info.name): info for info in self._open().getmembers() if info.isfile()}
+
+    def _open(self) -> tarfile.TarFile:
+        if self._pid != os.getpid():
+            self._archive = tarfile.open(self.path)
+            self._pid = os.getpid()
+        return self._archive
+
+    def read(self, name: str) -> bytes or None:
+        info = self.members.get(name)
+        if info is None:
+            return None
+        with self._lock:
+            with self._open().extractfile(info) as member_file:
+                return member_file.read()
+
+    def close(self):
+        super().close()
+        if self._archive and self._pid == os.getpid():
+            self._archive.close()
+        self._archive = None
+
+
+def open_resolver(path: str) -> Resolver:
+    """ Returns the resolver of a directory, or of a zip or tar archive """
+    if os.path.isdir(path):
+        return LocalResolver(path)
+    if zipfile.is_zipfile(path):
+        return ZipResolver(path)
+    if tarfile.is_tarfile(path):
+        return TarResolver(path)
+    raise ValueError(f'"{path}" is not a directory, zip or tar archive')